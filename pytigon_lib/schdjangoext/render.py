@@ -19,10 +19,31 @@
 
 from django.template import loader, Context
 
-from pytigon_lib.schdjangoext.spreadsheet_render import render_odf, render_ooxml
+from pytigon_lib.schdjangoext.spreadsheet_render import (
+    render_odf,
+    render_ooxml,
+    render_rows,
+)
 from pytigon_lib.schhtml.htmlviewer import stream_from_html
 import os
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _iter_file(file_name, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield content of temporary file in chunks and remove the file at the end,
+    can be used with StreamingHttpResponse"""
+    try:
+        with open(file_name, "rb") as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                yield data
+    finally:
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
 
 def get_template_names(context, doc_type):
     ret = []
@@ -64,12 +85,33 @@ def render_doc(context):
 
     templates = get_template_names(context, doc_type)
 
+    if doc_type in ("ods", "xlsx") and "stream_rows" in context:
+        # large data sets: rows are written directly to the first sheet of template,
+        # document is saved to temporary file and returned as iterator of its chunks
+        file_out, file_in = render_rows(
+            templates,
+            context["stream_rows"],
+            context.get("stream_header_rows", 1),
+            context.get("stream_fields"),
+            stream=False,
+        )
+        ret_attr["Content-Length"] = str(os.path.getsize(file_out))
+        ret_content = _iter_file(file_out)
+        ret_attr["Content-Disposition"] = "attachment; filename=%s" % os.path.basename(
+            file_in
+        )
+        if doc_type == "ods":
+            ret_attr["Content-Type"] = "application/vnd.oasis.opendocument.spreadsheet"
+        else:
+            ret_attr[
+                "Content-Type"
+            ] = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        return ret_attr, ret_content
+
     if doc_type in ("ods", "odt", "odp"):
-        file_out, file_in = render_odf(templates, Context(context))
+        file_out, file_in = render_odf(templates, Context(context), stream=True)
         if file_out:
-            with open(file_out, "rb") as f:
-                ret_content = f.read()
-            os.remove(file_out)
+            ret_content = file_out.getvalue()
             ret_attr[
                 "Content-Disposition"
             ] = "attachment; filename=%s" % os.path.basename(file_in)
@@ -78,11 +120,9 @@ def render_doc(context):
         return ret_attr, ret_content
 
     elif doc_type in ("xlsx", "docx", "pptx"):
-        file_out, file_in = render_ooxml(templates, Context(context))
+        file_out, file_in = render_ooxml(templates, Context(context), stream=True)
         if file_out:
-            with open(file_out, "rb") as f:
-                ret_content = f.read()
-            os.remove(file_out)
+            ret_content = file_out.getvalue()
             ret_attr[
                 "Content-Disposition"
             ] = "attachment; filename=%s" % os.path.basename(templates[0])
@@ -40,22 +40,27 @@ from django.template.exceptions import TemplateDoesNotExist
 from pytigon_lib.schfs.vfstools import get_temp_filename
 from pytigon_lib.schspreadsheet.odf_process import OdfDocTransform
 from pytigon_lib.schspreadsheet.ooxml_process import OOXmlDocTransform
+from pytigon_lib.schspreadsheet.stream_writer import write_rows
 
 template_dirs = getattr(settings, "TEMPLATES")[0]["DIRS"]
 
+TEMPLATE_HEADER = "{% load exsyntax %}{% load exfiltry %}{% load expr %}"
+
 
 class OdfDocTemplateTransform(OdfDocTransform):
+    def compile_template(self, doc_str):
+        return Template(TEMPLATE_HEADER + doc_str)
+
     def process_template(self, doc_str, context):
-        return Template(
-            "{% load exsyntax %}{% load exfiltry %}{% load expr %}" + doc_str
-        ).render(context)
+        return self.compile_template(doc_str).render(context)
 
 
 class OOXmlDocTemplateTransform(OOXmlDocTransform):
+    def compile_template(self, doc_str):
+        return Template(TEMPLATE_HEADER + doc_str)
+
     def process_template(self, doc_str, context):
-        return Template(
-            "{% load exsyntax %}{% load exfiltry %}{% load expr %}" + doc_str
-        ).render(context)
+        return self.compile_template(doc_str).render(context)
 
 
 def oo_dict(template_name):
@@ -95,17 +100,52 @@ class DefaultTbl(object):
         return ""
 
 
-def _render_doc(doc_type, template_name, context_instance=None, debug=None):
+def _find_template(template_name):
+    """Return path of template file
+
+    Args:
+        template_name - name of template or list of names - the first existing is
+        returned
+    """
+    if template_name.__class__ in (list, tuple):
+        test = False
+        for tname in template_name:
+            if tname[0] == "/":
+                name = tname
+                if os.path.exists(name):
+                    test = True
+                    break
+            else:
+                for template_dir in template_dirs:
+                    name = template_dir + "/" + tname
+                    if os.path.exists(name):
+                        test = True
+                        break
+                if test:
+                    break
+        if not test:
+            raise TemplateDoesNotExist(";".join(template_name))
+    else:
+        name = template_name
+    return name
+
+
+def _render_doc(
+    doc_type, template_name, context_instance=None, debug=None, stream=False
+):
     """Render odf file content, save rendered file and return its name
 
     Args:
         template_name - name of template. Template is odf file with special syntax.
         context_instance - see django.template.Context
         debug - if True - print some additional information to console
+        stream - if True - render document to io.BytesIO object instead of temporary
+        file
 
     Returns:
         (output_file_name, template_name)
-        output_file_name is the name of temporary file with rendered content
+        output_file_name is the name of temporary file with rendered content or
+        io.BytesIO object if stream is True
         template_name - real path to template odf file
     """
     if not "tbl" in context_instance:
@@ -121,27 +161,11 @@ def _render_doc(doc_type, template_name, context_instance=None, debug=None):
         if not "tbl" in context_instance:
             context_instance["tbl"] = DefaultTbl()
 
-        if template_name.__class__ in (list, tuple):
-            test = False
-            for tname in template_name:
-                if tname[0] == "/":
-                    name = tname
-                    if os.path.exists(name):
-                        test = True
-                        break
-                else:
-                    for template_dir in template_dirs:
-                        name = template_dir + "/" + tname
-                        if os.path.exists(name):
-                            test = True
-                            break
-                    if test:
-                        break
-            if not test:
-                raise TemplateDoesNotExist(";".join(template_name))
+        name = _find_template(template_name)
+        if stream:
+            name_out = io.BytesIO()
         else:
-            name = template_name
-        name_out = get_temp_filename()
+            name_out = get_temp_filename()
         if doc_type.lower().startswith("od"):
             doc = OdfDocTemplateTransform(name, name_out)
         else:
@@ -151,17 +175,43 @@ def _render_doc(doc_type, template_name, context_instance=None, debug=None):
 
         if ret != 1:
             ret2 = (None, name)
-            os.remove(name_out)
+            if not stream and os.path.exists(name_out):
+                os.remove(name_out)
         else:
             ret2 = (name_out, name)
     return ret2
 
 
+def render_rows(template_name, rows, header_rows=1, fields=None, stream=True):
+    """Write rows to xlsx or ods file incrementally, without template engine.
+
+    Args:
+        template_name - name of template (xlsx or ods file) or list of names, see
+        pytigon_lib.schspreadsheet.stream_writer
+        rows - iterable of rows, for example QuerySet.values_list().iterator()
+        header_rows - number of rows of template copied to output
+        fields - None or list of attribute names or functions used to get values from
+        row objects
+        stream - if True - write document to io.BytesIO object instead of temporary
+        file
+
+    Returns:
+        (output_file_name, template_name) - see _render_doc
+    """
+    name = _find_template(template_name)
+    if stream:
+        name_out = io.BytesIO()
+    else:
+        name_out = get_temp_filename()
+    write_rows(name, name_out, rows, header_rows, fields)
+    return (name_out, name)
+
+
 def _render_doc_to_response(
     doc_type, doc_content_type, template_name, context_instance=None, debug=None
 ):
 
-    s = _render_doc(doc_type, template_name, context_instance, debug)
+    s = _render_doc(doc_type, template_name, context_instance, debug, stream=True)
 
     if not s[0]:
         response = None
@@ -173,19 +223,16 @@ def _render_doc_to_response(
         response = HttpResponse()
         response["Content-Disposition"] = "attachment; filename=%s" % name
         response["Content-Type"] = "application/vnd.oasis.opendocument.spreadsheet"
-        f = open(s[0], "rb")
-        response.content = f.read()
-        f.close()
-        os.remove(s[0])
+        response.content = s[0].getvalue()
     return response
 
 
-def render_odf(template_name, context_instance=None, debug=None):
-    return _render_doc("ODF", template_name, context_instance, debug)
+def render_odf(template_name, context_instance=None, debug=None, stream=False):
+    return _render_doc("ODF", template_name, context_instance, debug, stream)
 
 
-def render_ooxml(template_name, context_instance=None, debug=None):
-    return _render_doc("OOXML", template_name, context_instance, debug)
+def render_ooxml(template_name, context_instance=None, debug=None, stream=False):
+    return _render_doc("OOXML", template_name, context_instance, debug, stream)
 
 
 def render_to_response_odf(template_name, context_instance=None, debug=None):
@@ -23,6 +23,8 @@ import tempfile
 import email.generator
 import zipfile
 import hashlib
+import copy
+import struct
 
 from pytigon_lib.schdjangoext.tools import gettempdir
 
@@ -82,6 +84,77 @@ def get_temp_filename(base_name=None):
         return os.path.join(gettempdir(), boundary)
 
 
+def _copy_zip_member(zin, zout, info):
+    """Copy compressed data of zip member without decompression"""
+    zin.fp.seek(info.header_offset)
+    header = zin.fp.read(30)
+    if header[:4] != b"PK\x03\x04":
+        raise zipfile.BadZipFile("Bad magic number for file header: %s" % info.filename)
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    zin.fp.seek(name_len + extra_len, 1)
+
+    info2 = copy.copy(info)
+    # sizes and crc are known, so data descriptor is not needed
+    info2.flag_bits &= ~0x08
+    info2.header_offset = zout.fp.tell()
+    zout.fp.write(info2.FileHeader())
+    size = info.compress_size
+    while size > 0:
+        buf = zin.fp.read(min(size, 1024 * 1024))
+        if not buf:
+            raise zipfile.BadZipFile("Truncated file: %s" % info.filename)
+        zout.fp.write(buf)
+        size -= len(buf)
+    zout.filelist.append(info2)
+    zout.NameToInfo[info2.filename] = info2
+    zout.start_dir = zout.fp.tell()
+
+
+def _write_zip_member(zout, name, content):
+    if content is None:
+        return
+    if callable(content):
+        with zout.open(name, "w", force_zip64=True) as f:
+            content(f)
+    else:
+        zout.writestr(name, content)
+
+
+def rewrite_zip(zip_in, zip_out, files=None, compression=zipfile.ZIP_DEFLATED):
+    """Copy zip file in one pass, replacing, deleting or adding some members.
+
+    Unchanged members are copied raw - without decompression and compression.
+
+    Args:
+        zip_in - name of source zip file or file-like object
+        zip_out - name of output zip file or writable file-like object
+        files - dict: member name -> new content (bytes, str or function which gets
+        writable file object and writes content to it incrementally). If content is
+        None member is deleted. Replaced members keep their position in archive, new
+        members are appended at the end. Names are compared case insensitive.
+        compression - compression of new content
+    """
+    files2 = {}
+    if files:
+        for key, value in files.items():
+            files2[key.lower()] = (key, value)
+    zin = zipfile.ZipFile(zip_in, "r")
+    zout = zipfile.ZipFile(zip_out, "w", compression)
+    try:
+        for info in zin.infolist():
+            name = info.filename.lower()
+            if name in files2:
+                _write_zip_member(zout, *files2.pop(name))
+            else:
+                _copy_zip_member(zin, zout, info)
+        for key, value in files2.values():
+            _write_zip_member(zout, key, value)
+    finally:
+        zout.close()
+        zin.close()
+    return 1
+
+
 def delete_from_zip(zip_name, del_file_names):
     """Delete one file from zip
 
@@ -89,17 +162,8 @@ def delete_from_zip(zip_name, del_file_names):
         zip_name - name of zip file
         del_file_names - name of file to delete
     """
-    del_file_names2 = [pos.lower() for pos in del_file_names]
-
     tmpname = get_temp_filename()
-    zin = zipfile.ZipFile(zip_name, "r")
-    zout = zipfile.ZipFile(tmpname, "w", zipfile.ZIP_STORED)
-    for item in zin.infolist():
-        if not item.filename.lower() in del_file_names2:
-            buffer = zin.read(item.filename)
-            zout.writestr(item, buffer)
-    zout.close()
-    zin.close()
+    rewrite_zip(zip_name, tmpname, dict((pos, None) for pos in del_file_names))
     os.remove(zip_name)
     os.rename(tmpname, zip_name)
     return 1
@@ -18,8 +18,17 @@
 # version: "0.1a"
 
 
+from bisect import bisect_right
+from itertools import accumulate
+
 from pytigon_lib.schhtml.htmltools import superstrip
 
+# line breaking: "greedy" - fill every line as much as possible, "optimal" - minimize sum
+# of squares of free space at the end of lines (Knuth-Plass without hyphenation),
+# can be set for element by css: text-wrap: pretty
+LINE_BREAK = "greedy"
+LINE_BREAK_CACHE_SIZE = 4
+
 decode_sym = (
     ("&gt;", ">"),
     ("&lt;", "<"),
@@ -39,6 +48,8 @@ def unescape(txt):
 class Atom(object):
     """Base rendered element"""
 
+    __slots__ = ("data", "dx", "dx_space", "dy_up", "dy_down", "style", "parent", "is_txt")
+
     def __init__(self, data, dx, dx_space, dy_up, dy_down, style=-1, is_txt=False):
         self.data = data
         self.dx = dx
@@ -63,6 +74,8 @@ class Atom(object):
 
 
 class NullAtom(Atom):
+    __slots__ = ()
+
     def __init__(self):
         self.data = ""
         self.dx = 0
@@ -78,14 +91,29 @@ class NullAtom(Atom):
 
 
 class BrAtom(NullAtom):
+    __slots__ = ("cr_count",)
+
     def __init__(self, cr_count=1):
         NullAtom.__init__(self)
         self.cr_count = cr_count
 
 
+_ctrl_classes = {}
+
+
+def _is_ctrl(obj):
+    cls = obj.__class__
+    ret = _ctrl_classes.get(cls)
+    if ret == None:
+        ret = _ctrl_classes[cls] = "CtrlTag" in cls.__name__
+    return ret
+
+
 class AtomLine(object):
     """Class represent full line in rendered html"""
 
+    __slots__ = ("maxwidth", "dx", "space", "dy_up", "dy_down", "objs")
+
     def __init__(self, maxwidth):
         self.maxwidth = maxwidth
         self.dx = 0
@@ -95,19 +123,8 @@ class AtomLine(object):
         self.objs = []
 
     def _append(self, atom):
-        atom = atom
-        if len(self.objs) > 0 and atom.is_txt:
-            if False:
-                self.objs[-1].data += atom.data
-                self.objs[-1].dx_space = atom.dx_space
-                self.objs[-1].dx += atom.get_width()
-                self.dx = self.dx + atom.get_width()
-            else:
-                self.objs.append(atom)
-                self.dx = self.dx + atom.get_width()
-        else:
-            self.objs.append(atom)
-            self.dx = self.dx + atom.get_width()
+        self.objs.append(atom)
+        self.dx = self.dx + atom.dx
         self.space = atom.dx_space
         if self.dy_up < atom.dy_up:
             self.dy_up = atom.dy_up
@@ -133,8 +150,112 @@ class AtomLine(object):
         return self.dy_up + self.dy_down
 
 
+def _new_line(width, atoms, dx):
+    line = AtomLine(width)
+    line.objs = atoms
+    line.dx = dx
+    line.space = atoms[-1].dx_space
+    for atom in atoms:
+        if line.dy_up < atom.dy_up:
+            line.dy_up = atom.dy_up
+        if line.dy_down < atom.dy_down:
+            line.dy_down = atom.dy_down
+    return line
+
+
+def _prefix_sums(atoms):
+    """Return (p, q, monotone): p[i] - width of atoms[:i], q[i] - width of atoms[: i + 1]
+    without trailing space of atoms[i]"""
+    p = list(accumulate([atom.dx for atom in atoms], initial=0))
+    q = [p[i + 1] - atoms[i].dx_space for i in range(0, len(atoms))]
+    monotone = True
+    for atom in atoms:
+        if atom.dx < atom.dx_space:
+            monotone = False
+            break
+    return (p, q, monotone)
+
+
+def break_greedy(width, atoms):
+    """Break atoms into lines, every line holds as many atoms as possible
+
+    Args:
+        width - maximum width of line
+        atoms - list of atoms without BrAtom objects
+
+    Returns:
+        list of AtomLine objects, last line is empty if atoms is empty
+    """
+    n = len(atoms)
+    if n == 0:
+        return [AtomLine(width)]
+    (p, q, monotone) = _prefix_sums(atoms)
+    lines = []
+    if q[0] > width:
+        lines.append(AtomLine(width))
+    i = 0
+    while i < n:
+        limit = p[i] + width
+        if monotone:
+            j = bisect_right(q, limit, i + 1)
+        else:
+            j = i + 1
+            while j < n and q[j] <= limit:
+                j += 1
+        lines.append(_new_line(width, atoms[i:j], p[j] - p[i]))
+        i = j
+    return lines
+
+
+def break_optimal(width, atoms):
+    """Break atoms into lines minimizing sum of squares of free space at the end of
+    lines (last line excluded)
+
+    Args and return value like in break_greedy
+    """
+    n = len(atoms)
+    if n == 0:
+        return [AtomLine(width)]
+    (p, q, monotone) = _prefix_sums(atoms)
+    best = [0] + [None] * n
+    prev = [0] * (n + 1)
+    for j in range(1, n + 1):
+        end = q[j - 1]
+        for i in range(j - 1, -1, -1):
+            w = end - p[i]
+            if w > width and i < j - 1:
+                break
+            if j == n and w <= width:
+                cost = best[i]
+            else:
+                cost = best[i] + (width - w) * (width - w)
+            if best[j] == None or cost < best[j]:
+                best[j] = cost
+                prev[j] = i
+    lines = []
+    j = n
+    while j > 0:
+        i = prev[j]
+        lines.append(_new_line(width, atoms[i:j], p[j] - p[i]))
+        j = i
+    lines.reverse()
+    return lines
+
+
 class AtomList(object):
-    def __init__(self, dc_info, line_dy=0, pre=False):
+    __slots__ = (
+        "dc_info",
+        "atom_list",
+        "line_dy",
+        "list_for_draw",
+        "first_line_height",
+        "width",
+        "pre",
+        "line_break",
+        "_lines_cache",
+    )
+
+    def __init__(self, dc_info, line_dy=0, pre=False, line_break=None):
         self.dc_info = dc_info
         self.atom_list = []
         self.line_dy = dc_info.get_line_dy(line_dy)
@@ -142,11 +263,19 @@ class AtomList(object):
         self.first_line_height = -1
         self.width = -1
         self.pre = pre
+        self.line_break = line_break if line_break else LINE_BREAK
+        self._lines_cache = None
+
+    def invalidate(self):
+        """Forget broken lines, must be called after change of atoms sizes"""
+        self.list_for_draw = None
+        self._lines_cache = None
 
     def set_line_dy(self, dy):
         self.line_dy = self.dc_info.get_line_dy(dy)
 
     def append_text(self, txt, style, parent=None):
+        self._lines_cache = None
         if txt and len(txt) > 0:
             if not self.pre:
                 txt2 = unescape(txt.replace("\n", " "))
@@ -198,10 +327,12 @@ class AtomList(object):
                     atom.set_parent(parent)
                     self.atom_list.append(atom)
             else:
+                get_extents = self.dc_info.get_extents
+                append = self.atom_list.append
                 for word in words:
                     if word == "":
                         continue
-                    extents = self.dc_info.get_extents(word, style)
+                    extents = get_extents(word, style)
                     atom = Atom(
                         word,
                         extents[0],
@@ -211,11 +342,11 @@ class AtomList(object):
                         style,
                         True,
                     )
-                    if parent:
-                        atom.set_parent(parent)
-                    self.atom_list.append(atom)
+                    atom.parent = parent
+                    append(atom)
 
     def append_atom(self, atom):
+        self._lines_cache = None
         self.atom_list.append(atom)
 
     def get_width_tab(self):
@@ -223,10 +354,11 @@ class AtomList(object):
         maxwidth = 0
         maxmaxwidth = 0
         for atom in self.atom_list:
-            if atom.get_width() > minwidth:
-                minwidth = atom.get_width()
-            maxwidth += atom.get_width() + atom.dx_space
-            if type(atom) == BrAtom:
+            dx = atom.dx
+            if dx > minwidth:
+                minwidth = dx
+            maxwidth += dx + atom.dx_space
+            if atom.__class__ == BrAtom:
                 if maxwidth > maxmaxwidth:
                     maxmaxwidth = maxwidth
                     maxwidth = 0
@@ -240,39 +372,61 @@ class AtomList(object):
             optwidth = maxwidth
         return (optwidth, minwidth, maxwidth)
 
-    def gen_list_for_draw(self, width):
-        l = []
+    def _segments(self):
+        """Split atoms into parts separated by BrAtom objects, skip spaces which are not
+        drawn. Returns list of (atoms, BrAtom or None)"""
+        segments = []
+        atoms = []
         last_atom = None
-        line = AtomLine(width)
         for atom in self.atom_list:
             if atom.__class__ == BrAtom:
-                if atom.cr_count > 1:
-                    line.dy_down = line.dy_down + line.get_height() * (
-                        atom.cr_count - 1
-                    )
-                l.append(line)
-                line = AtomLine(width)
+                segments.append((atoms, atom))
+                atoms = []
                 continue
-            test_append = True
             if atom.is_txt and atom.data == " ":
                 if (
                     last_atom == None
                     or last_atom
                     and last_atom.is_txt
                     and last_atom.data[-1] == " "
-                    or "CtrlTag" in last_atom.data.__class__.__name__
+                    or _is_ctrl(last_atom.data)
                 ):
-                    test_append = False
-            if test_append:
-                if not line.append(atom):
-                    l.append(line)
-                    line = AtomLine(width)
-                    line.append(atom, force_append=True)
+                    last_atom = atom
+                    continue
+            atoms.append(atom)
             last_atom = atom
-        if len(line.objs) > 0:
-            l.append(line)
-            if self.first_line_height == -1:
-                self.first_line_height = line.get_height()
+        segments.append((atoms, None))
+        return segments
+
+    def _break_lines(self, width):
+        if self.line_break == "optimal":
+            break_fun = break_optimal
+        else:
+            break_fun = break_greedy
+        l = []
+        for atoms, br in self._segments():
+            lines = break_fun(width, atoms)
+            if br:
+                if br.cr_count > 1:
+                    line = lines[-1]
+                    line.dy_down = line.dy_down + line.get_height() * (br.cr_count - 1)
+            elif len(lines[-1].objs) > 0:
+                if self.first_line_height == -1:
+                    self.first_line_height = lines[-1].get_height()
+            else:
+                lines.pop()
+            l.extend(lines)
+        return l
+
+    def gen_list_for_draw(self, width):
+        if self._lines_cache == None:
+            self._lines_cache = {}
+        l = self._lines_cache.get(width)
+        if l == None:
+            l = self._break_lines(width)
+            if len(self._lines_cache) >= LINE_BREAK_CACHE_SIZE:
+                self._lines_cache = {}
+            self._lines_cache[width] = l
         self.list_for_draw = l
         self.width = width
 
@@ -21,6 +21,45 @@
 import zipfile
 import io
 import json
+from collections import OrderedDict
+
+from pytigon_lib.schhtml.display_list import DisplayList, zip_member_data
+
+EXTENTS_CACHE_SIZE = 4096
+
+# record drawing operations in compact DisplayList instead of list of tuples
+COMPACT_DISPLAY_LIST = True
+
+
+def write_page(zf, nr, page, binary=False, compression=zipfile.ZIP_DEFLATED):
+    """Write page to zip file as binary display list (page_N.dl) or json lines (page_N)
+
+    Args:
+        zf - zipfile.ZipFile opened for writing
+        nr - page number, starting from 1
+        page - DisplayList or list of records
+        binary - format of page
+        compression - compression of page member
+    """
+    if binary:
+        if isinstance(page, DisplayList):
+            dl = page
+        else:
+            dl = DisplayList()
+            for rec in page:
+                dl.append(rec)
+        zf.writestr("page_%d.dl" % nr, dl.to_bytes(), compress_type=compression)
+    else:
+        buf = io.StringIO()
+        for rec in page:
+            try:
+                buf.write(json.dumps(rec))
+            except:
+                print("basedc:", rec.__class__, rec)
+            buf.write("\n")
+        zf.writestr(
+            "page_%d" % nr, buf.getvalue().encode("utf-8"), compress_type=compression
+        )
 
 
 class BaseDc(object):
@@ -32,7 +71,8 @@ class BaseDc(object):
         self.gparent = None
         self.dc_info = None
 
-        self.store = []
+        self.compact_store = COMPACT_DISPLAY_LIST
+        self.store = self._new_store()
         self.rec = True
         self.calc_only = calc_only
 
@@ -71,6 +111,8 @@ class BaseDc(object):
 
     def set_scale(self, scale):
         self.scale = scale
+        if self.dc_info:
+            self.dc_info.clear_extents_cache()
 
     def restore_state(self, state):
         self.width = state[1]
@@ -80,7 +122,9 @@ class BaseDc(object):
         self._maxwidth = state[5]
         self._maxheight = state[6]
         if self.dc_info:
-            self.dc_info.styles = state[7]
+            if self.dc_info.styles is not state[7]:
+                self.dc_info.styles = state[7]
+                self.dc_info.clear_extents_cache()
         self.last_style = state[8]
 
     def get_max_sizes(self):
@@ -100,6 +144,8 @@ class BaseDc(object):
 
     def set_base_font_size(self, size):
         self.base_font_size = size
+        if self.dc_info:
+            self.dc_info.clear_extents_cache()
 
     def is_calc_only(self):
         return self.calc_only
@@ -133,21 +179,35 @@ class BaseDc(object):
     def get_dc_info(self):
         return self.dc_info
 
+    def _new_store(self):
+        if self.compact_store:
+            return DisplayList()
+        else:
+            return []
+
     def record(self, name, args=None):
         if self.rec:
-            self.store.append((name, args))
+            try:
+                self.store.append((name, args))
+            except TypeError:
+                # value which DisplayList can't store, page is kept as list of records
+                self.store = list(self.store)
+                self.store.append((name, args))
 
     def play(self, page=-1):
         rec = self.rec
         self.rec = False
         if page >= 0:
             self.store = self.pages[page]
-        for pos in self.store:
-            fun = getattr(self, pos[0])
-            if pos[1]:
-                fun(*pos[1])
-            else:
-                fun()
+        if isinstance(self.store, DisplayList):
+            self.store.play(self)
+        else:
+            for pos in self.store:
+                fun = getattr(self, pos[0])
+                if pos[1]:
+                    fun(*pos[1])
+                else:
+                    fun()
         self.rec = rec
 
     def play_str(self, str):
@@ -161,24 +221,36 @@ class BaseDc(object):
                 else:
                     fun()
 
-    def save(self, zip_name):
+    def save(self, zip_name, binary=False, compression=zipfile.ZIP_DEFLATED):
+        """Save recorded pages to zip file
+
+        Args:
+            zip_name - file name or file like object
+            binary - if True pages are saved as binary display lists (page_N.dl),
+            else as json lines (page_N)
+            compression - compression of page members, binary pages saved with
+            zipfile.ZIP_STORED can be loaded without copying data.
+        """
         zf = zipfile.ZipFile(zip_name, mode="w", compression=zipfile.ZIP_DEFLATED)
         zf.writestr("set.dat", json.dumps(self.state()))
         i = 1
         for page in self.pages:
-            buf = io.BytesIO()
-            for rec in page:
-                try:
-                    buf.write(json.dumps(rec))
-                except:
-                    print("basedc:", rec.__class__, rec)
-                buf.write(b"\n")
-            zf.writestr("page_%d" % i, buf.getvalue())
+            write_page(zf, i, page, binary, compression)
             i += 1
         zf.close()
 
     def load(self, zip_name):
+        """Load pages saved by save function.
+
+        Args:
+            zip_name - file name or file like object. If it is io.BytesIO object and pages
+            are not compressed, display lists use stream buffer directly.
+        """
         zf = zipfile.ZipFile(zip_name, mode="r")
+        if hasattr(zip_name, "getbuffer"):
+            stream = zip_name
+        else:
+            stream = None
         parm = json.loads(zf.read("set.dat").decode("utf-8"))
         count = parm[0]
         self.pages = []
@@ -190,13 +262,19 @@ class BaseDc(object):
         self._maxheight = parm[6]
         if self.dc_info:
             self.dc_info.styles = parm[7]
+            self.dc_info.clear_extents_cache()
+        names = set(zf.namelist())
         for i in range(1, count + 1):
-            rec = []
-            data = zf.read("page_%d" % i).decode("utf-8")
-            for line in data.split("\n"):
-                if len(line) > 1:
-                    buf = json.loads(line)
-                    rec.append(buf)
+            name = "page_%d.dl" % i
+            if name in names:
+                rec = DisplayList.from_bytes(zip_member_data(zf, name, stream))
+            else:
+                rec = []
+                data = zf.read("page_%d" % i).decode("utf-8")
+                for line in data.split("\n"):
+                    if len(line) > 1:
+                        buf = json.loads(line)
+                        rec.append(buf)
             self.pages.append(rec)
             self.rec = rec
         zf.close()
@@ -241,13 +319,13 @@ class BaseDc(object):
     def start_page(self):
         if len(self.store) > 0:
             self.pages.append(self.store)
-            self.store = []
+            self.store = self._new_store()
         self.last_style = "None"
 
     def end_page(self):
         if len(self.store) > 0:
             self.pages.append(self.store)
-            self.store = []
+            self.store = self._new_store()
         self.last_style = "None"
 
     def fill(self, *args):
@@ -336,9 +414,26 @@ class BaseDc(object):
 
 
 class BaseDcInfo(object):
-    def __init__(self, dc):
+    def __init__(self, dc, extents_cache_size=EXTENTS_CACHE_SIZE):
         self.dc = dc
         self.styles = []
+        self.extents_cache_size = extents_cache_size
+        self.extents_cache_hits = 0
+        self.extents_cache_misses = 0
+        self._extents_cache = {}
+        self._style_index = {}
+        self._styles_ref = None
+
+    def clear_extents_cache(self):
+        """Forget all measured words, must be called when fonts or styles are changed"""
+        self._extents_cache = {}
+
+    def get_extents_cache_stats(self):
+        """return: hits, misses, number of cached words"""
+        size = 0
+        for pos in self._extents_cache.values():
+            size += len(pos)
+        return (self.extents_cache_hits, self.extents_cache_misses, size)
 
     def get_text_width(self, txt, style):
         return 12 * len(txt)
@@ -386,21 +481,55 @@ class BaseDcInfo(object):
             dy += self.get_text_height(line_ok, style)
         return (dy, lines)
 
-    def get_extents(self, word, style):
+    def get_extents(self, word, style=None):
+        """Return (dx, dx_space, dy_up, dy_down) for word drawn with style.
+
+        Results are kept in a bounded LRU cache for every style. If style is None
+        current style of device context is used and result is not cached.
+        """
+        if style is None or self.extents_cache_size <= 0:
+            return self._get_extents(word, style)
+        cache = self._extents_cache.get(style)
+        if cache is None:
+            cache = self._extents_cache[style] = OrderedDict()
+        else:
+            extents = cache.get(word)
+            if extents is not None:
+                self.extents_cache_hits += 1
+                cache.move_to_end(word)
+                return extents
+        self.extents_cache_misses += 1
+        extents = self._get_extents(word, style)
+        cache[word] = extents
+        if len(cache) > self.extents_cache_size:
+            cache.popitem(last=False)
+        return extents
+
+    def _get_extents(self, word, style):
         dx = self.get_text_width(word, style)
-        dx_space = self.get_text_width(" ", style)
-        dy = self.get_test_height(word, style)
+        if word and word[-1] == " ":
+            dx_space = self.get_text_width(" ", style)
+        else:
+            dx_space = 0
+        dy = self.get_text_height(word, style)
         dy_up = dy / 2
         dy_down = dy - dy_up
         return (dx, dx_space, dy_up, dy_down)
 
     def get_style_id(self, style):
-        i = 0
-        for pos in self.styles:
-            if style == pos:
-                return i
-            i += 1
-        self.styles.append(style)
+        if self._styles_ref is not self.styles or len(self._style_index) != len(
+            self.styles
+        ):
+            self._style_index = {}
+            for i, pos in enumerate(self.styles):
+                if not pos in self._style_index:
+                    self._style_index[pos] = i
+            self._styles_ref = self.styles
+        i = self._style_index.get(style)
+        if i is None:
+            i = len(self.styles)
+            self.styles.append(style)
+            self._style_index[style] = i
         return i
 
 
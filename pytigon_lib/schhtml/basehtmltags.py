@@ -112,6 +112,7 @@ class BaseHtmlElemParser(object):
         self.hover_css_attrs = {}
         self.gparent = self
         self.form_obj = None
+        self.dirty = False
 
     def __str__(self):
         return self.tag + ":" + str(self.attrs)
@@ -300,6 +301,40 @@ class BaseHtmlElemParser(object):
         if self.last_rendered_dc:
             self.render(self.last_rendered_dc)
 
+    def invalidate_layout(self):
+        """Forget calculated sizes, they are calculated again during next render"""
+        if not "height" in self.attrs:
+            self.height = -1
+
+    def mark_dirty(self):
+        """Mark element and its ancestors as changed"""
+        obj = self
+        while obj and not obj.dirty:
+            obj.dirty = True
+            obj.invalidate_layout()
+            obj = obj.parent
+
+    def clear_dirty(self):
+        obj = self
+        while obj and obj.dirty:
+            obj.dirty = False
+            obj = obj.parent
+
+    def patch(self, data=None, attrs=None):
+        """Change element in place
+
+        Args:
+            data - new text content of element, None - content is not changed
+            attrs - dict with attributes to change
+        """
+        if attrs:
+            self.attrs.update(attrs)
+            if "class" in attrs or "id" in attrs:
+                self.parser.css.invalidate_signatures()
+        if data is not None:
+            self.data = [data]
+        self.mark_dirty()
+
     def reg_id(self, dc):
         if self.reg_flag and "id" in self.attrs:
             self.parser.reg_id_obj(self.attrs["id"], dc, self)
@@ -434,7 +469,13 @@ class BaseHtmlAtomParser(BaseHtmlElemParser):
 
     def make_atom_list(self):
         if not self.atom_list:
-            self.atom_list = AtomList(self.dc_info, self.atom_dy, pre=self.pre)
+            if "text-wrap" in self.attrs and self.attrs["text-wrap"].strip() == "pretty":
+                line_break = "optimal"
+            else:
+                line_break = None
+            self.atom_list = AtomList(
+                self.dc_info, self.atom_dy, pre=self.pre, line_break=line_break
+            )
 
     def handle_data(self, data):
         if not self.pre:
@@ -458,6 +499,36 @@ class BaseHtmlAtomParser(BaseHtmlElemParser):
         for pos in atom_list.atom_list:
             self.atom_list.append_atom(pos)
 
+    def invalidate_layout(self):
+        BaseHtmlElemParser.invalidate_layout(self)
+        if self.atom_list:
+            self.atom_list.invalidate()
+
+    def patch(self, data=None, attrs=None):
+        if attrs:
+            self.attrs.update(attrs)
+            if "class" in attrs or "id" in attrs:
+                self.parser.css.invalidate_signatures()
+        if data is not None:
+            self.atom_list = None
+            self.data = []
+            self.style = -1
+            self.handle_data(data)
+        elif attrs and self.atom_list and self.style >= 0:
+            old_style = self.style
+            self.style = self.get_style_id()
+            if self.style != old_style:
+                for atom in self.atom_list.atom_list:
+                    if atom.is_txt and atom.style == old_style:
+                        atom.style = self.style
+                        (
+                            atom.dx,
+                            atom.dx_space,
+                            atom.dy_up,
+                            atom.dy_down,
+                        ) = self.dc_info.get_extents(atom.data, self.style)
+        self.mark_dirty()
+
     def set_atom_dy(self, dy):
         self.atom_dy = dy
         if self.atom_list:
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Pytigon - wxpython and django application framework
+
+# author: "Slawomir Cholaj (slawomir.cholaj@gmail.com)"
+# copyright: "Copyright (C) ????/2012 Slawomir Cholaj"
+# license: "LGPL 3.0"
+# version: "0.1a"
+
+"""Batch rendering of many independent html documents in a pool of processes.
+
+Example:
+    for result in render_batch(html_list, processes=4):
+        if result.error:
+            print(result.index, result.error)
+        else:
+            save(result.index, result.data)
+"""
+
+import os
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+WARM_UP_HTML = "<html><body><p>warm <b>up</b> <i>fonts</i></p><table><tr><td>1</td></tr></table></body></html>"
+
+
+class BatchResult:
+    """Result of rendering of one document
+
+    Attributes:
+        index - position of document in input sequence
+        data - rendered document (bytes) or None if error occurred
+        error - None or traceback of exception raised during rendering
+        time - rendering time in seconds (measured in worker process)
+    """
+
+    def __init__(self, index, data, error, time):
+        self.index = index
+        self.data = data
+        self.error = error
+        self.time = time
+
+    def __repr__(self):
+        return "BatchResult(%d, %s, %.3fs)" % (
+            self.index,
+            "error" if self.error else "%d bytes" % len(self.data),
+            self.time,
+        )
+
+
+_WORKER_PARAMS = {}
+
+
+def _init_worker(params):
+    global _WORKER_PARAMS
+    _WORKER_PARAMS = params
+    try:
+        from pytigon_lib.schhtml.htmlviewer import stream_from_html
+
+        stream_from_html(
+            WARM_UP_HTML,
+            stream_type=params["stream_type"],
+            width=params["width"],
+            height=params["height"],
+        )
+    except:
+        traceback.print_exc()
+
+
+def _render_document(index, html):
+    from pytigon_lib.schhtml.htmlviewer import stream_from_html
+
+    params = _WORKER_PARAMS
+    start = time.perf_counter()
+    try:
+        stream = stream_from_html(
+            html,
+            stream_type=params["stream_type"],
+            width=params["width"],
+            height=params["height"],
+            base_url=params["base_url"],
+        )
+        return (index, stream.getvalue(), None, time.perf_counter() - start)
+    except:
+        return (index, None, traceback.format_exc(), time.perf_counter() - start)
+
+
+def _get_result(index, future):
+    """Return BatchResult of future, errors of pool (for example worker process killed)
+    are returned as error of document"""
+    try:
+        return BatchResult(*future.result())
+    except:
+        return BatchResult(index, None, traceback.format_exc(), 0.0)
+
+
+def render_batch(
+    documents,
+    processes=None,
+    stream_type="pdf",
+    width=int(210 * 72 / 25.4),
+    height=int(297 * 72 / 25.4),
+    base_url=None,
+    max_pending=None,
+):
+    """Render documents in pool of processes
+
+    Every worker imports tag maps and loads fonts once, at start. Results are yielded in
+    the same order as documents, as soon as the next one in order is ready.
+
+    Args:
+        documents - iterable of html strings
+        processes - number of worker processes, default: os.cpu_count()
+        stream_type - 'pdf' or 'zip', see stream_from_html
+        width, height - page size
+        base_url - base url for resources
+        max_pending - maximum number of documents sent to workers and not yet yielded,
+        default: 4 * processes. Limits memory used by results waiting for earlier
+        documents.
+
+    Returns:
+        generator of BatchResult objects
+    """
+    if not processes:
+        processes = os.cpu_count() or 1
+    if not max_pending:
+        max_pending = 4 * processes
+    params = {
+        "stream_type": stream_type,
+        "width": width,
+        "height": height,
+        "base_url": base_url,
+    }
+    pending = deque()
+    executor = ProcessPoolExecutor(
+        max_workers=processes, initializer=_init_worker, initargs=(params,)
+    )
+    try:
+        for index, html in enumerate(documents):
+            try:
+                future = executor.submit(_render_document, index, html)
+            except Exception as exception:
+                # pool is broken, error is returned in result of document
+                future = Future()
+                future.set_exception(exception)
+            pending.append((index, future))
+            if len(pending) >= max_pending:
+                yield _get_result(*pending.popleft())
+        while pending:
+            yield _get_result(*pending.popleft())
+    finally:
+        # generator can be closed before all results are read
+        for index, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
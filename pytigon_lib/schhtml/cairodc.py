@@ -301,7 +301,7 @@ class CairoDcInfo(BaseDcInfo):
     def get_line_dy(self, height):
         return height * 12
 
-    def get_extents(self, word, style):
+    def _get_extents(self, word, style):
         self.dc.set_style(style)
         sizes = self.dc.ctx.text_extents(word + ".")[:4]
         dx = sizes[2]
@@ -19,6 +19,9 @@
 
 from .htmltools import superstrip
 import re
+from collections import OrderedDict
+
+CSS_CACHE_SIZE = 16384
 
 
 def comment_remover(text):
@@ -107,6 +110,13 @@ class Css(object):
         self.csspos_dict = {}
         self._act_dict = {}
         self._act_keys = []
+        self._root = CssPos([""], {})
+        self._root.parents = self.csspos_dict
+        self._cache = OrderedDict()
+        # signatures cached on elements are valid only for current version
+        self._signature_version = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
 
     def _append_keys(self):
         if len(self._act_keys) > 0:
@@ -119,6 +129,7 @@ class Css(object):
                     self.csspos_dict[y.key()] = y
         self._act_keys = []
         self._act_dict = {}
+        self._cache = OrderedDict()
 
     def parse_indent_str(self, s):
         for l in s.splitlines():
@@ -182,12 +193,44 @@ class Css(object):
             self._hadle_section(pos)
 
     def test_print(self):
-        tmp = CssPos([""], {})
-        tmp.parents = self.csspos_dict
-        tmp.test_print(0)
+        self._root.test_print(0)
+
+    def _signature(self, obj):
+        """Tuple (tag, class, id, signature of parent) - css attributes depend only on it"""
+        if obj == None:
+            return None
+        parent = obj.get_parent()
+        if parent != None:
+            cached = getattr(parent, "_css_signature", None)
+            if cached is None or cached[0] != self._signature_version:
+                cached = parent._css_signature = (
+                    self._signature_version,
+                    self._signature(parent),
+                )
+            parent_signature = cached[1]
+        else:
+            parent_signature = None
+        return (obj.get_tag(), obj.get_cls(), obj.get_id(), parent_signature)
+
+    def invalidate_signatures(self):
+        """Signatures cached on elements are not used any more, must be called after
+        change of class or id of element"""
+        self._signature_version += 1
 
     def get_dict(self, obj):
-        tmp = CssPos([""], {})
-        tmp.parents = self.csspos_dict
-        ret = tmp.get_dict(obj)
+        """Return css attributes for obj.
+
+        Result is computed once for every distinct signature of element (tag, class, id
+        and signature of parent), returned dict must not be modified.
+        """
+        key = self._signature(obj)
+        ret = self._cache.get(key)
+        if ret is None:
+            self.cache_misses += 1
+            ret = self._cache[key] = self._root.get_dict(obj)
+            if len(self._cache) > CSS_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+            self.cache_hits += 1
         return ret
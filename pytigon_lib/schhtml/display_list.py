@@ -0,0 +1,333 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Pytigon - wxpython and django application framework
+
+# author: "Slawomir Cholaj (slawomir.cholaj@gmail.com)"
+# copyright: "Copyright (C) ????/2012 Slawomir Cholaj"
+# license: "LGPL 3.0"
+# version: "0.1a"
+
+"""Compact, binary display list used by BaseDc.record/play.
+
+Every recorded call is stored as: opcode (1 byte), argument count (1 byte) and
+typed arguments. Strings and binary data (images) are interned in per page
+tables, so repeated words and styles are stored once.
+
+Page format:
+    magic (4 bytes), number of strings, number of blobs, length of operations
+    strings: length + utf-8 data
+    blobs: length + data
+    operations
+"""
+
+import struct
+import zipfile
+
+MAGIC = b"PDL1"
+
+OPCODES = (
+    "fill",
+    "draw",
+    "set_color",
+    "set_line_width",
+    "set_style",
+    "add_line",
+    "add_rectangle",
+    "add_rounded_rectangle",
+    "add_arc",
+    "add_ellipse",
+    "add_polygon",
+    "add_spline",
+    "draw_text",
+    "draw_rotated_text",
+    "draw_image",
+)
+
+OPCODE_MAP = dict((name, i) for i, name in enumerate(OPCODES))
+
+OP_EXT = 255
+
+T_NONE = 0
+T_FALSE = 1
+T_TRUE = 2
+T_INT = 3
+T_LONG = 4
+T_FLOAT = 5
+T_STR = 6
+T_BYTES = 7
+T_LIST = 8
+
+_HEADER = struct.Struct("<4sIII")
+_OP = struct.Struct("<BB")
+_UINT = struct.Struct("<I")
+_INT = struct.Struct("<i")
+_LONG = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+_USHORT = struct.Struct("<H")
+
+_ZIP_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+
+
+class DisplayList(object):
+    """List of (name, args) records kept in compact, binary form"""
+
+    def __init__(self):
+        self.ops = bytearray()
+        self.strings = []
+        self.blobs = []
+        self._string_map = {}
+        self._blob_map = {}
+        self._count = 0
+        self._data = None
+
+    def __len__(self):
+        self._unpack()
+        if self._count is None:
+            self._count = _count_ops(self.ops)
+        return self._count
+
+    def __iter__(self):
+        self._unpack()
+        strings = self.strings
+        blobs = self.blobs
+        ops = self.ops
+        end = len(ops)
+        pos = 0
+        while pos < end:
+            opcode, argc = _OP.unpack_from(ops, pos)
+            pos += 2
+            if opcode == OP_EXT:
+                name = strings[_UINT.unpack_from(ops, pos)[0]]
+                pos += 4
+            else:
+                name = OPCODES[opcode]
+            if argc:
+                args = []
+                for i in range(argc):
+                    value, pos = _read_value(ops, pos, strings, blobs)
+                    args.append(value)
+            else:
+                args = None
+            yield (name, args)
+
+    def _intern_str(self, s):
+        id = self._string_map.get(s)
+        if id is None:
+            id = len(self.strings)
+            self.strings.append(s)
+            self._string_map[s] = id
+        return id
+
+    def _intern_bytes(self, b):
+        id = self._blob_map.get(b)
+        if id is None:
+            id = len(self.blobs)
+            self.blobs.append(b)
+            self._blob_map[b] = id
+        return id
+
+    def _write_value(self, buf, value):
+        if value is None:
+            buf.append(T_NONE)
+        elif value is True:
+            buf.append(T_TRUE)
+        elif value is False:
+            buf.append(T_FALSE)
+        elif isinstance(value, int):
+            if -0x80000000 <= value <= 0x7FFFFFFF:
+                buf.append(T_INT)
+                buf += _INT.pack(value)
+            else:
+                buf.append(T_LONG)
+                buf += _LONG.pack(value)
+        elif isinstance(value, float):
+            buf.append(T_FLOAT)
+            buf += _FLOAT.pack(value)
+        elif isinstance(value, str):
+            buf.append(T_STR)
+            buf += _UINT.pack(self._intern_str(value))
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            buf.append(T_BYTES)
+            buf += _UINT.pack(self._intern_bytes(bytes(value)))
+        elif isinstance(value, (list, tuple)):
+            buf.append(T_LIST)
+            buf += _USHORT.pack(len(value))
+            for item in value:
+                self._write_value(buf, item)
+        else:
+            raise TypeError("Unsupported display list value: %s" % type(value))
+
+    def append(self, rec):
+        """Append record (name, args), TypeError is raised if args contain values of
+        types which can't be stored in display list"""
+        self._unpack()
+        if not isinstance(self.ops, bytearray):
+            len(self)
+            self.ops = bytearray(self.ops)
+        name, args = rec
+        buf = bytearray()
+        opcode = OPCODE_MAP.get(name, OP_EXT)
+        argc = len(args) if args else 0
+        buf += _OP.pack(opcode, argc)
+        if opcode == OP_EXT:
+            buf += _UINT.pack(self._intern_str(name))
+        if argc:
+            for arg in args:
+                self._write_value(buf, arg)
+        self.ops += buf
+        if self._count is not None:
+            self._count += 1
+
+    def play(self, dc):
+        funs = {}
+        for name, args in self:
+            fun = funs.get(name)
+            if fun is None:
+                fun = funs[name] = getattr(dc, name)
+            if args:
+                fun(*args)
+            else:
+                fun()
+
+    def to_bytes(self):
+        self._unpack()
+        buf = bytearray(
+            _HEADER.pack(MAGIC, len(self.strings), len(self.blobs), len(self.ops))
+        )
+        for s in self.strings:
+            b = s.encode("utf-8")
+            buf += _UINT.pack(len(b))
+            buf += b
+        for b in self.blobs:
+            buf += _UINT.pack(len(b))
+            buf += b
+        buf += self.ops
+        return bytes(buf)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Create display list from data returned by to_bytes.
+
+        Data is not copied: operations are read directly from passed buffer, which is
+        decoded when the list is used for the first time.
+        """
+        ret = cls()
+        ret._data = memoryview(data)
+        return ret
+
+    def _unpack(self):
+        if self._data is None:
+            return
+        data = self._data
+        self._data = None
+        magic, n_strings, n_blobs, ops_len = _HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("Invalid display list data")
+        pos = _HEADER.size
+        for i in range(n_strings):
+            l = _UINT.unpack_from(data, pos)[0]
+            pos += 4
+            s = str(data[pos : pos + l], "utf-8")
+            self._string_map[s] = len(self.strings)
+            self.strings.append(s)
+            pos += l
+        for i in range(n_blobs):
+            l = _UINT.unpack_from(data, pos)[0]
+            pos += 4
+            self.blobs.append(data[pos : pos + l])
+            pos += l
+        self.ops = data[pos : pos + ops_len]
+        self._count = None
+
+
+def _count_ops(ops):
+    count = 0
+    end = len(ops)
+    pos = 0
+    while pos < end:
+        opcode, argc = _OP.unpack_from(ops, pos)
+        pos += 2
+        if opcode == OP_EXT:
+            pos += 4
+        for i in range(argc):
+            pos = _skip_value(ops, pos)
+        count += 1
+    return count
+
+
+def _read_value(ops, pos, strings, blobs):
+    t = ops[pos]
+    pos += 1
+    if t == T_INT:
+        return _INT.unpack_from(ops, pos)[0], pos + 4
+    elif t == T_FLOAT:
+        return _FLOAT.unpack_from(ops, pos)[0], pos + 8
+    elif t == T_STR:
+        return strings[_UINT.unpack_from(ops, pos)[0]], pos + 4
+    elif t == T_NONE:
+        return None, pos
+    elif t == T_TRUE:
+        return True, pos
+    elif t == T_FALSE:
+        return False, pos
+    elif t == T_LONG:
+        return _LONG.unpack_from(ops, pos)[0], pos + 8
+    elif t == T_BYTES:
+        return bytes(blobs[_UINT.unpack_from(ops, pos)[0]]), pos + 4
+    elif t == T_LIST:
+        count = _USHORT.unpack_from(ops, pos)[0]
+        pos += 2
+        ret = []
+        for i in range(count):
+            value, pos = _read_value(ops, pos, strings, blobs)
+            ret.append(value)
+        return ret, pos
+    raise ValueError("Invalid display list value type: %d" % t)
+
+
+def _skip_value(ops, pos):
+    t = ops[pos]
+    pos += 1
+    if t in (T_INT, T_STR, T_BYTES):
+        return pos + 4
+    elif t in (T_FLOAT, T_LONG):
+        return pos + 8
+    elif t == T_LIST:
+        count = _USHORT.unpack_from(ops, pos)[0]
+        pos += 2
+        for i in range(count):
+            pos = _skip_value(ops, pos)
+        return pos
+    return pos
+
+
+def zip_member_data(zf, name, stream=None):
+    """Return content of zip member.
+
+    If member is not compressed and stream is in memory (io.BytesIO) memoryview
+    of stream buffer is returned instead of copy of data.
+    """
+    info = zf.getinfo(name)
+    if (
+        stream is not None
+        and info.compress_type == zipfile.ZIP_STORED
+        and hasattr(stream, "getbuffer")
+    ):
+        buf = stream.getbuffer()
+        header = _ZIP_LOCAL_HEADER.unpack_from(buf, info.header_offset)
+        if header[0] == b"PK\003\004":
+            start = (
+                info.header_offset + _ZIP_LOCAL_HEADER.size + header[10] + header[11]
+            )
+            return buf[start : start + info.file_size]
+    return zf.read(name)
@@ -23,11 +23,13 @@ import sys
 import traceback
 import os
 import io
+import json
+import zipfile
 from tempfile import NamedTemporaryFile
 
 from pytigon_lib.schhtml.htmltools import HtmlModParser
 from pytigon_lib.schhtml.html_tags import HtmlTag
-from pytigon_lib.schhtml.basedc import NullDc, BaseDc
+from pytigon_lib.schhtml.basedc import NullDc, BaseDc, write_page
 from pytigon_lib.schhtml.css import Css
 
 from pytigon_lib.schhtml.basehtmltags import get_tag_preprocess_map
@@ -126,6 +128,8 @@ class HtmlViewerParser(HtmlModParser):
         self.lp = 1
         self.table_lp = 0
         self.http = None
+        self.prefetch = True
+        self.resources = {}
         self.tdata_tab = []
         self.debug = False
 
@@ -182,6 +186,67 @@ class HtmlViewerParser(HtmlModParser):
             self.http = HttpClient(self.base_url)
         return self.http
 
+    def init(self, html_txt):
+        HtmlModParser.init(self, html_txt)
+        if self.prefetch and self._tree is not None:
+            self.prefetch_resources(self._tree)
+
+    def feed(self, html_txt):
+        try:
+            HtmlModParser.feed(self, html_txt)
+        finally:
+            self.resources = {}
+
+    def iter_feed(self, html_txt):
+        try:
+            yield from HtmlModParser.iter_feed(self, html_txt)
+        finally:
+            self.resources = {}
+
+    def prefetch_resources(self, tree):
+        """Download images and css files (<link rel="stylesheet">) referenced in tree
+        concurrently, before tags are processed. Tag handlers get them by get_resource,
+        they are released at the end of feed.
+
+        Args:
+            tree - root of parsed html
+        """
+        addresses = []
+        for elem in tree.iter():
+            if type(elem.tag) is not str:
+                continue
+            tag = elem.tag.lower()
+            if tag == "img":
+                address = elem.get("src")
+            elif tag == "link":
+                if not "stylesheet" in elem.get("rel", "").lower().split():
+                    continue
+                address = elem.get("href")
+            else:
+                continue
+            if (
+                address
+                and not address.startswith("data:")
+                and address not in self.resources
+                and address not in addresses
+            ):
+                addresses.append(address)
+        http = self.get_http_object()
+        if len(addresses) > 1 and hasattr(http, "get_many"):
+            self.resources.update(http.get_many(self.get_parent_window(), addresses))
+
+    def get_resource(self, parent, address):
+        """Return response with resource, prefetched or retrieved now
+
+        Args:
+            parent - tag object which needs resource
+            address - address of resource
+        """
+        response = self.resources.get(address)
+        if response is None:
+            response = self.get_http_object().get(parent, address)
+        return response
+
     def set_max_rendered_size(self, width, height):
         """Set maximum rendered size
 
@@ -221,6 +286,72 @@ class HtmlViewerParser(HtmlModParser):
         obj.last_rendered_dc = dc
         obj.rendered_rects.append((dc.x, dc.y, dc.dx, dc.dy))
 
+    def patch_obj(self, id, data=None, attrs=None):
+        """Change data or attributes of element registered with id and render it again
+
+        Only changed element is laid out and drawn. If new content does not fit in
+        rectangle occupied by element, sizes of its ancestors would change and whole
+        page must be rendered again.
+
+        Args:
+            id - value of id attribute of element
+            data - new text content of element, None - content is not changed
+            attrs - dict with attributes to change
+
+        Returns:
+            list of rectangles (x, y, dx, dy) to repaint or None if whole page must be
+            rendered again.
+        """
+        obj = self.obj_id_dict.get(id)
+        if not obj:
+            return None
+        obj.patch(data, attrs)
+        return self.relayout(obj)
+
+    def _get_background_color(self, obj):
+        """Return color of background under element - the nearest background color
+        of element or its ancestors, default white"""
+        while obj:
+            for attr in ("background-color", "bgcolor", "background"):
+                if attr in obj.attrs:
+                    for pos in obj.attrs[attr].split(" "):
+                        if pos.startswith("#"):
+                            return pos
+            obj = obj.parent
+        return "#ffffff"
+
+    def relayout(self, obj):
+        """Lay out and draw changed (dirty) element in place
+
+        Old content of element is cleared with background of its ancestors before
+        drawing. Element which grows would move its siblings and ancestors, which were
+        already rendered (block and table rendering consume their children), so then
+        None is returned and the caller renders the page again.
+
+        Returns:
+            list of rectangles to repaint or None if whole page must be rendered again.
+        """
+        if not obj.last_rendered_dc or not obj.rendered_rects:
+            return None
+        rect = obj.rendered_rects[-1]
+        dy = obj.get_height()
+        if dy < 0 or dy > rect[3]:
+            return None
+        dc = obj.last_rendered_dc
+        if not dc.calc_only:
+            (r, g, b) = dc.rgbfromhex(self._get_background_color(obj.parent))
+            dc.set_color(r, g, b)
+            dc.add_rectangle(0, 0, dc.dx, dc.dy)
+            dc.fill()
+        reg_flag = obj.reg_flag
+        obj.reg_flag = False
+        try:
+            obj.render(dc)
+        finally:
+            obj.reg_flag = reg_flag
+        obj.clear_dirty()
+        return [rect]
+
     def handle_starttag(self, tag, attrs):
         return self._handle_starttag(tag, attrs)
 
@@ -326,6 +457,31 @@ class HtmlViewerParser(HtmlModParser):
                 print("|   " * tab, "/", obj.tag, "(", obj.height, ")")
 
 
+def _prepare_html(html, width, height):
+    if not type(html) == str:
+        html = html.decode("utf-8")
+    if "<html" in html:
+        html2 = html
+    else:
+        html2 = "<html><body>" + html + "</body></html>"
+
+    if "orientation:landscape" in html2 or "orientation: landscape" in html2:
+        return (html2, height, width)
+    else:
+        return (html2, width, height)
+
+
+def _new_dc(stream_type, width, height, output_name=None):
+    if stream_type == "pdf":
+        return PdfDc(
+            calc_only=False, width=width, height=height, output_name=output_name
+        )
+    else:
+        from pytigon_lib.schhtml.cairodc import CairoDc
+
+        return CairoDc(calc_only=False, width=width, height=height)
+
+
 def stream_from_html(
     html,
     output_stream=None,
@@ -335,6 +491,7 @@ def stream_from_html(
     stream_type="pdf",
     base_url=None,
     info=None,
+    binary=False,
 ):
     """Render html string
 
@@ -344,7 +501,9 @@ def stream_from_html(
         css - css string
         width - default value 210*72/25.4
         height - default value 297*72/25.4
-        stream_type - 'zip' or 'pdf', default pdf.
+        stream_type - 'zip' or 'pdf', default pdf
+        binary - format of pages in 'zip' stream: if False json lines, if True not
+        compressed binary display lists, which BaseDc.load reads without copying.
     """
 
     if RENDERING_LIB:
@@ -352,20 +511,8 @@ def stream_from_html(
             return RENDERING_LIB.render(
                 html, output_stream, css, width, height, stream_type, base_url, info
             )
-            
-    if not type(html) == str:
-        html = html.decode("utf-8")
-    if "<html" in html:
-        html2 = html
-    else:
-        html2 = "<html><body>" + html + "</body></html>"
 
-    if "orientation:landscape" in html2 or "orientation: landscape" in html2:
-        width2 = height
-        height2 = width
-    else:
-        width2 = width
-        height2 = height
+    (html2, width2, height2) = _prepare_html(html, width, height)
 
     if output_stream:
         result = output_stream
@@ -376,11 +523,9 @@ def stream_from_html(
         result_buf = NamedTemporaryFile(delete=False)
         pdf_name = result_buf.name
         result_buf.close()
-        dc = PdfDc(calc_only=False, width=width2, height=height2, output_name=pdf_name)
     else:
-        from pytigon_lib.schhtml.cairodc import CairoDc
-
-        dc = CairoDc(calc_only=False, width=width2, height=height2)
+        pdf_name = None
+    dc = _new_dc(stream_type, width2, height2, pdf_name)
 
     dc.set_paging(True)
     p = HtmlViewerParser(dc=dc, calc_only=False, base_url=base_url)
@@ -391,18 +536,130 @@ def stream_from_html(
             result.write(f.read())
         os.unlink(pdf_name)
     else:
-        with NamedTemporaryFile(delete=False) as f:
-            name = f.name
-
         dc.end_page()
-        dc.save(name)
+        if binary:
+            dc.save(result, binary=True, compression=zipfile.ZIP_STORED)
+        else:
+            dc.save(result)
+    return result
 
-        with open(name, "rb") as f:
-            buf = f.read()
-            result.write(buf)
 
-        os.unlink(name)
-    return result
+def iter_pages_from_html(
+    html,
+    width=int(210 * 72 / 25.4),
+    height=int(297 * 72 / 25.4),
+    stream_type="zip",
+    base_url=None,
+    dc=None,
+):
+    """Render html string page by page
+
+    Generator yields (page number, display list of page) as soon as the page is finished.
+    Yielded pages are released by device context, so memory used by display lists does
+    not grow with document size.
+
+    Args:
+        html - html string to be rendered
+        width - default value 210*72/25.4
+        height - default value 297*72/25.4
+        stream_type - 'zip' or 'pdf', type of device context used for rendering
+        base_url - base url for resources
+        dc - device context, if None new one is created for stream_type
+    """
+    (html2, width2, height2) = _prepare_html(html, width, height)
+    if not dc:
+        dc = _new_dc(stream_type, width2, height2)
+    dc.set_paging(True)
+    p = HtmlViewerParser(dc=dc, calc_only=False, base_url=base_url)
+    sent = 0
+    for elem in p.iter_feed(html2.replace("&nbsp;", "»")):
+        while sent < len(dc.pages):
+            page = dc.pages[sent]
+            dc.pages[sent] = None
+            sent += 1
+            yield (sent, page)
+    p.close()
+    dc.end_page()
+    while sent < len(dc.pages):
+        page = dc.pages[sent]
+        dc.pages[sent] = None
+        sent += 1
+        yield (sent, page)
+
+
+class _ChunkWriter:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        ret = b"".join(self.chunks)
+        self.chunks = []
+        return ret
+
+
+def iter_stream_from_html(
+    html,
+    width=int(210 * 72 / 25.4),
+    height=int(297 * 72 / 25.4),
+    stream_type="zip",
+    base_url=None,
+    chunk_size=64 * 1024,
+    binary=False,
+):
+    """Render html string to stream of bytes, can be used with StreamingHttpResponse
+
+    For 'zip' stream every page is sent as soon as it is rendered (see
+    iter_pages_from_html), set.dat is written after last page. fpdf can not write
+    document before it is finished, so for 'pdf' whole document is rendered first
+    and then sent in chunk_size blocks.
+
+    Args:
+        html - html string to be rendered
+        width - default value 210*72/25.4
+        height - default value 297*72/25.4
+        stream_type - 'zip' or 'pdf'
+        base_url - base url for resources
+        chunk_size - size of chunks for pdf stream
+        binary - format of pages in 'zip' stream, see stream_from_html
+    """
+    if stream_type == "pdf":
+        (html2, width2, height2) = _prepare_html(html, width, height)
+        result_buf = NamedTemporaryFile(delete=False)
+        pdf_name = result_buf.name
+        result_buf.close()
+        dc = _new_dc(stream_type, width2, height2, pdf_name)
+        try:
+            for page in iter_pages_from_html(html, base_url=base_url, dc=dc):
+                pass
+            with open(pdf_name, "rb") as f:
+                while True:
+                    buf = f.read(chunk_size)
+                    if not buf:
+                        break
+                    yield buf
+        finally:
+            os.unlink(pdf_name)
+    else:
+        (html2, width2, height2) = _prepare_html(html, width, height)
+        dc = _new_dc(stream_type, width2, height2)
+        output = _ChunkWriter()
+        zf = zipfile.ZipFile(output, mode="w", compression=zipfile.ZIP_DEFLATED)
+        for nr, page in iter_pages_from_html(html, base_url=base_url, dc=dc):
+            if binary:
+                write_page(zf, nr, page, True, zipfile.ZIP_STORED)
+            else:
+                write_page(zf, nr, page)
+            yield output.pop()
+        zf.writestr("set.dat", json.dumps(dc.state()))
+        zf.close()
+        yield output.pop()
 
 
 def tdata_from_html(html, http):
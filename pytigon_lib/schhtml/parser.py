@@ -69,6 +69,19 @@ class Parser:
         if tree.tail:
             self.handle_data(tree.tail)
 
+    def _iter_crawl_tree(self, tree):
+        self._cur_elem = tree
+        if type(tree.tag) is str:
+            self.handle_starttag(tree.tag.lower(), tree.attrib)
+            if tree.text:
+                self.handle_data(tree.text)
+            for node in tree:
+                yield from self._iter_crawl_tree(node)
+            self.handle_endtag(tree.tag)
+            yield tree
+        if tree.tail:
+            self.handle_data(tree.tail)
+
     def crawl_tree(self, tree):
         self._tree = tree
         self._crawl_tree(self._tree)
@@ -101,6 +114,12 @@ class Parser:
         self.init(html_txt)
         self._crawl_tree(self._tree)
 
+    def iter_feed(self, html_txt):
+        """Like feed, but yields every element after its end tag has been handled"""
+        self.init(html_txt)
+        if self._tree is not None:
+            yield from self._iter_crawl_tree(self._tree)
+
     def close(self):
         self._tree = None
 
@@ -205,12 +205,12 @@ class PdfDc(BaseDc):
         style_tab = self.dc_info.styles[style].split(";")
         self.last_style_tab = style_tab
 
-        style = ""
+        font_style = ""
 
         if style_tab[3] == "1":
-            style += "I"
+            font_style += "I"
         if style_tab[4] == "1":
-            style += "B"
+            font_style += "B"
 
         if style_tab[1] in self.surf.fonts_map:
             font_name = self.surf.fonts_map[style_tab[1]]
@@ -218,7 +218,7 @@ class PdfDc(BaseDc):
             font_name = "sans-serif"
         self.dc.set_font(
             font_name,
-            style,
+            font_style,
             int((self.scale * self.base_font_size * int(style_tab[2])) / 100),
         )
         (r, g, b) = self.rgbfromhex(style_tab[0])
@@ -354,16 +354,16 @@ class PdfDcInfo(BaseDcInfo):
     def get_line_dy(self, height):
         return height
 
-    def get_extents(self, word, style=None):
+    def _get_extents(self, word, style=None):
         if style != None:
             self.dc.set_style(style)
 
-        w = self.dc.dc.get_string_width(word)
-        dx = w
+        dx = self.dc.dc.get_string_width(word)
         dy_up = self.dc.dc.font_size_pt
         dy_down = 0
-        dx_space = self.dc.dc.get_string_width(" ")
-        if not word or word[-1] != " ":
+        if word and word[-1] == " ":
+            dx_space = self.dc.dc.get_string_width(" ")
+        else:
             dx_space = 0
         return (dx, dx_space, dy_up, dy_down)
 
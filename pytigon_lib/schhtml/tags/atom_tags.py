@@ -126,9 +126,8 @@ class ImgTag(AtomTag):
         self.dx = 0
         self.dy = 0
         if self.src:
-            http = self.parser.get_http_object()
             try:
-                response = http.get(self, self.src)
+                response = self.parser.get_resource(self, self.src)
                 if response.ret_code == 404:
                     img = None
                 else:
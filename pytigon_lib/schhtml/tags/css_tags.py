@@ -36,11 +36,11 @@ class CssLink(BaseHtmlElemParser):
         BaseHtmlElemParser.__init__(self, parent, parser, tag, attrs)
 
     def close(self):
+        css_txt = None
         if "href" in self.attrs:
             href = self.attrs["href"]
-            http = self.parser.http
             try:
-                response = http.get(self, href)
+                response = self.parser.get_resource(self, href)
                 if response.ret_code == 404:
                     css_txt = None
                 else:
@@ -83,10 +83,9 @@ class ParBase(BaseHtmlAtomParser):
 
     def calc_height(self):
         if self.atom_list:
-            if not self.atom_list.list_for_draw:
-                self.atom_list.gen_list_for_draw(
-                    (self.width - self.extra_space[0]) - self.extra_space[1]
-                )
+            width = (self.width - self.extra_space[0]) - self.extra_space[1]
+            if not self.atom_list.list_for_draw or self.atom_list.width != width:
+                self.atom_list.gen_list_for_draw(width)
             y = self.atom_list.get_height()
         else:
             y = 0
@@ -141,10 +140,9 @@ class ParBase(BaseHtmlAtomParser):
                     valign = 2
                 else:
                     valign = 1
-            if not self.atom_list.list_for_draw:
-                self.atom_list.gen_list_for_draw(
-                    (self.width - self.extra_space[0]) - self.extra_space[1]
-                )
+            width = (self.width - self.extra_space[0]) - self.extra_space[1]
+            if not self.atom_list.list_for_draw or self.atom_list.width != width:
+                self.atom_list.gen_list_for_draw(width)
 
             dy = self.atom_list.draw_atom_list(dc2, align, valign)
         else:
@@ -336,10 +334,9 @@ class Div(Par):
         if not self.height > 0:
             self.height = self.get_height()
         else:
-            if not self.atom_list.list_for_draw:
-                self.atom_list.gen_list_for_draw(
-                    (self.width - self.extra_space[0]) - self.extra_space[1]
-                )
+            width = (self.width - self.extra_space[0]) - self.extra_space[1]
+            if not self.atom_list.list_for_draw or self.atom_list.width != width:
+                self.atom_list.gen_list_for_draw(width)
         atom = Atom(
             self,
             dx=self.width,
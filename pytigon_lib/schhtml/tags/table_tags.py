@@ -34,6 +34,12 @@ from collections import deque
 from .p_tags import Par
 from .block_tags import BodyTag
 
+# <table stream="n">: column widths are calculated from the first n rows. Later rows are
+# buffered until n of them are parsed, then the buffer is flushed: rows are rendered one by
+# one (BodyTag breaks pages between render calls) and released, so at most n rows are kept
+# in memory. Rows from <thead> are repeated on every page.
+STREAM_WINDOW = 200
+
 
 class TdRef(object):
     def __init__(self, tdref, parent, col, col_to_parent, row_to_parent, rowspan=0):
@@ -94,6 +100,13 @@ class TrRef(object):
         self.row = row
         self.height = -1
         self.attrs = attrs
+        self.header = False
+        self.has_rowspan = False
+        for td in row:
+            if td.__class__ != TdRef and td.rowspan > 1:
+                self.has_rowspan = True
+                break
+        self.rowspan_ok = False
 
     def __getitem__(self, id):
         return self.row[id]
@@ -140,6 +153,28 @@ class TableTag(BaseHtmlAtomParser):
         self.render_helpers = [RenderBackground(self)]
         self.atom = None
         self.lp = 0
+        self.in_thead = False
+        self.thead_rows = []
+        self.header_page = None
+        self.stream = 0
+        if "stream" in attrs and not self.subtab:
+            try:
+                self.stream = int(attrs["stream"])
+            except:
+                self.stream = STREAM_WINDOW
+            if self.stream <= 0:
+                self.stream = STREAM_WINDOW
+
+    def handle_starttag(self, parser, tag, attrs):
+        if tag in ("thead", "tbody", "tfoot"):
+            self.in_thead = tag == "thead"
+            return None
+        return BaseHtmlAtomParser.handle_starttag(self, parser, tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == "thead":
+            self.in_thead = False
+        return BaseHtmlAtomParser.handle_endtag(self, tag)
 
     def _get_pseudo_margins(self):
         return [
@@ -178,22 +213,32 @@ class TableTag(BaseHtmlAtomParser):
         if not self.sizes_ok:
             if not self.sizes:
                 self.sizes = [[-1, -1, -1]] * self.col_count
-            for i in range(0, self.col_count):
-                if self.sizes[i][0] < 0:
-                    (opt, min, max) = (0, 0, 0)
-                    for pos in self.tr_list:
-                        if pos[i].__class__ != TdRef and pos[i].colspan == 1:
-                            s = pos[i].get_width()
-                            if opt < s[0]:
-                                opt = s[0]
-                            if min < s[1]:
-                                min = s[1]
-                            if max < s[2]:
-                                max = s[2]
-                            self.sizes[i] = [opt, min, max]
-            for i in range(0, len(self.tr_list)):
+            cols = [i for i in range(0, self.col_count) if self.sizes[i][0] < 0]
+            if cols:
+                opt_tab = [0] * self.col_count
+                min_tab = [0] * self.col_count
+                max_tab = [0] * self.col_count
+                found = [False] * self.col_count
+                for tr in self.tr_list:
+                    row = tr.row
+                    for i in cols:
+                        pos = row[i]
+                        if pos.__class__ != TdRef and pos.colspan == 1:
+                            s = pos.get_width()
+                            if opt_tab[i] < s[0]:
+                                opt_tab[i] = s[0]
+                            if min_tab[i] < s[1]:
+                                min_tab[i] = s[1]
+                            if max_tab[i] < s[2]:
+                                max_tab[i] = s[2]
+                            found[i] = True
+                for i in cols:
+                    if found[i]:
+                        self.sizes[i] = [opt_tab[i], min_tab[i], max_tab[i]]
+            for tr in self.tr_list:
+                row = tr.row
                 for j in range(0, self.col_count):
-                    pos = self.tr_list[i][j]
+                    pos = row[j]
                     if pos.__class__ != TdRef and pos.colspan > 1:
                         s = pos.get_width()
                         s2 = [0, 0, 0]
@@ -286,6 +331,9 @@ class TableTag(BaseHtmlAtomParser):
         for row in self.tr_list[:size]:
             sy = self._row_height(row)
             y += sy
+        if self._repeat_header():
+            for row in self.thead_rows:
+                y += self._row_height(row)
         if self.start:
             y += self.border[2] + self.padding[2]
         if self.end:
@@ -323,7 +371,12 @@ class TableTag(BaseHtmlAtomParser):
                 row2.append(pos)
             else:
                 row2.append(TdEmptyTag())
-        self.tr_list.append(TrRef(row2, child.attrs))
+        tr = TrRef(row2, child.attrs)
+        if self.in_thead:
+            tr.header = True
+            if self.stream:
+                self.thead_rows.append(tr)
+        self.tr_list.append(tr)
         if rowspan > 1:
             delta = (rowspan - len(self.tr_queue)) - 1
             if delta > 0:
@@ -340,7 +393,12 @@ class TableTag(BaseHtmlAtomParser):
                         self.tr_queue[j][i] = TdRef(
                             tr[i], self, i, col_to_parent, j + 1, 0
                         )
-        if self.width >= 0 and len(self.tr_queue) == 0:
+        if self.stream:
+            # flush buffered rows, parent (BodyTag) renders them and doesn't keep the table
+            if len(self.tr_queue) == 0 and len(self.tr_list) >= self.stream:
+                self.calc_col_sizes()
+                self.parent.child_ready_to_render(self)
+        elif self.width >= 0 and len(self.tr_queue) == 0:
             if not self.sizes_ok and self.col_count > 0:
                 if not self.sizes:
                     self.sizes = [[-1, -1, -1]] * self.col_count
@@ -376,39 +434,49 @@ class TableTag(BaseHtmlAtomParser):
             return row.height
         else:
             dy = 0
+            sizes = self.sizes
+            tds = row.row
             for i in range(0, self.col_count):
-                if row[i].__class__ != TdRef and row[i].rowspan == 1:
-                    width = 0
-                    for j in range(0, row[i].colspan):
-                        width += self.sizes[i + j][0]
-                    row[i].set_width(width)
-                    sy = row[i].get_height()
+                td = tds[i]
+                if td.__class__ != TdRef and td.rowspan == 1:
+                    if td.colspan == 1:
+                        width = sizes[i][0]
+                    else:
+                        width = 0
+                        for j in range(0, td.colspan):
+                            width += sizes[i + j][0]
+                    td.set_width(width)
+                    sy = td.get_height()
                     if sy > dy:
                         dy = sy
             row.height = dy
             return dy
 
-    def _row_rowspan_height(self, rows):
-        dy = 0
+    def _row_rowspan_height(self, start):
+        rows = self.tr_list
+        first = rows[start]
         for i in range(0, self.col_count):
-            if rows[0][i].__class__ != TdRef and rows[0][i].rowspan > 1:
-                width = 0
-                for j in range(0, rows[0][i].colspan):
-                    width += self.sizes[i + j][0]
-                sy = rows[0][i].get_height()
+            td = first[i]
+            if td.__class__ != TdRef and td.rowspan > 1:
+                sy = td.get_height()
                 sy2 = 0
-                for j in range(0, rows[0][i].rowspan):
-                    sy2 += self._row_height(rows[j])
+                for j in range(0, td.rowspan):
+                    sy2 += self._row_height(rows[start + j])
                 if sy > sy2:
-                    delta = (sy - sy2) / rows[0][i].rowspan
-                    for j in range(0, rows[0][i].rowspan):
-                        rows[j].height = rows[j].height + delta
+                    delta = (sy - sy2) / td.rowspan
+                    for j in range(0, td.rowspan):
+                        rows[start + j].height = rows[start + j].height + delta
 
     def _calculate_rows_height(self):
         for row in self.tr_list:
-            self._row_height(row)
+            if row.height < 0:
+                self._row_height(row)
         for i in range(0, len(self.tr_list)):
-            self._row_rowspan_height(self.tr_list[i:])
+            row = self.tr_list[i]
+            if not row.rowspan_ok:
+                if row.has_rowspan:
+                    self._row_rowspan_height(i)
+                row.rowspan_ok = True
 
     def _iter(self):
         if self.subtab:
@@ -543,29 +611,13 @@ class TableTag(BaseHtmlAtomParser):
                 )
         size = self._iter()
         y = 0
-        for row_id in range(0, size):
-            row = self.tr_list[row_id]
-            x = 0
-            sy = self._row_height(row)
-            for col in range(0, self.col_count):
-                if row[col].__class__ != TdRef:
-                    if row[col].colspan > 1:
-                        dx = 0
-                        for i in range(0, row[col].colspan):
-                            dx += self.sizes[col + i][0]
-                    else:
-                        dx = self.sizes[col][0]
-                    if row[col].rowspan > 1:
-                        dy = sy
-                        for i in range(1, row[col].rowspan):
-                            dy += self._row_height(self.tr_list[row_id + i])
-                    else:
-                        dy = sy
-                    row[col].render(dc.subdc(x, y, dx, dy))
-                x += self.sizes[col][0]
-            y += sy
+        if self._repeat_header():
+            y = self._render_rows(dc, self.thead_rows, len(self.thead_rows), y)
+        y = self._render_rows(dc, self.tr_list, size, y)
+        if self.stream and size > 0:
+            self.header_page = self.parent.page
         if len(self.tr_list) > size:
-            self.tr_list = self.tr_list[size:]
+            del self.tr_list[:size]
             cont = True
         else:
             self.tr_list = []
@@ -586,6 +638,41 @@ class TableTag(BaseHtmlAtomParser):
         self.height = -1
         return (y, cont)
 
+    def _repeat_header(self):
+        return (
+            self.stream
+            and self.thead_rows
+            and not self.start
+            and self.header_page != None
+            and self.header_page != self.parent.page
+            and len(self.tr_list) > 0
+            and not self.tr_list[0].header
+        )
+
+    def _render_rows(self, dc, rows, size, y):
+        for row_id in range(0, size):
+            row = rows[row_id]
+            x = 0
+            sy = self._row_height(row)
+            for col in range(0, self.col_count):
+                if row[col].__class__ != TdRef:
+                    if row[col].colspan > 1:
+                        dx = 0
+                        for i in range(0, row[col].colspan):
+                            dx += self.sizes[col + i][0]
+                    else:
+                        dx = self.sizes[col][0]
+                    if row[col].rowspan > 1:
+                        dy = sy
+                        for i in range(1, row[col].rowspan):
+                            dy += self._row_height(rows[row_id + i])
+                    else:
+                        dy = sy
+                    row[col].render(dc.subdc(x, y, dx, dy))
+                x += self.sizes[col][0]
+            y += sy
+        return y
+
     def draw_atom(self, dc, style, x, y, dx, dy):
         if not self.sizes:
             return
@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Pytigon - wxpython and django application framework
+
+# author: "Slawomir Cholaj (slawomir.cholaj@gmail.com)"
+# copyright: "Copyright (C) ????/2012 Slawomir Cholaj"
+# license: "LGPL 3.0"
+# version: "0.1a"
+
+"""Memory benchmark of AtomList.
+
+Builds atom lists for a report with many table cells (one AtomList per cell, as
+TdTag does) and compares memory used by current, slotted Atom/AtomLine/AtomList
+with classes with per-instance dicts (copied below).
+
+usage: python atom_benchmark.py [cells] [words_per_cell]
+"""
+
+import sys
+import tracemalloc
+
+sys.path.append("./../../..")
+
+from pytigon_lib.schhtml.atom import AtomList
+
+
+class BenchDcInfo(object):
+    def get_extents(self, word, style):
+        dx = 6 * len(word)
+        if word.endswith(" "):
+            return (dx, 6, 10, 3)
+        return (dx, 0, 10, 3)
+
+    def get_line_dy(self, dy):
+        return dy
+
+
+# previous version of classes, with __dict__ in every instance
+
+
+class DictAtom(object):
+    def __init__(self, data, dx, dx_space, dy_up, dy_down, style=-1, is_txt=False):
+        self.data = data
+        self.dx = dx
+        self.dx_space = dx_space
+        self.dy_up = dy_up
+        self.dy_down = dy_down
+        self.style = style
+        self.parent = None
+        self.is_txt = is_txt
+
+
+class DictAtomLine(object):
+    def __init__(self, maxwidth):
+        self.maxwidth = maxwidth
+        self.dx = 0
+        self.space = 0
+        self.dy_up = 0
+        self.dy_down = 0
+        self.objs = []
+
+
+class DictAtomList(object):
+    def __init__(self, dc_info, line_dy=0, pre=False):
+        self.dc_info = dc_info
+        self.atom_list = []
+        self.line_dy = line_dy
+        self.list_for_draw = None
+        self.first_line_height = -1
+        self.width = -1
+        self.pre = pre
+
+
+def build_current(cells, words, dc_info):
+    ret = []
+    for i in range(cells):
+        atom_list = AtomList(dc_info)
+        atom_list.append_text(
+            " ".join("w%d_%d" % (i % 97, j) for j in range(words)), 0
+        )
+        atom_list.gen_list_for_draw(120)
+        ret.append(atom_list)
+    return ret
+
+
+def build_dict(cells, words, dc_info):
+    ret = []
+    for i in range(cells):
+        atom_list = DictAtomList(dc_info)
+        for j in range(words):
+            word = "w%d_%d " % (i % 97, j)
+            e = dc_info.get_extents(word, 0)
+            atom_list.atom_list.append(DictAtom(word, e[0], e[1], e[2], e[3], 0, True))
+        line = DictAtomLine(120)
+        lines = [line]
+        for atom in atom_list.atom_list:
+            if line.dx + atom.dx - atom.dx_space > 120:
+                line = DictAtomLine(120)
+                lines.append(line)
+            line.objs.append(atom)
+            line.dx += atom.dx
+        atom_list.list_for_draw = lines
+        ret.append(atom_list)
+    return ret
+
+
+def measure(fun, cells, words):
+    dc_info = BenchDcInfo()
+    tracemalloc.start()
+    data = fun(cells, words, dc_info)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+    return size
+
+
+def run(cells, words):
+    for name, fun in (("dict", build_dict), ("slots", build_current)):
+        size = measure(fun, cells, words)
+        print(
+            "%-6s %8.1f MB  %6.1f bytes/atom"
+            % (name, size / 1024.0 / 1024.0, size / (cells * words))
+        )
+
+
+if __name__ == "__main__":
+    cells = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    words = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    run(cells, words)
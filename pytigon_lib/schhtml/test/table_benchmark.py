@@ -0,0 +1,243 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Pytigon - wxpython and django application framework
+
+# author: "Slawomir Cholaj (slawomir.cholaj@gmail.com)"
+# copyright: "Copyright (C) ????/2012 Slawomir Cholaj"
+# license: "LGPL 3.0"
+# version: "0.1a"
+
+"""Benchmark of TableTag column width and row height calculation.
+
+Compares current TableTag.calc_col_sizes/_calculate_rows_height with the previous
+algorithm (copied below) on a table with synthetic cells and checks that both give
+the same column sizes and row heights.
+
+usage: python table_benchmark.py [rows] [cols]
+"""
+
+import sys
+import time
+
+sys.path.append("./../../..")
+
+from pytigon_lib.schhtml.tags.table_tags import TableTag, TrRef, TdRef
+
+
+class BenchTd(object):
+    def __init__(self, x, y, rowspan=1, colspan=1):
+        self.x = x
+        self.y = y
+        self.rowspan = rowspan
+        self.colspan = colspan
+        self.width = -1
+        self.data = ""
+
+    def get_width(self):
+        w = 20 + (self.x * 7 + self.y * 13) % 50
+        return [w, w // 2, w * 2]
+
+    def set_width(self, width):
+        self.width = width
+
+    def get_height(self):
+        return 10 + (self.x + self.y) % 5 + 200 // (self.width + 1)
+
+
+def make_table(rows, cols):
+    tab = TableTag.__new__(TableTag)
+    tab.col_count = cols
+    tab.sizes = None
+    tab.sizes_ok = False
+    tab.width = 100 * cols
+    tab._height = -1
+    tab.border = [0, 0, 0, 0]
+    tab.padding = [0, 0, 0, 0]
+    tab.tr_list = []
+    for y in range(rows):
+        row = []
+        x = 0
+        while x < cols:
+            if y % 100 == 0 and x + 1 < cols:
+                td = BenchTd(x, y, colspan=2)
+                row.append(td)
+                row.append(TdRef(td, tab, x + 1, 1, 0, 1))
+                x += 2
+            else:
+                row.append(BenchTd(x, y))
+                x += 1
+        tab.tr_list.append(TrRef(row, {}))
+    return tab
+
+
+# previous version of TableTag methods
+
+
+def legacy_calc_col_sizes(self):
+    if self.col_count <= 0:
+        return
+    if not self.sizes_ok:
+        if not self.sizes:
+            self.sizes = [[-1, -1, -1]] * self.col_count
+        for i in range(0, self.col_count):
+            if self.sizes[i][0] < 0:
+                (opt, min, max) = (0, 0, 0)
+                for pos in self.tr_list:
+                    if pos[i].__class__ != TdRef and pos[i].colspan == 1:
+                        s = pos[i].get_width()
+                        if opt < s[0]:
+                            opt = s[0]
+                        if min < s[1]:
+                            min = s[1]
+                        if max < s[2]:
+                            max = s[2]
+                        self.sizes[i] = [opt, min, max]
+        for i in range(0, len(self.tr_list)):
+            for j in range(0, self.col_count):
+                pos = self.tr_list[i][j]
+                if pos.__class__ != TdRef and pos.colspan > 1:
+                    s = pos.get_width()
+                    s2 = [0, 0, 0]
+                    for k in range(0, pos.colspan):
+                        s2[0] += self.sizes[j + k][0]
+                        s2[1] += self.sizes[j + k][1]
+                        s2[2] += self.sizes[j + k][2]
+                    delta = [0, 0, 0]
+                    for k in range(0, 3):
+                        if s[k] > s2[k]:
+                            delta[k] = (s[k] - s2[k]) / pos.colspan
+                    if delta[0] != 0 or delta[1] != 0 or delta[2] != 0:
+                        l = 1
+                        if delta[l] != 0:
+                            for k in range(0, pos.colspan):
+                                self.sizes[j + k][l] += delta[l]
+        (opt, min, max) = (0, 0, 0)
+        for pos in self.sizes:
+            opt += pos[0]
+            min += pos[1]
+            max += pos[2]
+        if self.width < 0:
+            if self.parent.width >= 0:
+                parent_width = self.get_parent_width()
+                if opt > parent_width or max > parent_width:
+                    self.width = parent_width
+                else:
+                    self.width = (
+                        opt
+                        + self.border[0]
+                        + self.border[1]
+                        + self.padding[0]
+                        + self.padding[1]
+                    )
+            else:
+                self.width = (
+                    opt
+                    + self.border[0]
+                    + self.border[1]
+                    + self.padding[0]
+                    + self.padding[1]
+                )
+        if self.width > 0:
+            width2 = (
+                ((self.width - self.border[0]) - self.border[1]) - self.padding[0]
+            ) - self.padding[1]
+            if width2 < min:
+                for pos in self.sizes:
+                    pos[0] = pos[1]
+            else:
+                if width2 <= opt:
+                    if opt - min == 0:
+                        proc = 1
+                    else:
+                        proc = ((width2 - min) * 1.0) / (opt - min)
+                    for pos in self.sizes:
+                        pos[0] = pos[1] + (pos[0] - pos[1]) * proc
+                else:
+                    if width2 <= max:
+                        proc = ((width2 - opt) * 1.0) / (max - opt)
+                        for pos in self.sizes:
+                            pos[0] = pos[0] + (pos[2] - pos[0]) * proc
+                    else:
+                        proc = (width2 * 1.0) / max
+                        for pos in self.sizes:
+                            pos[0] = pos[2] * proc
+        self.sizes_ok = True
+
+
+def legacy_row_height(self, row):
+    if row.height >= 0:
+        return row.height
+    else:
+        dy = 0
+        for i in range(0, self.col_count):
+            if row[i].__class__ != TdRef and row[i].rowspan == 1:
+                width = 0
+                for j in range(0, row[i].colspan):
+                    width += self.sizes[i + j][0]
+                row[i].set_width(width)
+                sy = row[i].get_height()
+                if sy > dy:
+                    dy = sy
+        row.height = dy
+        return dy
+
+
+def legacy_row_rowspan_height(self, rows):
+    dy = 0
+    for i in range(0, self.col_count):
+        if rows[0][i].__class__ != TdRef and rows[0][i].rowspan > 1:
+            width = 0
+            for j in range(0, rows[0][i].colspan):
+                width += self.sizes[i + j][0]
+            sy = rows[0][i].get_height()
+            sy2 = 0
+            for j in range(0, rows[0][i].rowspan):
+                sy2 += legacy_row_height(self, rows[j])
+            if sy > sy2:
+                delta = (sy - sy2) / rows[0][i].rowspan
+                for j in range(0, rows[0][i].rowspan):
+                    rows[j].height = rows[j].height + delta
+
+
+def legacy_calculate_rows_height(self):
+    for row in self.tr_list:
+        legacy_row_height(self, row)
+    for i in range(0, len(self.tr_list)):
+        legacy_row_rowspan_height(self, self.tr_list[i:])
+
+
+def run(rows, cols):
+    results = []
+    for name, calc_sizes, calc_heights in (
+        ("legacy", legacy_calc_col_sizes, legacy_calculate_rows_height),
+        ("current", TableTag.calc_col_sizes, TableTag._calculate_rows_height),
+    ):
+        tab = make_table(rows, cols)
+        t0 = time.perf_counter()
+        calc_sizes(tab)
+        t1 = time.perf_counter()
+        calc_heights(tab)
+        t2 = time.perf_counter()
+        print(
+            "%-8s col sizes: %8.3fs  row heights: %8.3fs" % (name, t1 - t0, t2 - t1)
+        )
+        results.append(
+            ([list(pos) for pos in tab.sizes], [row.height for row in tab.tr_list])
+        )
+    print("identical output:", results[0] == results[1])
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    cols = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    run(rows, cols)
@@ -353,7 +353,7 @@ class DcDcinfo(BaseDcInfo):
     def get_line_dy(self, height):
         return height * 3
 
-    def get_extents(self, word, style):
+    def _get_extents(self, word, style):
         self.dc.set_style(style)
         (w, h, d, e) = self.dc.dc.GetFullTextExtent("-" + word + "-")
         dx = w
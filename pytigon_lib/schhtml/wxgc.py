@@ -249,7 +249,7 @@ class GraphicsContextDcinfo(BaseDcInfo):
     def get_line_dy(self, height):
         return height * 3
 
-    def get_extents(self, word, style):
+    def _get_extents(self, word, style):
         self.dc.set_style(style)
         (w, h, d, e) = self.dc.ctx.GetFullTextExtent("-" + word + "-")
         dx = w
@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import concurrent.futures
+import threading
 import urllib
 import copy
+import os
+import uuid
+import mimetypes
 
 SCOPE_TEMPLATE = {
     "type": "http",
@@ -56,15 +62,69 @@ def get_scope_and_content_http_get(path, headers):
     return scope, ""
 
 
+def _is_file(value):
+    return hasattr(value, "read")
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode("utf-8")
+
+
+def multipart_content(params):
+    """Return (content type, body) of multipart/form-data request, values of params
+    can be strings, bytes, file-like objects or lists of them"""
+    boundary = uuid.uuid4().hex
+    buf = []
+    for key, values in params.items():
+        if not isinstance(values, (list, tuple)):
+            values = [values]
+        for value in values:
+            buf.append(b"--" + boundary.encode("ascii") + b"\r\n")
+            if _is_file(value):
+                file_name = os.path.basename(str(getattr(value, "name", key)))
+                content_type = (
+                    mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+                )
+                buf.append(
+                    (
+                        'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                        "Content-Type: %s\r\n\r\n" % (key, file_name, content_type)
+                    ).encode("utf-8")
+                )
+                buf.append(_to_bytes(value.read()))
+            else:
+                buf.append(
+                    ('Content-Disposition: form-data; name="%s"\r\n\r\n' % key).encode(
+                        "utf-8"
+                    )
+                )
+                buf.append(_to_bytes(value))
+            buf.append(b"\r\n")
+    buf.append(b"--" + boundary.encode("ascii") + b"--\r\n")
+    return "multipart/form-data; boundary=" + boundary, b"".join(buf)
+
+
 def get_scope_and_content_http_post(path, headers, params={}):
     scope, content = get_scope_and_content_http_get(path, headers)
     scope["method"] = "POST"
     scope["headers"].append((b"upgrade-insecure-requests", b"1"))
-    scope["headers"].append((b"content-type", b"application/x-www-form-urlencoded"))
-    if params:
-        content = urllib.parse.urlencode(params)
+    has_files = False
+    for value in params.values() if params else ():
+        if isinstance(value, (list, tuple)):
+            has_files = has_files or any(_is_file(pos) for pos in value)
+        else:
+            has_files = has_files or _is_file(value)
+    if has_files:
+        content_type, content = multipart_content(params)
     else:
-        content = ""
+        content_type = "application/x-www-form-urlencoded"
+        if params:
+            content = urllib.parse.urlencode(params).encode("utf-8")
+        else:
+            content = b""
+    scope["headers"].append((b"content-type", content_type.encode("utf-8")))
     scope["headers"].append((b"content-length", str(len(content)).encode("utf-8")))
     return scope, content
 
@@ -75,8 +135,21 @@ def get_scope_websocket(path, headers):
     return scope
 
 
-async def get_or_post(application, path, headers, params={}, post=False):
+async def get_or_post(application, path, headers, params={}, post=False, body_callback=None):
+    """Call ASGI application, return response message (status, headers, body)
+
+    Args:
+        application - ASGI application
+        path - request path with query string
+        headers - list of (name, value) pairs
+        params - parameters of post request
+        post - True for post request
+        body_callback - if not None, function called with every part of response body
+        as soon as application sends it, parts are not collected in returned body
+    """
     ret = {}
+    body = []
+    finished = asyncio.Event()
     if post:
         scope, content = get_scope_and_content_http_post(path, headers, params)
     else:
@@ -85,23 +158,53 @@ async def get_or_post(application, path, headers, params={}, post=False):
     async def send(message):
         nonlocal ret
         for key, value in message.items():
-            if key in ret:
+            if key == "body":
+                if body_callback:
+                    body_callback(value)
+                else:
+                    body.append(value)
+            elif key in ret:
                 ret[key] += value
             else:
                 ret[key] = value
+        if message.get("type") == "http.response.body" and not message.get(
+            "more_body", False
+        ):
+            finished.set()
+
+    request_sent = False
 
     async def receive():
-        nonlocal content
-        return {"type": "http", "body": content.encode("utf-8")}
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {
+                "type": "http.request",
+                "body": content if isinstance(content, bytes) else content.encode("utf-8"),
+                "more_body": False,
+            }
+        await finished.wait()
+        return {"type": "http.disconnect"}
 
-    application_queue = await application(scope, receive, send)
+    app_task = asyncio.ensure_future(application(scope, receive, send))
+    try:
+        await asyncio.shield(app_task)
+    except asyncio.CancelledError:
+        # request cancelled: receive returns http.disconnect, application stops its
+        # work and cleans up in app_task
+        finished.set()
+        raise
+    finished.set()
+    ret["body"] = b"".join(body)
 
-    if "status" in ret and ret["status"] == 302:
+    if "status" in ret and ret["status"] in (301, 302):
         if "headers" in ret:
             for pos in ret["headers"]:
-                if pos[0] == b"Location":
+                if pos[0].lower() == b"location":
                     new_url = pos[1].decode("utf-8").replace("http://127.0.0.2", "")
-                    ret2 = await get_or_post(application, new_url, headers)
+                    ret2 = await get_or_post(
+                        application, new_url, headers, body_callback=body_callback
+                    )
                     if "headers" in ret:
                         for pos2 in ret["headers"]:
                             ret2["headers"].append(pos2)
@@ -110,6 +213,90 @@ async def get_or_post(application, path, headers, params={}, post=False):
     return ret
 
 
+class AsgiDispatcher:
+    """Calls ASGI application in one event loop running in its own thread.
+
+    Requests from many threads are processed concurrently in this loop, there is no
+    new thread or event loop for every request.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.loop = None
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def can_dispatch(self):
+        """Return False if request can't be sent from current thread without deadlock:
+        in thread of the dispatcher and in threads of asgiref which run sync code of
+        application (for example Django view which gets page from embedded server),
+        the application would wait for the same thread.
+        """
+        if self.thread is not None and threading.current_thread() is self.thread:
+            return False
+        try:
+            from asgiref.sync import SyncToAsync
+        except ImportError:
+            return True
+        return getattr(SyncToAsync.threadlocal, "main_event_loop", None) is None
+
+    def start(self):
+        with self._lock:
+            if self.thread is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(
+                    target=self._run, name="asgi_dispatcher", daemon=True
+                )
+                self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        with self._lock:
+            if self.thread is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.thread.join()
+                self.loop.close()
+                self.thread = None
+                self.loop = None
+
+    def submit(self, path, headers, params={}, post=False, body_callback=None):
+        """Start request, return concurrent.futures.Future of response message
+
+        Args: see get_or_post, body_callback is called in thread of the dispatcher
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(
+            get_or_post(self.application, path, headers, params, post, body_callback),
+            self.loop,
+        )
+
+    def get_or_post(self, path, headers, params={}, post=False, timeout=None):
+        """Call application and wait for response, if timeout is exceeded request is
+        cancelled and concurrent.futures.TimeoutError is raised"""
+        future = self.submit(path, headers, params, post)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+
+_DISPATCHERS = {}
+_DISPATCHERS_LOCK = threading.Lock()
+
+
+def get_asgi_dispatcher(application):
+    """Return shared dispatcher of application"""
+    with _DISPATCHERS_LOCK:
+        dispatcher = _DISPATCHERS.get(id(application))
+        if dispatcher is None or dispatcher.application is not application:
+            dispatcher = _DISPATCHERS[id(application)] = AsgiDispatcher(application)
+    return dispatcher
+
+
 async def websocket(application, path, headers, input_queue, output):
     ret = {}
     status = 0
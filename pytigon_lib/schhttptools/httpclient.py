@@ -22,12 +22,15 @@
 """
 
 import base64
+import copy
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from urllib.parse import urlsplit
 
 from django.conf import settings
 from django.core.files.storage import default_storage
 import asyncio
-from threading import Thread
 
 from pytigon_lib.schfs.vfstools import norm_path
 from pytigon_lib.schtools.schjson import json_loads
@@ -36,7 +39,8 @@ from pytigon_lib.schtools.platform_info import platform_name
 if platform_name() != "Emscripten":
     import httpx
 from pytigon_lib.schhttptools.wsgi_bridge import get_or_post as wsgi_get_or_post
-from pytigon_lib.schhttptools.asgi_bridge import get_or_post, websocket
+from pytigon_lib.schhttptools.asgi_bridge import websocket, get_asgi_dispatcher
+from pytigon_lib.schhttptools.response_cache import ResponseCache, CacheEntry
 from pytigon_lib.schtools.platform_info import platform_name
 from django.core.wsgi import get_wsgi_application
 from django.test import Client
@@ -48,6 +52,8 @@ LOGGER = logging.getLogger("httpclient")
 
 ASGI_APPLICATION = None
 FORCE_WSGI = False
+# seconds, max time of waiting for response of embedded application
+EMBEDED_TIMEOUT = 300
 
 
 def decode(bstr, dec="utf-8"):
@@ -146,6 +152,19 @@ class RetHttp:
                 self.url = value
 
 
+response_cache = ResponseCache()
+
+
+def set_response_cache(cache):
+    """Set cache used by HttpClient objects created later
+
+    Args:
+        cache - ResponseCache object or object with the same interface
+    """
+    global response_cache
+    response_cache = cache
+
+
 CLIENT = None
 # Client(HTTP_USER_AGENT = 'Emscripten' if platform_name() == "Emscripten" else "Pytigon")
 
@@ -185,7 +204,7 @@ def emscripten_asgi_or_wsgi_get_or_post(
     result["body"] = response.getvalue()
     result["more_body"] = False
     if response.status_code in (301, 302):
-        return asgi_or_wsgi_get_or_post(
+        return emscripten_asgi_or_wsgi_get_or_post(
             application,
             response.headers["Location"],
             headers,
@@ -204,127 +223,272 @@ def emscripten_asgi_or_wsgi_get_or_post(
 def asgi_or_wsgi_get_or_post(
     application, url, headers, params={}, post=False, ret=[], user_agent="pytigon"
 ):
-    if True or platform_name() == "Emscripten" or FORCE_WSGI:
+    dispatcher = get_asgi_dispatcher(application)
+    if platform_name() == "Emscripten" or FORCE_WSGI or not dispatcher.can_dispatch():
         return emscripten_asgi_or_wsgi_get_or_post(
             application, url, headers, params, post, ret, user_agent
         )
     else:
-        event_loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(event_loop)
-        ret2 = asyncio.get_event_loop().run_until_complete(
-            get_or_post(application, url, headers, params=params, post=post)
-        )
-        ret.append(ret2)
+        ret.append(dispatcher.get_or_post(url, headers, params, post, EMBEDED_TIMEOUT))
+
+
+# limits of pooled keep-alive connections, see set_http_pool_limits
+HTTP_MAX_CONNECTIONS = 20
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 10
+HTTP_KEEPALIVE_EXPIRY = 30
+HTTP2 = False
+# number of worker threads for requests made by gui applications
+HTTP_WORKERS = 8
+
+_TRANSPORTS = {}
+_TRANSPORT_LOCK = threading.Lock()
+_HTTP_EXECUTOR = None
+
+
+def set_http_pool_limits(
+    max_connections=None,
+    max_keepalive_connections=None,
+    keepalive_expiry=None,
+    http2=None,
+    workers=None,
+):
+    """Set limits of pooled connections, transports created before are closed
+
+    Args:
+        max_connections - max number of connections to one host
+        max_keepalive_connections - max number of idle connections kept open
+        keepalive_expiry - seconds after which idle connection is closed
+        http2 - use HTTP/2 if h2 package is installed
+        workers - number of worker threads
+    """
+    global HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS, HTTP_KEEPALIVE_EXPIRY
+    global HTTP2, HTTP_WORKERS, _HTTP_EXECUTOR
+
+    if max_connections != None:
+        HTTP_MAX_CONNECTIONS = max_connections
+    if max_keepalive_connections != None:
+        HTTP_MAX_KEEPALIVE_CONNECTIONS = max_keepalive_connections
+    if keepalive_expiry != None:
+        HTTP_KEEPALIVE_EXPIRY = keepalive_expiry
+    if http2 != None:
+        HTTP2 = http2
+    if workers != None and workers != HTTP_WORKERS:
+        HTTP_WORKERS = workers
+        if _HTTP_EXECUTOR:
+            _HTTP_EXECUTOR.shutdown(wait=False)
+            _HTTP_EXECUTOR = None
+    close_http_transports()
+
+
+def _get_origin(url):
+    x = urlsplit(url)
+    return x.scheme + "://" + x.netloc
+
+
+def _get_transport_args():
+    http2 = False
+    if HTTP2:
+        try:
+            import h2
+
+            http2 = True
+        except ImportError:
+            pass
+    return {
+        "limits": httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        "http2": http2,
+    }
+
+
+def get_http_transport(url):
+    """Return shared keep-alive transport for base address of url"""
+    origin = _get_origin(url)
+    with _TRANSPORT_LOCK:
+        transport = _TRANSPORTS.get(origin)
+        if transport is None:
+            transport = httpx.HTTPTransport(**_get_transport_args())
+            _TRANSPORTS[origin] = transport
+    return transport
+
+
+def close_http_transports():
+    with _TRANSPORT_LOCK:
+        transports = list(_TRANSPORTS.values())
+        _TRANSPORTS.clear()
+    for transport in transports:
+        transport.close()
+
+
+def get_http_executor():
+    global _HTTP_EXECUTOR
+    with _TRANSPORT_LOCK:
+        if _HTTP_EXECUTOR is None:
+            _HTTP_EXECUTOR = ThreadPoolExecutor(
+                max_workers=HTTP_WORKERS, thread_name_prefix="httpclient"
+            )
+    return _HTTP_EXECUTOR
+
+
+class HttpStats:
+    """Numbers of requests, errors and times of requests for every host"""
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def add(self, url, t, error=False, size=0):
+        origin = _get_origin(url)
+        with self._lock:
+            stats = self._stats.get(origin)
+            if stats is None:
+                stats = self._stats[origin] = {
+                    "requests": 0,
+                    "errors": 0,
+                    "bytes": 0,
+                    "total_time": 0.0,
+                    "max_time": 0.0,
+                }
+            stats["requests"] += 1
+            if error:
+                stats["errors"] += 1
+            stats["bytes"] += size
+            stats["total_time"] += t
+            if t > stats["max_time"]:
+                stats["max_time"] = t
+
+    def get(self, host=None):
+        """Return dict: base address -> statistics
+
+        Args:
+            host - if not None only statistics of base address of host are returned
+        """
+        ret = {}
+        with self._lock:
+            for origin, stats in self._stats.items():
+                if host and origin != _get_origin(host):
+                    continue
+                stats2 = dict(stats)
+                stats2["avg_time"] = stats["total_time"] / stats["requests"]
+                transport = _TRANSPORTS.get(origin)
+                try:
+                    stats2["connections"] = len(transport._pool.connections)
+                except AttributeError:
+                    stats2["connections"] = 0
+                ret[origin] = stats2
+        return ret
+
+    def clear(self):
+        with self._lock:
+            self._stats = {}
+
+
+http_stats = HttpStats()
+
+
+def _split_argv(argv):
+    argv2 = dict(argv)
+    cookies = argv2.pop("cookies", None)
+    return cookies, argv2
 
 
 def requests_request(method, url, argv, ret=[]):
-    ret2 = httpx.request(method, url, **argv)
+    cookies, argv2 = _split_argv(argv)
+    client = httpx.Client(transport=get_http_transport(url), cookies=cookies)
+    ret2 = client.request(method, url, **argv2)
     ret.append(ret2)
 
 
+def _wait(future, app=None, timeout=None):
+    """Wait for result of future, if app is not None process its events while waiting
+
+    Args:
+        future - concurrent.futures.Future
+        app - application object with Yield method or None
+        timeout - seconds, if exceeded future is cancelled and
+        concurrent.futures.TimeoutError is raised
+    """
+    if app:
+        start = time.monotonic()
+        try:
+            while not future.done():
+                if timeout is not None and time.monotonic() - start > timeout:
+                    break
+                app.Yield()
+        except:
+            pass
+        if timeout is not None:
+            timeout = max(timeout - (time.monotonic() - start), 0)
+    try:
+        return future.result(timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise
+
+
+def _run_in_worker(fun, args, app=None):
+    return _wait(get_http_executor().submit(fun, *args), app)
+
+
 def request(method, url, direct_access, argv, app=None, user_agent="pytigon"):
     global ASGI_APPLICATION
     ret = []
-    if direct_access and ASGI_APPLICATION:
-        post = True if method == "post" else False
-        h = argv["headers"]
-        headers = []
-        for key, value in h.items():
-            headers.append((key.encode("utf-8"), value.encode("utf-8")))
-        cookies = ""
-        if "cookies" in argv:
-            for key, value in argv["cookies"].items():
-                value2 = value.split(";", 1)[0]
-                cookies += f"{key}={value2};"
-        if cookies:
-            headers.append((b"cookie", cookies.encode("utf-8")))
-
-        if post:
-            if platform_name() == "Emscripten" or FORCE_WSGI:
-                asgi_or_wsgi_get_or_post(
-                    ASGI_APPLICATION,
-                    url.replace("http://127.0.0.2", ""),
-                    headers,
-                    argv["data"],
-                    post,
-                    ret,
-                    user_agent,
+    start = time.perf_counter()
+    try:
+        if direct_access and ASGI_APPLICATION:
+            post = True if method == "post" else False
+            h = argv["headers"]
+            headers = []
+            for key, value in h.items():
+                headers.append((key.encode("utf-8"), value.encode("utf-8")))
+            cookies = ""
+            if "cookies" in argv:
+                for key, value in argv["cookies"].items():
+                    value2 = value.split(";", 1)[0]
+                    cookies += f"{key}={value2};"
+            if cookies:
+                headers.append((b"cookie", cookies.encode("utf-8")))
+
+            path = url.replace("http://127.0.0.2", "")
+            params = argv["data"] if post else {}
+            dispatcher = get_asgi_dispatcher(ASGI_APPLICATION)
+            if (
+                platform_name() == "Emscripten"
+                or FORCE_WSGI
+                or not dispatcher.can_dispatch()
+            ):
+                emscripten_asgi_or_wsgi_get_or_post(
+                    ASGI_APPLICATION, path, headers, params, post, ret, user_agent
                 )
             else:
-                t = Thread(
-                    target=asgi_or_wsgi_get_or_post,
-                    args=(
-                        ASGI_APPLICATION,
-                        url.replace("http://127.0.0.2", ""),
-                        headers,
-                        argv["data"],
-                        post,
-                        ret,
-                        user_agent,
-                    ),
-                    daemon=True,
+                ret.append(
+                    _wait(
+                        dispatcher.submit(path, headers, params, post),
+                        app,
+                        EMBEDED_TIMEOUT,
+                    )
                 )
-                t.start()
-                if app:
-                    try:
-                        while t.is_alive():
-                            app.Yield()
-                    except:
-                        t.join()
-                else:
-                    t.join()
+            response = RetHttp(url, ret[0])
         else:
-            if platform_name() == "Emscripten" or FORCE_WSGI:
-                asgi_or_wsgi_get_or_post(
-                    ASGI_APPLICATION,
-                    url.replace("http://127.0.0.2", ""),
-                    headers,
-                    {},
-                    post,
-                    ret,
-                    user_agent,
-                )
+            if app and not (platform_name() == "Emscripten" or FORCE_WSGI):
+                _run_in_worker(requests_request, (method, url, argv, ret), app)
             else:
-                t = Thread(
-                    target=asgi_or_wsgi_get_or_post,
-                    args=(
-                        ASGI_APPLICATION,
-                        url.replace("http://127.0.0.2", ""),
-                        headers,
-                        {},
-                        post,
-                        ret,
-                        user_agent,
-                    ),
-                    daemon=True,
-                )
-                t.start()
-                if app:
-                    try:
-                        while t.is_alive():
-                            app.Yield()
-                    except:
-                        t.join()
-                else:
-                    t.join()
-        return RetHttp(url, ret[0])
-    else:
-        if app:
-            if platform_name() == "Emscripten" or FORCE_WSGI:
                 requests_request(method, url, argv, ret)
-            else:
-                t = Thread(
-                    target=requests_request, args=(method, url, argv, ret), daemon=True
-                )
-                t.start()
-                try:
-                    while t.is_alive():
-                        app.Yield()
-                except:
-                    t.join()
-        else:
-            requests_request(method, url, argv, ret)
-        return ret[0]
+            response = ret[0]
+    except:
+        http_stats.add(url, time.perf_counter() - start, error=True)
+        raise
+    content = getattr(response, "content", None)
+    http_stats.add(
+        url,
+        time.perf_counter() - start,
+        getattr(response, "status_code", 200) >= 500,
+        len(content) if content else 0,
+    )
+    return response
 
 
 class HttpResponse:
@@ -337,6 +501,7 @@ class HttpResponse:
         self.content = content
         self.ret_content_type = ret_content_type
         self.new_url = url
+        self.cache_entry = None
 
     def process_response(self, http_client, parent, post_request):
         global COOKIES
@@ -351,13 +516,19 @@ class HttpResponse:
 
         self.content = self.response.content
         self.ret_code = self.response.status_code
+        not_modified = self.ret_code == 304 and self.cache_entry
 
-        if self.response.status_code != 200:
+        if not_modified:
+            self.content = self.cache_entry.content
+            self.ret_code = 200
+        elif self.response.status_code != 200:
             LOGGER.error({"address": self.url, "httpcode": self.response.status_code})
             if self.response.status_code == 500:
                 LOGGER.error({"content": self.content})
 
-        if "content-type" in self.response.headers:
+        if not_modified:
+            self.ret_content_type = self.cache_entry.content_type
+        elif "content-type" in self.response.headers:
             self.ret_content_type = self.response.headers["content-type"]
         else:
             self.ret_content_type = None
@@ -388,13 +559,20 @@ class HttpResponse:
                 self.content = b""
                 return
 
-        if (
-            not post_request
-            and not "?" in self.url
-            and type(self.content) == bytes
-            and (b"Cache-control" in self.content or "/plugins" in self.url)
-        ):
-            http_client.http_cache[self.url] = (self.ret_content_type, self.content)
+        if not post_request and not "?" in self.url and type(self.content) == bytes:
+            if not_modified:
+                http_client.http_cache.refresh(
+                    self.url, self.cache_entry, self.response.headers
+                )
+            elif self.ret_code == 200:
+                entry = http_client.http_cache.entry_from_response(
+                    self.ret_content_type,
+                    self.content,
+                    self.response.headers,
+                    b"Cache-control" in self.content or "/plugins" in self.url,
+                )
+                if entry:
+                    http_client.http_cache.put(self.url, entry)
 
         if type(self.response.url) == str:
             self.new_url = self.response.url
@@ -434,19 +612,69 @@ class HttpResponse:
 class HttpClient:
     """Http client class"""
 
-    def __init__(self, address):
+    def __init__(self, address, cache=None):
         """Constructor
 
         Args:
             address: base address for http requests
+            cache: response cache, if None module response_cache is used
         """
         self.base_address = address
-        self.http_cache = {}
+        self.http_cache = cache if cache is not None else response_cache
         self.app = None
 
     def close(self):
         pass
 
+    def get_http_stats(self, host=None):
+        """Return statistics of requests: base address -> dict with numbers of requests,
+        errors, received bytes, total, average and max time of request and number of
+        open connections
+
+        Args:
+            host - if not None only statistics of base address of host are returned
+        """
+        return http_stats.get(host)
+
+    def get_many(self, parent, addresses, user_agent="pytigon"):
+        """Get many resources concurrently
+
+        Args:
+            parent - parent wx.Window derived object
+            addresses - list of request addresses
+            user_agent - default "pytigon"
+
+        Returns:
+            dict: address -> HttpResponse, addresses which could not be retrieved are
+            missing
+        """
+        ret = {}
+        if platform_name() == "Emscripten" or FORCE_WSGI:
+            for address in addresses:
+                try:
+                    ret[address] = self.get(parent, address, user_agent=user_agent)
+                except:
+                    pass
+            return ret
+        # worker threads must not process gui events
+        client = copy.copy(self)
+        client.app = None
+        executor = get_http_executor()
+        futures = [
+            (address, executor.submit(client.get, parent, address, user_agent=user_agent))
+            for address in addresses
+        ]
+        for address, future in futures:
+            try:
+                ret[address] = _wait(future, self.app)
+            except:
+                pass
+        return ret
+
+    def get_cache_stats(self):
+        """Return statistics of response cache, see ResponseCache.stats"""
+        return self.http_cache.stats()
+
     def post(
         self,
         parent,
@@ -550,13 +778,18 @@ class HttpClient:
 
         LOGGER.info(adr)
 
+        cache_entry = None
         if not post_request and not "?" in adr:
-            if adr in self.http_cache:
-                return HttpResponse(
-                    adr,
-                    content=self.http_cache[adr][1],
-                    ret_content_type=self.http_cache[adr][0],
-                )
+            cache_entry = self.http_cache.get(adr)
+            if cache_entry:
+                if cache_entry.is_fresh():
+                    return HttpResponse(
+                        adr,
+                        content=cache_entry.content,
+                        ret_content_type=cache_entry.content_type,
+                    )
+                if not cache_entry.can_revalidate():
+                    cache_entry = None
 
         if (
             adr.startswith("http://127.0.0")
@@ -571,11 +804,23 @@ class HttpClient:
                 ).replace("/site_media", "")
 
             try:
-                return HttpResponse(
-                    adr,
-                    content=default_storage.open(path).read(),
-                    ret_content_type="text/html",
-                )
+                try:
+                    etag = "mtime:%r" % default_storage.get_modified_time(
+                        path
+                    ).timestamp()
+                except:
+                    etag = None
+                if etag and cache_entry and cache_entry.etag == etag:
+                    self.http_cache.revalidated()
+                    return HttpResponse(
+                        adr,
+                        content=cache_entry.content,
+                        ret_content_type=cache_entry.content_type,
+                    )
+                content = default_storage.open(path).read()
+                if etag:
+                    self.http_cache.put(adr, CacheEntry("text/html", content, etag=etag))
+                return HttpResponse(adr, content=content, ret_content_type="text/html")
             except:
                 print("Static file load error: ", path)
                 return HttpResponse(adr, 400, content=b"", ret_content_type="text/html")
@@ -596,6 +841,8 @@ class HttpClient:
         if user_agent:
             headers["User-Agent"] = user_agent
         headers["Referer"] = adr
+        if cache_entry:
+            headers.update(cache_entry.validators())
 
         # argv = {"headers": headers, "allow_redirects": True, "cookies": cookies}
         argv = {"headers": headers, "follow_redirects": True, "cookies": cookies}
@@ -638,6 +885,7 @@ class HttpClient:
 
         response = request(method, adr, direct_access, argv, self.app, user_agent)
         http_response = HttpResponse(adr, response=response)
+        http_response.cache_entry = cache_entry
         http_response.process_response(self, parent, post_request)
 
         return http_response
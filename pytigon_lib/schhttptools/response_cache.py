@@ -0,0 +1,339 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Pytigon - wxpython and django application framework
+
+# author: "Slawomir Cholaj (slawomir.cholaj@gmail.com)"
+# copyright: "Copyright (C) ????/2012 Slawomir Cholaj"
+# license: "LGPL 3.0"
+# version: "0.1a"
+
+"""Cache of http responses used by HttpClient.
+
+Responses are kept in memory in LRU order within a limit of bytes and optionally in
+a directory on disk. Entry is fresh until time given by Cache-Control max-age (or
+CACHE_TIMEOUT for responses cached without it), stale entries with ETag or
+Last-Modified are revalidated by conditional request.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+CACHE_DISK_MAX_BYTES = 256 * 1024 * 1024
+# seconds, for responses without max-age which are cached anyway
+CACHE_TIMEOUT = 3600
+
+
+def parse_cache_control(value):
+    """Return dict: directive -> value (True for directives without value)"""
+    ret = {}
+    if value:
+        for pos in value.split(","):
+            pos = pos.strip().lower()
+            if pos:
+                x = pos.split("=", 1)
+                if len(x) > 1:
+                    ret[x[0].strip()] = x[1].strip().strip('"')
+                else:
+                    ret[x[0].strip()] = True
+    return ret
+
+
+class CacheEntry:
+    def __init__(
+        self, content_type, content, expires=None, etag=None, last_modified=None
+    ):
+        """Constructor
+
+        Args:
+            content_type - value of content-type header
+            content - response body (bytes)
+            expires - time (time.time()) after which entry must be revalidated, None -
+            always revalidate
+            etag, last_modified - validators sent in conditional request
+        """
+        self.content_type = content_type
+        self.content = content
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def size(self):
+        return len(self.content)
+
+    def is_fresh(self):
+        return self.expires is not None and time.time() < self.expires
+
+    def can_revalidate(self):
+        return bool(self.etag or self.last_modified)
+
+    def validators(self):
+        """Return headers of conditional request"""
+        ret = {}
+        if self.etag:
+            ret["If-None-Match"] = self.etag
+        if self.last_modified:
+            ret["If-Modified-Since"] = self.last_modified
+        return ret
+
+    def to_meta(self, url):
+        return {
+            "url": url,
+            "content_type": self.content_type,
+            "expires": self.expires,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+        }
+
+
+class ResponseCache:
+    """LRU cache of responses with a limit of bytes and optional disk storage.
+
+    Subclass it (or write class with the same methods) and pass the object to
+    HttpClient or set_response_cache to change caching policy.
+    """
+
+    def __init__(
+        self,
+        max_bytes=CACHE_MAX_BYTES,
+        disk_path=None,
+        disk_max_bytes=CACHE_DISK_MAX_BYTES,
+        timeout=CACHE_TIMEOUT,
+    ):
+        """Constructor
+
+        Args:
+            max_bytes - max size of content kept in memory
+            disk_path - directory of disk cache, None - don't use disk
+            disk_max_bytes - max size of disk cache
+            timeout - lifetime of entries cached without max-age
+        """
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+        self.disk_max_bytes = disk_max_bytes
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.RLock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.disk_hits = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    def entry_from_response(self, content_type, content, headers, force=False):
+        """Return CacheEntry for response or None if response shouldn't be cached
+
+        Args:
+            content_type - content type of response
+            content - response body
+            headers - response headers, keys are case insensitive or lower case
+            force - cache response without cache headers for timeout seconds
+        """
+        cc = parse_cache_control(headers.get("cache-control"))
+        if "no-store" in cc:
+            return None
+        expires = None
+        if "no-cache" in cc:
+            pass
+        elif "max-age" in cc:
+            try:
+                expires = time.time() + int(cc["max-age"])
+            except (TypeError, ValueError):
+                pass
+        elif force:
+            expires = time.time() + self.timeout
+        entry = CacheEntry(
+            content_type,
+            content,
+            expires,
+            headers.get("etag"),
+            headers.get("last-modified"),
+        )
+        if entry.expires is None and not entry.can_revalidate():
+            return None
+        if not self.can_store(entry):
+            return None
+        return entry
+
+    def can_store(self, entry):
+        """Return False if entry is too big to be cached (over 1/4 of max_bytes)"""
+        return entry.size <= self.max_bytes // 4
+
+    def get(self, url):
+        """Return CacheEntry (fresh or not) or None"""
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            elif self.disk_path:
+                entry = self._read_disk(url)
+                if entry is not None:
+                    self.disk_hits += 1
+                    self._put_memory(url, entry)
+            if entry is None:
+                self.cache_misses += 1
+            else:
+                self.cache_hits += 1
+            return entry
+
+    def put(self, url, entry):
+        """Cache entry, entries too big to be cached are ignored and remove older
+        entry of url"""
+        if not self.can_store(entry):
+            self.remove(url)
+            return
+        with self._lock:
+            self._put_memory(url, entry)
+            if self.disk_path:
+                self._write_disk(url, entry)
+
+    def refresh(self, url, entry, headers):
+        """Update entry after response 304 (not modified)"""
+        entry2 = self.entry_from_response(
+            entry.content_type, entry.content, headers, force=False
+        )
+        with self._lock:
+            self.revalidations += 1
+            if entry2 is not None:
+                entry.expires = entry2.expires
+                if entry2.etag:
+                    entry.etag = entry2.etag
+                if entry2.last_modified:
+                    entry.last_modified = entry2.last_modified
+            if self.disk_path:
+                self._write_disk(url, entry)
+
+    def revalidated(self):
+        with self._lock:
+            self.revalidations += 1
+
+    def remove(self, url):
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                self._bytes -= entry.size
+            if self.disk_path:
+                self._remove_disk_file(self._disk_file_name(url))
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._bytes = 0
+            self.cache_hits = 0
+            self.cache_misses = 0
+            self.disk_hits = 0
+            self.revalidations = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Return dict with keys: hits, misses, disk_hits, revalidations, evictions,
+        entries, bytes, disk_bytes"""
+        with self._lock:
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "disk_hits": self.disk_hits,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "disk_bytes": self._get_disk_bytes() if self.disk_path else 0,
+            }
+
+    def _put_memory(self, url, entry):
+        old = self._entries.pop(url, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._entries[url] = entry
+        self._bytes += entry.size
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            url2, entry2 = self._entries.popitem(last=False)
+            self._bytes -= entry2.size
+            self.evictions += 1
+
+    def _disk_file_name(self, url):
+        return os.path.join(
+            self.disk_path, hashlib.sha1(url.encode("utf-8")).hexdigest()
+        )
+
+    def _get_disk_bytes(self):
+        if self._disk_bytes is None:
+            self._disk_bytes = 0
+            if os.path.exists(self.disk_path):
+                for entry in os.scandir(self.disk_path):
+                    if entry.is_file():
+                        self._disk_bytes += entry.stat().st_size
+        return self._disk_bytes
+
+    def _read_disk(self, url):
+        file_name = self._disk_file_name(url)
+        try:
+            with open(file_name, "rb") as f:
+                meta = json.loads(f.readline().decode("utf-8"))
+                content = f.read()
+        except (OSError, ValueError):
+            return None
+        if meta.get("url") != url:
+            return None
+        try:
+            os.utime(file_name)
+        except OSError:
+            pass
+        return CacheEntry(
+            meta["content_type"],
+            content,
+            meta["expires"],
+            meta["etag"],
+            meta["last_modified"],
+        )
+
+    def _remove_disk_file(self, file_name):
+        try:
+            size = os.path.getsize(file_name)
+            os.remove(file_name)
+        except OSError:
+            return
+        if self._disk_bytes is not None:
+            self._disk_bytes -= size
+
+    def _write_disk(self, url, entry):
+        self._get_disk_bytes()
+        file_name = self._disk_file_name(url)
+        self._remove_disk_file(file_name)
+        data = (
+            json.dumps(entry.to_meta(url)).encode("utf-8") + b"\n" + entry.content
+        )
+        try:
+            os.makedirs(self.disk_path, exist_ok=True)
+            with open(file_name, "wb") as f:
+                f.write(data)
+        except OSError:
+            return
+        self._disk_bytes += len(data)
+        if self._disk_bytes > self.disk_max_bytes:
+            files = sorted(
+                (e for e in os.scandir(self.disk_path) if e.is_file()),
+                key=lambda e: e.stat().st_mtime,
+            )
+            for e in files:
+                if self._disk_bytes <= self.disk_max_bytes * 0.9:
+                    break
+                if e.path != file_name:
+                    self._remove_disk_file(e.path)
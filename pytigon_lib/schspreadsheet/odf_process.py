@@ -23,9 +23,11 @@
 """
 
 from xml.dom.expatbuilder import TEXT_NODE
-from zipfile import ZipFile, ZIP_DEFLATED
+from zipfile import ZipFile
+import os
 import re
-import shutil
+import threading
+from collections import OrderedDict
 
 try:
     from lxml import etree
@@ -33,11 +35,14 @@ except:
     pass
 import base64
 
-from pytigon_lib.schfs.vfstools import delete_from_zip
+from pytigon_lib.schfs.vfstools import rewrite_zip
 
 OFFICE_URN = "{urn:oasis:names:tc:opendocument:xmlns:office:1.0}"
 TABLE_URN = "{urn:oasis:names:tc:opendocument:xmlns:table:1.0}"
 TEXT_URN = "{urn:oasis:names:tc:opendocument:xmlns:text:1.0}"
+XML_URI = "http://www.w3.org/XML/1998/namespace"
+
+TEMPLATE_CACHE_SIZE = 64
 
 
 def attr_get(attrs, key):
@@ -51,6 +56,168 @@ def transform_str(s):
     return s.replace("***", '"').replace("**", "'")
 
 
+# elements of content.xml which are written to output tag by tag during streaming
+# transformation, other elements are transformed and written as whole subtrees
+STREAM_TAGS = (
+    "document-content",
+    "body",
+    "spreadsheet",
+    "table",
+    "table-header-rows",
+    "table-rows",
+    "table-row-group",
+)
+
+CONTENT_REPLACEMENTS = (
+    (b"&apos;", b"'"),
+    (b"_start_", b"{{"),
+    (b"_end_", b"}}"),
+)
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _escape_text(s):
+    return (
+        s.replace("&", "&amp;")
+        .replace("<", "&lt;")
+        .replace(">", "&gt;")
+        .replace("\r", "&#13;")
+    )
+
+
+def _escape_attr(s):
+    return (
+        _escape_text(s)
+        .replace('"', "&quot;")
+        .replace("\n", "&#10;")
+        .replace("\t", "&#9;")
+    )
+
+
+class ReplaceReader:
+    """File like object which replaces byte strings in data read from other file"""
+
+    def __init__(self, f, replacements=CONTENT_REPLACEMENTS, chunk_size=64 * 1024):
+        """Constructor
+
+        Args:
+            f - source file object
+            replacements - list of pairs: (old, new), new must not contain any of old
+            chunk_size - size of data read from f at once
+        """
+        self.f = f
+        self.replacements = replacements
+        self.chunk_size = chunk_size
+        self.keep = max([len(pos[0]) for pos in replacements]) - 1
+        self.buf = b""
+        self.eof = False
+
+    def read(self, size=-1):
+        if size == None or size < 0:
+            size = self.chunk_size
+        while not self.eof and len(self.buf) < size + self.keep:
+            data = self.f.read(max(size, self.chunk_size))
+            if data:
+                self.buf += data
+            else:
+                self.eof = True
+        buf = self.buf
+        for old, new in self.replacements:
+            buf = buf.replace(old, new)
+        if self.eof or self.keep <= 0:
+            self.buf = b""
+            return buf
+        self.buf = buf[-self.keep :]
+        return buf[: -self.keep]
+
+
+class _StreamFrame:
+    def __init__(self, element, slot):
+        self.element = element
+        self.slot = slot
+        self.suffix = ""
+        self.skip = False
+        self.hidden = False
+        self.drop_tail = False
+        self.closed = True
+        self.text_done = False
+        self.finished_child = None
+        self.finished_drop_tail = False
+        self.finished_suffix = ""
+
+
+class TemplateCache:
+    """Cache of prepared templates.
+
+    Key contains path, modification time and size of template file, so a changed
+    template is prepared again. Value is anything the transformation needs to render
+    document: preprocessed xml and compiled template.
+    """
+
+    def __init__(self, size=TEMPLATE_CACHE_SIZE):
+        self.size = size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def key(self, file_name, *args):
+        """Return cache key for template file or None if file doesn't exist
+
+        Args:
+            file_name - template file name
+            args - hashable options which change result of preprocessing
+        """
+        try:
+            st = os.stat(file_name)
+        except OSError:
+            return None
+        return (os.path.abspath(file_name), st.st_mtime_ns, st.st_size) + args
+
+    def get(self, key):
+        with self._lock:
+            ret = self._cache.get(key)
+            if ret is None:
+                self.cache_misses += 1
+            else:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+            return ret
+
+    def put(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache = OrderedDict()
+            self.cache_hits = 0
+            self.cache_misses = 0
+
+    def stats(self):
+        """Return dict with keys: hits, misses, size"""
+        with self._lock:
+            return {
+                "hits": self.cache_hits,
+                "misses": self.cache_misses,
+                "size": len(self._cache),
+            }
+
+
+template_cache = TemplateCache()
+
+
+def get_template_cache_stats():
+    """Return hit/miss statistics of cache of prepared templates"""
+    return template_cache.stats()
+
+
 class OdfDocTransform:
     """Transformate odf file"""
 
@@ -59,7 +226,8 @@ class OdfDocTransform:
 
         Args:
             file_name_in - input file name
-            file_name_out - output file name - if none output file name is composed from input file name.
+            file_name_out - output file name or writable file-like object - if none
+            output file name is composed from input file name.
         """
         self.file_name_in = file_name_in
         if file_name_out == None:
@@ -69,6 +237,7 @@ class OdfDocTransform:
         self.process_tables = None
         self.doc_type = 1
         self.buf = None
+        self.use_cache = True
 
     def set_doc_type(self, doc_type):
         """
@@ -95,6 +264,9 @@ class OdfDocTransform:
         pass
 
     def spreadsheet_process(self, doc, debug):
+        self._spreadsheet_process(doc, debug)
+
+    def _spreadsheet_process(self, doc, debug, outer=None):
         elementy = doc.findall(".//{*}p")
         for element in elementy:
             if element.getparent().tag.endswith("annotation"):
@@ -118,10 +290,13 @@ class OdfDocTransform:
                     x = element.getparent()
                     y = element.getparent().getparent()
                     y.remove(x)
-                    if poziom > 1:
-                        y = y.getparent()
-                    if poziom > 2:
+                    up = poziom - 1
+                    while up > 0 and not (outer and y is doc):
                         y = y.getparent()
+                        up -= 1
+                    if outer and y is doc:
+                        outer(up, skladniki)
+                        continue
                     new_cell = etree.Element("tmp")
                     parent = y.getparent()
                     parent[parent.index(y)] = new_cell
@@ -241,6 +416,151 @@ class OdfDocTransform:
                     parent = element.getparent()
                     parent[parent.index(element)] = new_cell
 
+    def spreadsheet_stream_process(self, f, debug):
+        """Transform content.xml of spreadsheet in one pass
+
+        Output is the same as from spreadsheet_process, but elements are transformed and
+        written as soon as they are parsed, so only one row is kept in memory.
+
+        Args:
+            f - file object with content.xml, '&apos;', '_start_' and '_end_' should be
+            already replaced (see ReplaceReader)
+            debug - add annotations with formulas
+
+        Returns:
+            transformed xml (str) with <tmp> tags removed
+        """
+        out = ["<?xml version='1.0' encoding='utf-8'?>\n"]
+        stack = []
+        ns_decl = []
+        subtree = None
+        depth = 0
+
+        def outer(up, skladniki):
+            frame = stack[-1 - up]
+            if frame.hidden:
+                return
+            out[frame.slot] += skladniki[0]
+            frame.drop_tail = True
+            if len(skladniki) > 1:
+                frame.suffix = skladniki[1] + frame.suffix
+
+        def qname(element, name):
+            if name[0] != "{":
+                return name
+            uri, local = name[1:].split("}", 1)
+            if uri == XML_URI:
+                return "xml:" + local
+            for prefix, uri2 in element.nsmap.items():
+                if uri2 == uri and prefix:
+                    return prefix + ":" + local
+            return local
+
+        def write(frame, s):
+            if not frame.skip:
+                out.append(s)
+
+        def flush(frame):
+            if not frame.closed:
+                out.append(">")
+                frame.closed = True
+            if not frame.text_done:
+                frame.text_done = True
+                if frame.element.text:
+                    write(frame, _escape_text(frame.element.text))
+            child = frame.finished_child
+            if child is not None:
+                if child.tail and not frame.finished_drop_tail:
+                    write(frame, _escape_text(child.tail))
+                write(frame, frame.finished_suffix)
+                frame.element.remove(child)
+                frame.finished_child = None
+
+        for event, element in etree.iterparse(
+            f, events=("start", "end", "start-ns"), huge_tree=True
+        ):
+            if event == "start-ns":
+                if subtree is None:
+                    ns_decl.append(element)
+                continue
+            if subtree is not None:
+                if event == "start":
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        parent = stack[-1]
+                        holder = etree.Element("tmp", nsmap=parent.element.nsmap)
+                        holder.append(element)
+                        self._spreadsheet_process(holder, debug, outer)
+                        x = etree.tostring(holder, encoding="unicode")
+                        if x.endswith("</tmp>"):
+                            x = x[x.index(">") + 1 : -6]
+                            write(parent, x.replace("<tmp>", "").replace("</tmp>", ""))
+                        subtree = None
+                continue
+            if event == "start":
+                if stack:
+                    flush(stack[-1])
+                if stack and not _local_name(element.tag) in STREAM_TAGS:
+                    subtree = element
+                    depth = 1
+                    ns_decl = []
+                    continue
+                frame = _StreamFrame(element, len(out))
+                out.append("")
+                if stack and stack[-1].skip:
+                    frame.skip = True
+                    frame.hidden = True
+                if _local_name(element.tag) == "table":
+                    frame.drop_tail = True
+                    write(frame, self.zer_row_col())
+                    if self.process_tables != None and not frame.skip:
+                        if not attr_get(element.attrib, "name") in self.process_tables:
+                            out.append("<tmp/>")
+                            frame.skip = True
+                if not frame.skip:
+                    tag = "<" + qname(element, element.tag)
+                    for prefix, uri in ns_decl:
+                        if prefix:
+                            tag += ' xmlns:%s="%s"' % (prefix, _escape_attr(uri))
+                        else:
+                            tag += ' xmlns="%s"' % _escape_attr(uri)
+                    for key, value in element.attrib.items():
+                        tag += ' %s="%s"' % (qname(element, key), _escape_attr(value))
+                    out.append(tag)
+                    frame.closed = False
+                ns_decl = []
+                stack.append(frame)
+            else:
+                frame = stack.pop()
+                if frame.closed:
+                    flush(frame)
+                    write(frame, "</" + qname(element, element.tag) + ">")
+                else:
+                    if element.text:
+                        flush(frame)
+                        write(frame, "</" + qname(element, element.tag) + ">")
+                    else:
+                        out.append("/>")
+                        frame.closed = True
+                if stack:
+                    parent = stack[-1]
+                    parent.finished_child = element
+                    parent.finished_drop_tail = frame.drop_tail
+                    parent.finished_suffix = frame.suffix
+                else:
+                    out.append(frame.suffix)
+        return "".join(out)
+
+    def compile_template(self, doc_str):
+        """Return compiled template or None - then process_template is used to
+        render every document"""
+        return None
+
+    def render_template(self, template, context):
+        return template.render(context)
+
     def process_template(self, doc_str, context):
         pass
 
@@ -251,55 +571,89 @@ class OdfDocTransform:
             "utf-8"
         )
 
-    def process(self, context, debug):
-        """Transform input file
+    def prepare_content(self, context, debug):
+        """Return content.xml of template prepared for template engine
 
         Args:
             context - python dict with variables used for transformation
-            debut - print debug information
+            debug - print debug information
         """
-        shutil.copyfile(self.file_name_in, self.file_name_out)
-        z = ZipFile(self.file_name_out, "r")
-        doc_content = z.read("content.xml").decode("utf-8")
-        z.close()
-
-        if (
-            delete_from_zip(
-                self.file_name_out,
-                [
-                    "content.xml",
-                ],
-            )
-            == 0
-        ):
-            return
-
-        doc = etree.fromstring(
-            doc_content.replace("&apos;", "'")
-            .replace("_start_", "{{")
-            .replace("_end_", "}}")
-            .encode("utf-8")
+        stream = (
+            self.doc_type == 1
+            and type(self).spreadsheet_process == OdfDocTransform.spreadsheet_process
         )
+        z = ZipFile(self.file_name_in, "r")
+        if stream:
+            with z.open("content.xml") as f:
+                doc_str = self.spreadsheet_stream_process(ReplaceReader(f), debug)
+            z.close()
+        else:
+            doc_content = z.read("content.xml").decode("utf-8")
+            z.close()
+            doc = etree.fromstring(
+                doc_content.replace("&apos;", "'")
+                .replace("_start_", "{{")
+                .replace("_end_", "}}")
+                .encode("utf-8")
+            )
 
-        if self.doc_type == 1:
-            self.spreadsheet_process(doc, debug)
-        if self.doc_type == 2:
-            self.doc_process(doc, debug)
+            if self.doc_type == 1:
+                self.spreadsheet_process(doc, debug)
+            if self.doc_type == 2:
+                self.doc_process(doc, debug)
 
-        doc_str = (
-            etree.tostring(doc, encoding="utf-8", xml_declaration=True)
-            .decode("utf-8")
-            .replace("<tmp>", "")
-            .replace("</tmp>", "")
-        )
+            doc_str = (
+                etree.tostring(doc, encoding="utf-8", xml_declaration=True)
+                .decode("utf-8")
+                .replace("<tmp>", "")
+                .replace("</tmp>", "")
+            )
 
         p = re.compile("\^(.*?\(.*?\))")
         doc_str = p.sub(r"${\1}", doc_str)
 
         if "expr_escape" in context:
             doc_str = doc_str.replace("{{", "{% expr_escape ").replace("}}", " %}")
+        return doc_str
+
+    def cache_key(self, context, debug):
+        """Return key of prepared template in template_cache or None if template
+        should not be cached"""
+        if not self.use_cache:
+            return None
+        process_tables = self.process_tables
+        if process_tables != None:
+            process_tables = tuple(process_tables)
+        return template_cache.key(
+            self.file_name_in,
+            type(self),
+            self.doc_type,
+            process_tables,
+            bool(debug),
+            "expr_escape" in context,
+        )
+
+    def process(self, context, debug):
+        """Transform input file
+
+        Args:
+            context - python dict with variables used for transformation
+            debut - print debug information
+        """
+        key = self.cache_key(context, debug)
+        cached = template_cache.get(key) if key else None
+        if cached:
+            doc_str, template = cached
+        else:
+            doc_str = self.prepare_content(context, debug)
+            template = self.compile_template(doc_str)
+            if key:
+                template_cache.put(key, (doc_str, template))
 
-        x = self.process_template(doc_str, context)
+        if template != None:
+            x = self.render_template(template, context)
+        else:
+            x = self.process_template(doc_str, context)
         if not x:
             x = doc_str
 
@@ -328,13 +682,10 @@ class OdfDocTransform:
             for pos in context["extended_transformations"]:
                 self.extended_transformation(pos[0], pos[1])
 
-        z = ZipFile(self.file_name_out, "a", ZIP_DEFLATED)
-        z.writestr("content.xml", self.buf.encode("utf-8"))
-
+        new_files = {"content.xml": self.buf.encode("utf-8")}
         for pos in files:
-            z.writestr(pos[0], base64.b64decode(pos[1].encode("utf-8")))
-
-        z.close()
+            new_files[pos[0]] = base64.b64decode(pos[1].encode("utf-8"))
+        rewrite_zip(self.file_name_in, self.file_name_out, new_files)
 
         return 1
 
@@ -22,10 +22,12 @@
 """
 
 import zipfile
-import shutil
 import os
 import sys
+import copy
 import datetime
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
 import dateutil.parser
 
@@ -39,10 +41,12 @@ import email.generator
 from django.template import Context
 from django.template import Template
 
-from pytigon_lib.schspreadsheet.odf_process import OdfDocTransform
-from pytigon_lib.schfs.vfstools import delete_from_zip
+from pytigon_lib.schspreadsheet.odf_process import OdfDocTransform, template_cache
+from pytigon_lib.schfs.vfstools import rewrite_zip
 
 SECTION_WIDTH = ord("Z") - ord("A") + 1
+# max number of worker processes of the pool shared by all transformations
+MAX_SHEET_PROCESSES = os.cpu_count() or 1
 
 
 def transform_str(s):
@@ -111,6 +115,57 @@ def date_to_float(d):
     return dt.days + dt.seconds / 86400
 
 
+_SHEET_EXECUTOR = None
+_SHEET_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_sheet_executor():
+    """Return pool of MAX_SHEET_PROCESSES processes shared by all transformations,
+    created on first use"""
+    global _SHEET_EXECUTOR
+    with _SHEET_EXECUTOR_LOCK:
+        if _SHEET_EXECUTOR is None:
+            _SHEET_EXECUTOR = ProcessPoolExecutor(max_workers=MAX_SHEET_PROCESSES)
+        return _SHEET_EXECUTOR
+
+
+def shutdown_sheet_executor():
+    global _SHEET_EXECUTOR
+    with _SHEET_EXECUTOR_LOCK:
+        if _SHEET_EXECUTOR:
+            _SHEET_EXECUTOR.shutdown()
+            _SHEET_EXECUTOR = None
+
+
+def _split(tab, parts):
+    """Split list to parts (lists of neighbouring elements)"""
+    size, rest = divmod(len(tab), parts)
+    ret = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (1 if i < rest else 0)
+        ret.append(tab[start:end])
+        start = end
+    return ret
+
+
+def _prepare_sheets(transform, sheets):
+    ret = []
+    for sheet_str, comments in sheets:
+        transform.comments = comments
+        ret.append(transform.prepare_sheet(etree.XML(sheet_str)))
+    return ret
+
+
+def _repair_sheets(transform, sheet_strs):
+    ret = []
+    for sheet_str in sheet_strs:
+        root = etree.XML(sheet_str)
+        transform.repair_xml(root)
+        ret.append(etree.tostring(root, pretty_print=True))
+    return ret
+
+
 class OOXmlDocTransform(OdfDocTransform):
     """Transformate odf file"""
 
@@ -119,7 +174,8 @@ class OOXmlDocTransform(OdfDocTransform):
 
         Args:
             file_name_in - input file name
-            file_name_out - output file name - if none output file name is composed from input file name.
+            file_name_out - output file name or writable file-like object - if none
+            output file name is composed from input file name.
         """
         super().__init__(file_name_in, file_name_out)
 
@@ -133,17 +189,61 @@ class OOXmlDocTransform(OdfDocTransform):
         self.to_update = None
         self.shared_strings = {}
         self.comments = {}
+        self.sheet_processes = 0
 
     def doc_process(self, doc, debug):
         pass
 
+    def set_sheet_processes(self, processes):
+        """Process sheets of workbook in pool of processes
+
+        Args:
+            processes - number of worker processes, 0 or 1 - process sheets in current
+            process. Can be also set by "sheet_processes" key of context.
+        """
+        self.sheet_processes = processes
+
+    def worker_copy(self):
+        """Return copy of object sent to worker processes: without opened files and
+        output, but with shared strings, so they are sent once for group of sheets"""
+        ret = copy.copy(self)
+        ret.zip_file = None
+        ret.to_update = None
+        ret.file_name_out = None
+        ret.buf = None
+        return ret
+
+    def map_sheets(self, sheet_executor, fun, items):
+        """Call fun(worker copy of self, group of items) in processes of sheet_executor
+        for groups of items and return list of results in order of items
+
+        Args:
+            sheet_executor - (executor, number of processes) returned by sheet_executor
+            fun - _prepare_sheets or _repair_sheets
+            items - list of arguments
+        """
+        executor, processes = sheet_executor
+        transform = self.worker_copy()
+        futures = [
+            executor.submit(fun, transform, group)
+            for group in _split(items, processes)
+            if group
+        ]
+        ret = []
+        for future in futures:
+            ret.extend(future.result())
+        return ret
+
     def get_xml_content(self, xml_name):
         xml = None
-        for pos in self.to_update:
+        for i, pos in enumerate(self.to_update):
             if xml_name == pos[0]:
                 xml = pos[1]
+                if isinstance(xml, bytes):
+                    xml = etree.XML(xml)
+                    self.to_update[i] = (xml_name, xml)
                 break
-        if xml:
+        if xml is not None:
             return {"data": xml, "from_cache": True}
 
         content = self.zip_file.read(xml_name)
@@ -365,15 +465,158 @@ class OOXmlDocTransform(OdfDocTransform):
                 if v != None:
                     pos.remove(v)
 
-    def handle_sheet(self, sheet, django_context):
+    def prepare_sheet(self, sheet):
         self.shared_strings_to_inline(sheet)
         self.add_comments(sheet)
-        sheet_str = etree.tostring(sheet, pretty_print=True).decode("utf-8")
-        sheet_str = self.process_template(sheet_str, django_context)
+        return etree.tostring(sheet, pretty_print=True).decode("utf-8")
+
+    def render_sheet(self, sheet_str, template, django_context):
+        if template != None:
+            sheet_str = self.render_template(template, django_context)
+        else:
+            sheet_str = self.process_template(sheet_str, django_context)
         root = etree.XML(sheet_str)
         self.repair_xml(root)
         return root
 
+    def handle_sheet(self, sheet, django_context):
+        sheet_str = self.prepare_sheet(sheet)
+        return self.render_sheet(
+            sheet_str, self.compile_template(sheet_str), django_context
+        )
+
+    def read_sheets(self, context):
+        """Read shared strings and return list of sheets to process: (sheet_name,
+        sheet_str, comments, comments_name, comments_str)"""
+        try:
+            shared_strings_str = self.zip_file.read("xl/sharedStrings.xml")
+            root = etree.XML(shared_strings_str)
+            d2 = root.findall(".//si", namespaces=root.nsmap)
+            self.shared_strings = [
+                transform_str(
+                    etree.tostring(pos, method="text", encoding="utf-8").decode("utf-8")
+                )
+                for pos in d2
+            ]
+        except:
+            # no shared strings
+            self.shared_strings = []
+        ret = []
+        id = 1
+        while True:
+            if "no_process_sheets" in context and id in context["no_process_sheets"]:
+                id += 1
+                continue
+            try:
+                sheet_name = "xl/worksheets/sheet%d.xml" % id
+                sheet_str = self.zip_file.read(sheet_name)
+                comments = {}
+                comments_name = None
+                comments_str = None
+                try:
+                    sheet_rels_name = "xl/worksheets/_rels/sheet%d.xml.rels" % id
+                    sheet_rels_str = self.zip_file.read(sheet_rels_name)
+                    root = etree.XML(sheet_rels_str)
+                    d1 = root.findall(".//{*}Relationship", namespaces=root.nsmap)
+                    d2 = filter_attr(
+                        d1,
+                        "Type",
+                        "http://schemas.openxmlformats.org/officeDocument/2006/relationships/comments",
+                    )
+                    if len(d2) > 0:
+                        name = os.path.normpath(
+                            "xl/worksheets/" + d2[0].attrib["Target"]
+                        ).replace("\\", "/")
+                        comments_str = self.zip_file.read(name)
+                        root = etree.XML(comments_str)
+                        d1 = root.findall(".//{*}comment", namespaces=root.nsmap)
+                        for pos in d1:
+                            ref = pos.attrib["ref"]
+                            d2 = pos.findall(
+                                ".//{*}text/{*}r/{*}t", namespaces=root.nsmap
+                            )
+                            for pos2 in d2:
+                                if "{{" in pos2.text or "{%" in pos2.text:
+                                    comments[ref] = pos2.text
+                                    comment = pos2.getparent().getparent().getparent()
+                                    comment_list = comment.getparent()
+                                    comment_list.remove(comment)
+                        comments_str = etree.tostring(root)
+                        comments_name = name
+                except KeyError:
+                    pass
+
+                ret.append(
+                    (sheet_name, sheet_str, comments, comments_name, comments_str)
+                )
+            except KeyError:
+                break
+            id += 1
+        return ret
+
+    def prepare_sheets(self, sheets, executor=None):
+        """Return list of prepared sheets: (sheet_name, sheet_str, template,
+        comments_name, comments_str)
+
+        Args:
+            sheets - list returned by read_sheets
+            executor - value returned by sheet_executor or None
+        """
+        if executor:
+            sheet_strs = self.map_sheets(
+                executor, _prepare_sheets, [(pos[1], pos[2]) for pos in sheets]
+            )
+        else:
+            sheet_strs = []
+            for pos in sheets:
+                self.comments = pos[2]
+                sheet_strs.append(self.prepare_sheet(etree.XML(pos[1])))
+        return [
+            (pos[0], sheet_str, self.compile_template(sheet_str), pos[3], pos[4])
+            for pos, sheet_str in zip(sheets, sheet_strs)
+        ]
+
+    def sheet_executor(self, context, sheet_count):
+        """Return (shared pool of processes, number of processes to use) or None if
+        sheets should be processed in current process"""
+        processes = context.get("sheet_processes", self.sheet_processes)
+        if not processes or processes < 2 or sheet_count < 2:
+            return None
+        return (
+            get_sheet_executor(),
+            min(processes, sheet_count, MAX_SHEET_PROCESSES),
+        )
+
+    def prepare_docs(self, doc_type):
+        """Return list of prepared docx/pptx parts: (doc_name, doc_str, template)"""
+        if doc_type == "docx":
+            doc_names = ["word/document.xml"]
+        else:
+            doc_names = []
+            id = 1
+            while "ppt/slides/slide%d.xml" % id in self.zip_file.namelist():
+                doc_names.append("ppt/slides/slide%d.xml" % id)
+                id += 1
+        ret = []
+        for doc_name in doc_names:
+            doc_str = self.zip_file.read(doc_name).decode("utf-8")
+            ret.append((doc_name, doc_str, self.compile_template(doc_str)))
+        return ret
+
+    def cache_key(self, context, debug):
+        if not self.use_cache:
+            return None
+        if "no_process_sheets" in context:
+            no_process_sheets = tuple(sorted(context["no_process_sheets"]))
+        else:
+            no_process_sheets = None
+        return template_cache.key(
+            self.file_name_in,
+            type(self),
+            context.get("doc_type", "xlsx"),
+            no_process_sheets,
+        )
+
     def process(self, context, debug):
         """Transform input file
 
@@ -387,124 +630,74 @@ class OOXmlDocTransform(OdfDocTransform):
             xlsx = False
         else:
             xlsx = True
-        shutil.copyfile(self.file_name_in, self.file_name_out)
         self.to_update = []
-        self.zip_file = zipfile.ZipFile(self.file_name_out, "r")
+        self.zip_file = zipfile.ZipFile(self.file_name_in, "r")
+        key = self.cache_key(context, debug)
         if xlsx:
-            try:
-                shared_strings_str = self.zip_file.read("xl/sharedStrings.xml")
-                root = etree.XML(shared_strings_str)
-                d2 = root.findall(".//si", namespaces=root.nsmap)
-                self.shared_strings = [
-                    transform_str(
-                        etree.tostring(pos, method="text", encoding="utf-8").decode(
-                            "utf-8"
-                        )
-                    )
-                    for pos in d2
-                ]
-            except:
-                # no shared strings
-                self.shared_strings = []
-            id = 1
-            while True:
-                if (
-                    "no_process_sheets" in context
-                    and id in context["no_process_sheets"]
-                ):
-                    id += 1
-                    continue
-                try:
-                    sheet_name = "xl/worksheets/sheet%d.xml" % id
-                    sheet_str = self.zip_file.read(sheet_name)
-                    sheet = etree.XML(sheet_str)
-                    self.comments = {}
-                    try:
-                        sheet_rels_name = "xl/worksheets/_rels/sheet%d.xml.rels" % id
-                        sheet_rels_str = self.zip_file.read(sheet_rels_name)
-                        root = etree.XML(sheet_rels_str)
-                        d1 = root.findall(".//{*}Relationship", namespaces=root.nsmap)
-                        d2 = filter_attr(
-                            d1,
-                            "Type",
-                            "http://schemas.openxmlformats.org/officeDocument/2006/relationships/comments",
-                        )
-                        if len(d2) > 0:
-                            comments_name = os.path.normpath(
-                                "xl/worksheets/" + d2[0].attrib["Target"]
-                            ).replace("\\", "/")
-                            comments_str = self.zip_file.read(comments_name)
-                            root = etree.XML(comments_str)
-                            d1 = root.findall(".//{*}comment", namespaces=root.nsmap)
-                            for pos in d1:
-                                ref = pos.attrib["ref"]
-                                d2 = pos.findall(
-                                    ".//{*}text/{*}r/{*}t", namespaces=root.nsmap
-                                )
-                                for pos2 in d2:
-                                    if "{{" in pos2.text or "{%" in pos2.text:
-                                        self.comments[ref] = pos2.text
-                                        comment = (
-                                            pos2.getparent().getparent().getparent()
-                                        )
-                                        comment_list = comment.getparent()
-                                        comment_list.remove(comment)
-                            self.to_update.append((comments_name, root))
-                    except KeyError:
-                        pass
-
-                    sheet2 = self.handle_sheet(sheet, django_context)
-                    self.to_update.append((sheet_name, sheet2))
-                except KeyError:
-                    break
-                id += 1
+            sheets = template_cache.get(key) if key else None
+            if sheets is None:
+                sheets = self.read_sheets(context)
+                executor = self.sheet_executor(context, len(sheets))
+                sheets = self.prepare_sheets(sheets, executor)
+                if key:
+                    template_cache.put(key, sheets)
+            else:
+                executor = self.sheet_executor(context, len(sheets))
+            if executor:
+                rendered = []
+                for pos in sheets:
+                    if pos[2] != None:
+                        rendered.append(self.render_template(pos[2], django_context))
+                    else:
+                        rendered.append(self.process_template(pos[1], django_context))
+                repaired = self.map_sheets(executor, _repair_sheets, rendered)
+            else:
+                repaired = [None] * len(sheets)
+            for pos, sheet2 in zip(sheets, repaired):
+                sheet_name, sheet_str, template, comments_name, comments_str = pos
+                if comments_name:
+                    self.to_update.append((comments_name, etree.XML(comments_str)))
+                if sheet2 is None:
+                    sheet2 = self.render_sheet(sheet_str, template, django_context)
+                self.to_update.append((sheet_name, sheet2))
             if "extended_transformations" in django_context:
                 for pos in django_context["extended_transformations"]:
                     self.extended_transformation(pos[0], pos[1])
 
             self.zip_file.close()
-            delete_from_zip(self.file_name_out, [pos[0] for pos in self.to_update])
-            z = zipfile.ZipFile(self.file_name_out, "a", zipfile.ZIP_DEFLATED)
+            new_files = {}
             for pos in self.to_update:
-                z.writestr(
-                    pos[0],
-                    etree.tostring(pos[1], pretty_print=True)
-                    .decode("utf-8")
-                    .replace("<tmp>", "")
-                    .replace("</tmp>", ""),
+                if isinstance(pos[1], bytes):
+                    data = pos[1]
+                else:
+                    data = etree.tostring(pos[1], pretty_print=True)
+                new_files[pos[0]] = (
+                    data.decode("utf-8").replace("<tmp>", "").replace("</tmp>", "")
                 )
-            z.close()
+            rewrite_zip(self.file_name_in, self.file_name_out, new_files)
         else:
             doc_type = context["doc_type"]
-            if doc_type == "docx":
-                doc_name = "word/document.xml"
-                doc_str = self.zip_file.read(doc_name).decode("utf-8")
-                doc_str = self.process_template(doc_str, django_context)
-                self.to_update.append(doc_name, doc_str)
-            elif doc_type == "pptx":
-                id = 1
-                while True:
-                    doc_name = "ppt/slides/slide%d.xml" % id
-                    try:
-                        doc_str = self.zip_file.read(doc_name).decode("utf-8")
-                        doc_str2 = self.process_template(doc_str, django_context)
-                        if doc_str != doc_str2:
-                            self.to_update.append((doc_name, doc_str2))
-                        id += 1
-                    except KeyError:
-                        break
-            else:
+            if doc_type not in ("docx", "pptx"):
+                self.zip_file.close()
                 return 0
+            docs = template_cache.get(key) if key else None
+            if docs is None:
+                docs = self.prepare_docs(doc_type)
+                if key:
+                    template_cache.put(key, docs)
+            for doc_name, doc_str, template in docs:
+                if template != None:
+                    doc_str2 = self.render_template(template, django_context)
+                else:
+                    doc_str2 = self.process_template(doc_str, django_context)
+                if doc_str != doc_str2:
+                    self.to_update.append((doc_name, doc_str2))
             self.zip_file.close()
-            if self.to_update:
-                delete_from_zip(
-                    self.file_name_out,
-                    [item[0] for item in self.to_update],
-                )
-                z = zipfile.ZipFile(self.file_name_out, "a", zipfile.ZIP_DEFLATED)
-                for item in self.to_update:
-                    z.writestr(item[0], item[1].encode("utf-8"))
-                z.close()
+            rewrite_zip(
+                self.file_name_in,
+                self.file_name_out,
+                dict((item[0], item[1].encode("utf-8")) for item in self.to_update),
+            )
 
         return 1
 
@@ -0,0 +1,329 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Pytigon - wxpython and django application framework
+
+# author: "Slawomir Cholaj (slawomir.cholaj@gmail.com)"
+# copyright: "Copyright (C) ????/2019 Slawomir Cholaj"
+# license: "LGPL 3.0"
+# version: "0.1a"
+
+"""Streaming export of large data sets to xlsx and ods files.
+
+Template is a normal xlsx/ods file. In the first sheet: header_rows rows are copied to
+the output, the next row is an example data row - styles of its cells are used for
+columns of data rows. Other rows of the sheet are removed. Data rows are written to
+the output zip incrementally, so memory usage doesn't depend on number of rows.
+
+Example:
+    writer = XlsxStreamWriter("export.xlsx", header_rows=1)
+    writer.write(response, Person.objects.values_list("name", "age").iterator())
+"""
+
+import datetime
+import decimal
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    from lxml import etree
+except:
+    pass
+
+from zipfile import ZipFile
+
+from pytigon_lib.schfs.vfstools import rewrite_zip
+
+ROWS_MARKER = "pytigon_stream_rows"
+FLUSH_ROWS = 1000
+
+TABLE_URN = "{urn:oasis:names:tc:opendocument:xmlns:table:1.0}"
+
+
+def _col_name(col):
+    """Return name of column: 0 -> A, 26 -> AA"""
+    ret = ""
+    col += 1
+    while col > 0:
+        col, rem = divmod(col - 1, 26)
+        ret = chr(ord("A") + rem) + ret
+    return ret
+
+
+def _col_index(addr):
+    col = 0
+    for c in addr:
+        if c.isalpha():
+            col = col * 26 + ord(c.upper()) - ord("A") + 1
+        else:
+            break
+    return col - 1
+
+
+def _qname(element, key):
+    if key.startswith("{"):
+        uri, name = key[1:].split("}")
+        for prefix, uri2 in element.nsmap.items():
+            if uri2 == uri and prefix:
+                return prefix + ":" + name
+        if uri == "http://www.w3.org/XML/1998/namespace":
+            return "xml:" + name
+    return key
+
+
+def _date_to_float(d):
+    if not isinstance(d, datetime.datetime):
+        d = datetime.datetime(d.year, d.month, d.day)
+    dt = d.replace(tzinfo=None) - datetime.datetime(1899, 12, 30)
+    return dt.days + dt.seconds / 86400
+
+
+def _split_xml(root, marker):
+    """Serialize root and split result at marker comment"""
+    xml = etree.tostring(root, encoding="utf-8", xml_declaration=True, standalone=True)
+    prefix, suffix = xml.split(b"<!--" + marker.encode("utf-8") + b"-->")
+    return prefix, suffix
+
+
+class SpreadsheetStreamWriter:
+    """Base class of streaming writers"""
+
+    sheet_name = None
+
+    def __init__(self, template_name, header_rows=1, fields=None):
+        """Constructor
+
+        Args:
+            template_name - template file name
+            header_rows - number of rows of template copied to output
+            fields - None if rows are sequences of values, otherwise list of attribute
+            names or functions (object -> value) used to get values from row objects
+        """
+        self.template_name = template_name
+        self.header_rows = header_rows
+        self.fields = fields
+        self.styles = []
+        self.row_attrs = ""
+
+    def get_values(self, row):
+        if self.fields is None:
+            return row
+        ret = []
+        for field in self.fields:
+            if callable(field):
+                ret.append(field(row))
+            else:
+                ret.append(getattr(row, field))
+        return ret
+
+    def prepare(self, content):
+        """Return (prefix, suffix) of sheet xml - data rows are written between them"""
+        pass
+
+    def row_xml(self, row_no, values):
+        pass
+
+    def write_rows(self, f, prefix, suffix, rows):
+        f.write(prefix)
+        buf = []
+        row_no = self.header_rows
+        for row in rows:
+            row_no += 1
+            buf.append(self.row_xml(row_no, self.get_values(row)))
+            if len(buf) >= FLUSH_ROWS:
+                f.write("".join(buf).encode("utf-8"))
+                buf = []
+        if buf:
+            f.write("".join(buf).encode("utf-8"))
+        f.write(suffix)
+
+    def write(self, output, rows):
+        """Write document with data rows
+
+        Args:
+            output - output file name or writable file-like object
+            rows - iterable of rows, for example QuerySet.values_list().iterator()
+        """
+        z = ZipFile(self.template_name, "r")
+        try:
+            content = z.read(self.sheet_name)
+        finally:
+            z.close()
+        prefix, suffix = self.prepare(content)
+
+        def _write(f):
+            self.write_rows(f, prefix, suffix, rows)
+
+        rewrite_zip(self.template_name, output, {self.sheet_name: _write})
+        return 1
+
+
+class XlsxStreamWriter(SpreadsheetStreamWriter):
+    """Streaming writer of xlsx files, data are written to the first sheet"""
+
+    sheet_name = "xl/worksheets/sheet1.xml"
+
+    def __init__(self, template_name, header_rows=1, fields=None):
+        super().__init__(template_name, header_rows, fields)
+        self.col_names = []
+
+    def prepare(self, content):
+        root = etree.XML(content)
+        ns = root.nsmap.get(None)
+        prefix = "{%s}" % ns if ns else ""
+        sheet_data = root.find(prefix + "sheetData")
+        rows = list(sheet_data.iterchildren(prefix + "row"))
+        if len(rows) > self.header_rows:
+            style_row = rows[self.header_rows]
+            self.row_attrs = "".join(
+                " %s=%s" % (_qname(style_row, key), quoteattr(value))
+                for key, value in style_row.attrib.items()
+                if key not in ("r", "spans")
+            )
+            for c in style_row.iterchildren(prefix + "c"):
+                if "r" in c.attrib:
+                    col = _col_index(c.attrib["r"])
+                else:
+                    col = len(self.styles)
+                while len(self.styles) < col:
+                    self.styles.append(None)
+                self.styles.append(c.attrib.get("s"))
+        for row in rows[self.header_rows :]:
+            sheet_data.remove(row)
+        sheet_data.append(etree.Comment(ROWS_MARKER))
+        dimension = root.find(prefix + "dimension")
+        if dimension is not None:
+            root.remove(dimension)
+        return _split_xml(root, ROWS_MARKER)
+
+    def cell_xml(self, addr, style, value):
+        if value is None:
+            return ""
+        attrs = ' r="%s"' % addr
+        if style:
+            attrs += ' s="%s"' % style
+        if isinstance(value, bool):
+            return '<c%s t="b"><v>%d</v></c>' % (attrs, value)
+        if isinstance(value, (int, float, decimal.Decimal)):
+            return "<c%s><v>%s</v></c>" % (attrs, value)
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            return "<c%s><v>%s</v></c>" % (attrs, repr(_date_to_float(value)))
+        return '<c%s t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (
+            attrs,
+            escape(str(value)),
+        )
+
+    def row_xml(self, row_no, values):
+        styles = self.styles
+        col_names = self.col_names
+        row_str = str(row_no)
+        cells = []
+        for i, value in enumerate(values):
+            if i >= len(col_names):
+                col_names.append(_col_name(i))
+            cells.append(
+                self.cell_xml(
+                    col_names[i] + row_str,
+                    styles[i] if i < len(styles) else None,
+                    value,
+                )
+            )
+        return '<row r="%d"%s>%s</row>' % (row_no, self.row_attrs, "".join(cells))
+
+
+class OdsStreamWriter(SpreadsheetStreamWriter):
+    """Streaming writer of ods files, data are written to the first table"""
+
+    sheet_name = "content.xml"
+
+    def prepare(self, content):
+        root = etree.XML(content)
+        table = next(root.iter(TABLE_URN + "table"))
+        rows = list(table.iter(TABLE_URN + "table-row"))
+        if len(rows) > self.header_rows:
+            style_row = rows[self.header_rows]
+            style = style_row.attrib.get(TABLE_URN + "style-name")
+            if style:
+                self.row_attrs = " table:style-name=%s" % quoteattr(style)
+            for cell in style_row:
+                repeated = int(cell.attrib.get(TABLE_URN + "number-columns-repeated", 1))
+                style = cell.attrib.get(TABLE_URN + "style-name")
+                self.styles.extend([style] * min(repeated, 256))
+        for row in rows[self.header_rows :]:
+            row.getparent().remove(row)
+        if self.header_rows > 0 and len(rows) > 0:
+            last = rows[min(self.header_rows, len(rows)) - 1]
+            # data rows can't be placed in table:table-header-rows
+            while last.getparent() is not table:
+                last = last.getparent()
+            last.addnext(etree.Comment(ROWS_MARKER))
+        else:
+            columns = list(table.iter(TABLE_URN + "table-column"))
+            if columns:
+                columns[-1].addnext(etree.Comment(ROWS_MARKER))
+            else:
+                table.insert(0, etree.Comment(ROWS_MARKER))
+        return _split_xml(root, ROWS_MARKER)
+
+    def cell_xml(self, style, value):
+        if style:
+            attrs = " table:style-name=%s" % quoteattr(style)
+        else:
+            attrs = ""
+        if value is None:
+            return "<table:table-cell%s/>" % attrs
+        if isinstance(value, bool):
+            attrs += ' office:value-type="boolean" office:boolean-value="%s"' % (
+                "true" if value else "false"
+            )
+        elif isinstance(value, (int, float, decimal.Decimal)):
+            attrs += ' office:value-type="float" office:value="%s"' % value
+        elif isinstance(value, datetime.datetime):
+            attrs += ' office:value-type="date" office:date-value="%s"' % value.replace(
+                tzinfo=None, microsecond=0
+            ).isoformat()
+        elif isinstance(value, datetime.date):
+            attrs += ' office:value-type="date" office:date-value="%s"' % (
+                value.isoformat()
+            )
+        else:
+            attrs += ' office:value-type="string"'
+        return "<table:table-cell%s><text:p>%s</text:p></table:table-cell>" % (
+            attrs,
+            escape(str(value)),
+        )
+
+    def row_xml(self, row_no, values):
+        styles = self.styles
+        cells = []
+        for i, value in enumerate(values):
+            cells.append(self.cell_xml(styles[i] if i < len(styles) else None, value))
+        return "<table:table-row%s>%s</table:table-row>" % (
+            self.row_attrs,
+            "".join(cells),
+        )
+
+
+def write_rows(template_name, output, rows, header_rows=1, fields=None):
+    """Write rows to xlsx or ods file, type of writer is chosen by template extension
+
+    Args:
+        template_name - xlsx or ods template
+        output - output file name or writable file-like object
+        rows - iterable of rows
+        header_rows - number of rows of template copied to output
+        fields - see SpreadsheetStreamWriter
+    """
+    if template_name.lower().endswith(".ods"):
+        writer = OdsStreamWriter(template_name, header_rows, fields)
+    else:
+        writer = XlsxStreamWriter(template_name, header_rows, fields)
+    return writer.write(output, rows)
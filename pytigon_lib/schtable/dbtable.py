@@ -18,7 +18,15 @@
 # version: "0.1a"
 
 
+import json
+import operator
+import threading
+import time
+from collections import OrderedDict
+
 import django.apps.registry
+from django.db import connections, transaction
+from django.db.models import Q
 
 from pytigon_lib.schtable import table
 from pytigon_lib.schtools import schjson
@@ -85,6 +93,82 @@ __COLSIZE__ = {
 }
 
 
+PAGE_SIZE = 256
+# number of (sort, filter) pairs for which boundaries of pages are remembered
+KEYSET_CACHE_SIZE = 16
+# seconds, boundaries of pages older than that are not used (rows could be changed
+# outside of DbTable)
+KEYSET_CACHE_TIMEOUT = 30
+
+# approximate count: planner estimate is used only for large results, smaller are
+# counted exactly
+APPROXIMATE_COUNT_MIN = 100000
+
+
+class PageKeysCache:
+    """Short time cache of boundaries of pages used by keyset pagination.
+
+    Tables are created for every request, boundaries of pages are shared between them:
+    (app, tab) -> (sort, value) -> page number -> sort keys of the last row of page.
+    """
+
+    def __init__(self, timeout=KEYSET_CACHE_TIMEOUT, size=KEYSET_CACHE_SIZE):
+        self.timeout = timeout
+        self.size = size
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get(self, table_key, key, nr):
+        """Return (page number, sort keys) of the nearest known page before page nr
+        or (-1, None)"""
+        with self._lock:
+            pages = self._cache.get(table_key, {}).get(key)
+            if not pages:
+                return -1, None
+            now = time.monotonic()
+            for pos in [pos for pos, x in pages.items() if now - x[0] >= self.timeout]:
+                del pages[pos]
+            prev = max((pos for pos in pages if pos < nr), default=-1)
+            if prev < 0:
+                return -1, None
+            return prev, pages[prev][1]
+
+    def put(self, table_key, key, nr, values):
+        with self._lock:
+            keys = self._cache.setdefault(table_key, OrderedDict())
+            if key in keys:
+                keys.move_to_end(key)
+            else:
+                if len(keys) >= self.size:
+                    keys.popitem(last=False)
+                keys[key] = {}
+            keys[key][nr] = (time.monotonic(), values)
+
+    def invalidate(self, table_key):
+        with self._lock:
+            self._cache.pop(table_key, None)
+
+
+page_keys_cache = PageKeysCache()
+
+
+def _choice_conw(choices):
+    def _conw(value):
+        if value in choices:
+            return str(value) + ":" + choices[value]
+        else:
+            return ""
+
+    return _conw
+
+
+def _foreign_key_conw(value):
+    if value:
+        return str(value.id) + ":" + str(value)
+    else:
+        return ""
+
+
 class DbTable(table.Table):
     def __init__(self, app, tab):
         self.auto_cols = []
@@ -108,6 +192,15 @@ class DbTable(table.Table):
         self.default_rec = self._get_default_rec()
         self.query = None
 
+        self._fields = self.model_class._meta.fields
+        self._fk_names = [
+            field.name
+            for field in self._fields
+            if type(field).__name__ in ("ForeignKey", "HiddenForeignKey")
+        ]
+        self._getters, self._converters = self._get_converters()
+        self.approximate_count = False
+
     def conw_long(self, l):
         if l:
             return int(l)
@@ -188,67 +281,223 @@ class DbTable(table.Table):
             ret.append(size)
         return ret[1:]
 
-    def _set_sort(self, objects, sort):
-        sortobj = objects
-        items = sort.split(",")
-        for item in items:
+    def _get_converters(self):
+        """Return functions which get values of fields from model object and
+        functions which convert them to values of table columns (None - no conversion)"""
+        getters = []
+        converters = []
+        for field in self._fields:
+            if field.choices:
+                getters.append(field.value_from_object)
+                converters.append(_choice_conw(dict(field.choices)))
+            elif type(field).__name__ in ("ForeignKey", "HiddenForeignKey"):
+                getters.append(operator.attrgetter(field.name))
+                converters.append(_foreign_key_conw)
+            else:
+                getters.append(field.value_from_object)
+                converters.append(None)
+        return getters, converters
+
+    def _get_sort_names(self, sort):
+        names = []
+        for item in sort.split(","):
+            if not item:
+                continue
             znak = False
             if item[0] == "-":
                 item = item[1:]
                 znak = True
-            for col in self.model_class._meta.fields:
+            for col in self._fields:
                 if col.verbose_name:
                     colname0 = col.verbose_name
                 else:
                     colname0 = col.name
-                colname1 = col.name
                 if item == colname0:
                     if znak:
-                        colname1 = "-" + colname1
-                    sortobj = sortobj.order_by(colname1)
-        return sortobj
+                        names.append("-" + col.name)
+                    else:
+                        names.append(col.name)
+        return names
 
-    def page(self, nr, sort=None, value=None):
-        if value and value != "":
-            if hasattr(self.model_class, "simple_query"):
-                data = self.model_class.simple_query(value)
-            else:
-                data = self.model_class.objects.all()
-        else:
-            data = self.model_class.objects.all()
+    def _set_sort(self, objects, sort):
+        names = self._get_sort_names(sort)
+        if names:
+            return objects.order_by(*names)
+        return objects
+
+    def _get_keyset(self, data, sort):
+        """Return list of (field, descending) which defines unique order of rows, or
+        None if keyset pagination can't be used for this order"""
         if sort:
-            data = self._set_sort(data, sort)
+            names = self._get_sort_names(sort)
+        elif data.query.order_by:
+            names = list(data.query.order_by)
+        else:
+            names = list(self.model_class._meta.ordering)
+        keyset = []
+        opts = self.model_class._meta
+        for name in names:
+            if not isinstance(name, str):
+                return None
+            desc = name.startswith("-")
+            name = name.lstrip("-")
+            if name == "pk":
+                field = opts.pk
+            else:
+                try:
+                    field = opts.get_field(name)
+                except Exception:
+                    return None
+            # NULL values are not comparable, relations are sorted by related model
+            if field.is_relation or field.null or not field.concrete:
+                return None
+            keyset.append((field, desc))
+        if opts.pk.is_relation:
+            return None
+        if not opts.pk in [pos[0] for pos in keyset]:
+            keyset.append((opts.pk, False))
+        return keyset
+
+    def _seek_filter(self, keyset, values):
+        """Return filter selecting rows after row with sort keys values"""
+        q = None
+        for i, (field, desc) in enumerate(keyset):
+            cond = {}
+            for j in range(i):
+                cond[keyset[j][0].attname] = values[j]
+            if desc:
+                cond[field.attname + "__lt"] = values[i]
+            else:
+                cond[field.attname + "__gt"] = values[i]
+            if q is None:
+                q = Q(**cond)
+            else:
+                q = q | Q(**cond)
+        if len(keyset) > 1:
+            # redundant condition on the first column lets database use its index
+            field, desc = keyset[0]
+            if desc:
+                q = Q(**{field.attname + "__lte": values[0]}) & q
+            else:
+                q = Q(**{field.attname + "__gte": values[0]}) & q
+        return q
+
+    def _fetch(self, data, keyset=None):
+        """Return (rows, sort keys values of the last row)"""
+        converters = self._converters
         tab = []
-        data = data[nr * 256 : (nr + 1) * 256]
-        for rec in data:
-            row = []
-            for field in self.model_class._meta.fields:
-                value = field.value_from_object(rec)
-                if field.choices:
-                    if value in dict(field.choices):
-                        value = str(value) + ":" + dict(field.choices)[value]
+        last = None
+        if self._fk_names:
+            getters = self._getters
+            for rec in data.select_related(*self._fk_names):
+                row = []
+                for get, conw in zip(getters, converters):
+                    if conw:
+                        row.append(conw(get(rec)))
                     else:
-                        value = ""
-                else:
-                    if type(field).__name__ in ("ForeignKey", "HiddenForeignKey"):
-                        value2 = getattr(rec, field.name)
-                        if value2:
-                            value2 = str(value2.id) + ":" + str(value2)
-                        if value == None:
-                            value = "0"
-                        if value2 == None:
-                            value2 = ""
-                        value = str(value2)
-                row.append(value)
-            tab.append(row)
+                        row.append(get(rec))
+                tab.append(row)
+            if keyset and tab:
+                last = [getattr(rec, field.attname) for field, desc in keyset]
+        else:
+            rec = None
+            for rec in data.values_list(*[field.attname for field in self._fields]):
+                row = []
+                for value, conw in zip(rec, converters):
+                    if conw:
+                        row.append(conw(value))
+                    else:
+                        row.append(value)
+                tab.append(row)
+            if keyset and rec:
+                last = [rec[self._fields.index(field)] for field, desc in keyset]
+        return tab, last
+
+    def _get_data(self, value):
+        if value and value != "":
+            if hasattr(self.model_class, "simple_query"):
+                return self.model_class.simple_query(value)
+        return self.model_class.objects.all()
+
+    def page(self, nr, sort=None, value=None):
+        """Return page nr of table.
+
+        Rows are fetched in one query (foreign keys with select_related). If order of
+        rows is unique (primary key is added to sort columns) and sort columns are not
+        nullable, keyset pagination is used: rows of page are selected by sort keys of
+        the last row of the nearest known previous page instead of large OFFSET.
+        """
+        data = self._get_data(value)
+        keyset = self._get_keyset(data, sort)
+        if keyset is None:
+            if sort:
+                data = self._set_sort(data, sort)
+            return self._fetch(data[nr * PAGE_SIZE : (nr + 1) * PAGE_SIZE])[0]
+
+        data = data.order_by(
+            *[("-" if desc else "") + field.attname for field, desc in keyset]
+        )
+        table_key = (self.app, self.tab)
+        key = (sort, value)
+        prev, values = page_keys_cache.get(table_key, key, nr)
+        if prev >= 0:
+            data = data.filter(self._seek_filter(keyset, values))
+        offset = (nr - prev - 1) * PAGE_SIZE
+        tab, last = self._fetch(data[offset : offset + PAGE_SIZE], keyset)
+        if last and len(tab) == PAGE_SIZE:
+            page_keys_cache.put(table_key, key, nr, last)
         return tab
 
     def rec_as_str(self, nr):
         obj = self.model_class.objects.get(id=nr)
         return str(obj)
 
-    def count(self, v):
-        return self.model_class.objects.count()
+    def _estimate_count(self, data):
+        """Return number of rows estimated by database planner or None if database
+        doesn't support it"""
+        connection = connections[data.db]
+        if connection.vendor != "postgresql":
+            return None
+        sql, params = data.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    def count(self, value=None):
+        """Return number of rows selected by filter value"""
+        return self._get_data(value).count()
+
+    def count_approximate(self, value=None):
+        """Return number of rows selected by filter value, large results are estimated
+        by database planner (PostgreSQL) instead of full count.
+        """
+        data = self._get_data(value)
+        try:
+            count = self._estimate_count(data)
+        except Exception:
+            count = None
+        if count != None and count >= APPROXIMATE_COUNT_MIN:
+            return count
+        return data.count()
+
+    def count_cache_key(self):
+        return ("DbTable", self.app, self.tab)
+
+    def _invalidate_caches(self, using=None):
+        """Forget cached page boundaries and counts of table, must be called after
+        modification. Inside transaction caches are cleared again after commit, because
+        until then other connections read old rows and can cache them."""
+
+        def _invalidate():
+            page_keys_cache.invalidate((self.app, self.tab))
+            table.count_cache.invalidate(self.count_cache_key())
+
+        _invalidate()
+        if transaction.get_connection(using).in_atomic_block:
+            transaction.on_commit(_invalidate, using=using)
 
     def insert_rec(self, rec):
         i = 1
@@ -268,6 +517,7 @@ class DbTable(table.Table):
                     field.save_form_data(obj, rec[i])
             i = i + 1
         obj.save()
+        self._invalidate_caches(obj._state.db)
         return None
 
     def update_rec(self, rec):
@@ -288,10 +538,13 @@ class DbTable(table.Table):
                     field.save_form_data(obj, rec[i])
             i = i + 1
         obj.save()
+        self._invalidate_caches(obj._state.db)
 
     def delete_rec(self, nr):
         obj = self.model_class.objects.get(id=nr)
+        db = obj._state.db
         obj.delete()
+        self._invalidate_caches(db)
 
     def auto(self, col_name, col_names, rec):
         pass
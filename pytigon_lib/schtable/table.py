@@ -18,6 +18,12 @@
 # version: "0.1a"
 
 
+import array
+import re
+import threading
+import time
+from collections import OrderedDict
+
 from pytigon_lib.schtools import schjson
 
 CMD_INFO = 1
@@ -28,6 +34,43 @@ CMD_AUTO = 5
 CMD_RECASSTR = 6
 CMD_EXEC = 7
 
+# seconds, grid client asks for number of rows repeatedly while scrolling
+COUNT_CACHE_TIMEOUT = 5
+
+
+class CountCache:
+    """Short time cache of numbers of rows of tables.
+
+    Key of table is returned by Table.count_cache_key, counts are stored for every
+    filter value. Tables invalidate their counts after modification.
+    """
+
+    def __init__(self, timeout=COUNT_CACHE_TIMEOUT):
+        self.timeout = timeout
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, value):
+        with self._lock:
+            counts = self._cache.get(key)
+            if counts and value in counts:
+                t, count = counts[value]
+                if time.monotonic() - t < self.timeout:
+                    return count
+                del counts[value]
+        return None
+
+    def put(self, key, value, count):
+        with self._lock:
+            self._cache.setdefault(key, {})[value] = (time.monotonic(), count)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._cache.pop(key, None)
+
+
+count_cache = CountCache()
+
 
 class Table:
     """Base class for server table interface"""
@@ -38,6 +81,8 @@ class Table:
         self.col_names = ["ID"]
         self.col_types = ["int"]
         self.default_rec = [0]
+        # default for CMD_COUNT without "approximate" parameter
+        self.approximate_count = False
 
     def _info(self):
         return schjson.dumps(
@@ -56,8 +101,23 @@ class Table:
     def _rec_as_str(self, nr):
         return schjson.dumps({"recasstr": self.rec_as_str(nr)})
 
-    def _count(self, value=None):
-        return schjson.dumps({"count": self.count(value)})
+    def _count(self, value=None, approximate=None):
+        if approximate is None:
+            approximate = getattr(self, "approximate_count", False)
+        if approximate:
+            count_fun = self.count_approximate
+        else:
+            count_fun = self.count
+        key = self.count_cache_key()
+        if key is None:
+            count = count_fun(value)
+        else:
+            value_key = (schjson.dumps(value), approximate)
+            count = count_cache.get(key, value_key)
+            if count is None:
+                count = count_fun(value)
+                count_cache.put(key, value_key, count)
+        return schjson.dumps({"count": count})
 
     def _sync(self, update, insert, delete):
         if len(update) > 0:
@@ -87,6 +147,14 @@ class Table:
     def count(self, value):
         pass
 
+    def count_approximate(self, value):
+        """Return number of rows, large results may be estimated, default: exact count"""
+        return self.count(value)
+
+    def count_cache_key(self):
+        """Return key of table in count_cache or None if counts should not be cached"""
+        return None
+
     def rec_as_str(self, nr):
         pass
 
@@ -128,7 +196,11 @@ class Table:
                 value = cmd_dict["value"]
             else:
                 value = None
-            return self._count(value)
+            if "approximate" in cmd_dict:
+                approximate = bool(cmd_dict["approximate"])
+            else:
+                approximate = None
+            return self._count(value, approximate)
         if cmd == CMD_SYNC:
             return self._sync(
                 schjson.loads(cmd_dict["update"]),
@@ -150,62 +222,207 @@ class Table:
         return None
 
 
-def str_cmp(x, y, ts):
-    (id, s) = ts[0]
-    if x[id] > y[id]:
-        return s
-    if x[id] < y[id]:
-        return -1 * s
-    if len(ts) > 1:
-        return str_cmp(x, y, ts[1:])
-    else:
-        return 0
+# array.array type codes for numeric columns of TablePy, other columns are lists
+COLUMN_ARRAY_TYPES = {"int": "q", "long": "q", "double": "d", "float": "d"}
+# python type of values which array.array with type code stores without conversion
+ARRAY_VALUE_TYPES = {"q": int, "d": float}
+# number of (sort, value) pairs for which orders of rows are cached by TablePy
+ORDER_CACHE_SIZE = 32
+
+
+def _fits_column(col, value):
+    """Return True if value can be stored in col and is read back unchanged"""
+    if isinstance(col, array.array):
+        return type(value) is ARRAY_VALUE_TYPES[col.typecode]
+    return True
+
+
+def _make_column(col_type, values):
+    """Return array.array if all values have python type of numeric column, else list,
+    so values (for example bool or None in int column) are never converted"""
+    code = COLUMN_ARRAY_TYPES.get(col_type)
+    if code:
+        value_type = ARRAY_VALUE_TYPES[code]
+        if all(type(value) is value_type for value in values):
+            try:
+                return array.array(code, values)
+            except OverflowError:
+                pass
+    return list(values)
+
+
+def _none_first_key(col):
+    def _key(i):
+        value = col[i]
+        if value is None:
+            return (0, "")
+        return (1, value)
+
+    return _key
+
+
+def _str_key(col):
+    def _key(i):
+        value = col[i]
+        if value is None:
+            return (0, "")
+        return (1, str(value))
+
+    return _key
 
 
 class TablePy(Table):
+    """Table stored in memory column by column.
+
+    Numeric columns with values of one type are kept in array.array, other columns
+    in lists. Sort and filter work on the whole table: orders of rows (lists of row
+    indexes) are cached for ORDER_CACHE_SIZE recently used (sort, value) pairs until
+    the table is modified, so page is a slice of the cached order. ID of row is its
+    index in the table.
+    """
+
     def __init__(self, table, col_names, col_typ, col_length, default_rec):
-        self.tab = table
         self.auto_cols = []
         self.col_length = col_length
         self.col_names = ["ID"] + col_names
         self.col_types = ["int"] + col_typ
         self.default_rec = [0] + default_rec
+        self.tab = table
 
-    def page(self, nr, sort=None, value=None):
-        tab = []
-        i = 0
-        tab2 = self.tab[nr * 256 : (nr + 1) * 256]
-        for rec in tab2:
-            tab.append([nr * 256 + i] + rec)
-            i += 1
+    @property
+    def tab(self):
+        return [list(rec) for rec in zip(*self.columns)]
+
+    @tab.setter
+    def tab(self, table):
+        """Replace all rows of table, table is a list of rows without ID"""
+        self.columns = [
+            _make_column(typ, [rec[i] for rec in table])
+            for i, typ in enumerate(self.col_types[1:])
+        ]
+        self.row_count = len(table)
+        self._orders = OrderedDict()
+
+    def _get_sort(self, sort):
+        ts = []
         if sort != None:
-            s = sort.split(",")
-            ts = []
-            for pos in s:
+            for pos in sort.split(","):
                 if pos != "":
-                    id = 0
-                    ss = 0
                     if pos[0] == "-":
-                        id = self.col_names.index(pos[1:])
-                        ss = -1
+                        ts.append((self.col_names.index(pos[1:]), True))
                     else:
-                        id = self.col_names.index(pos)
-                        ss = 1
-                    ts.append((id, ss))
-            tab.sort(cmp=lambda x, y: str_cmp(x, y, ts))
+                        ts.append((self.col_names.index(pos), False))
+        return tuple(ts)
+
+    def _sort(self, ts):
+        order = list(range(self.row_count))
+        for id, desc in reversed(ts):
+            if id == 0:
+                order.sort(reverse=desc)
+                continue
+            col = self.columns[id - 1]
+            try:
+                if isinstance(col, list) and None in col:
+                    order.sort(key=_none_first_key(col), reverse=desc)
+                else:
+                    order.sort(key=col.__getitem__, reverse=desc)
+            except TypeError:
+                order.sort(key=_str_key(col), reverse=desc)
+        return order
+
+    def _filter(self, order, value):
+        """Return indexes of rows in which regular expression value is found"""
+        try:
+            cmp = re.compile(str(value), re.IGNORECASE)
+        except re.error:
+            cmp = re.compile(re.escape(str(value)), re.IGNORECASE)
+        ret = []
+        columns = self.columns
+        for i in order:
+            for col in columns:
+                value = col[i]
+                if value is not None and cmp.search(str(value)):
+                    ret.append(i)
+                    break
+        return ret
+
+    def _get_cached_order(self, key):
+        order = self._orders.get(key)
+        if order is not None:
+            self._orders.move_to_end(key)
+        return order
+
+    def _put_cached_order(self, key, order):
+        self._orders[key] = order
+        while len(self._orders) > ORDER_CACHE_SIZE:
+            self._orders.popitem(last=False)
+
+    def get_order(self, sort=None, value=None):
+        """Return list of indexes of rows matching value and sorted by sort"""
+        ts = self._get_sort(sort)
+        key = (ts, value or None)
+        order = self._get_cached_order(key)
+        if order is None:
+            if ts:
+                order = self._get_cached_order((ts, None))
+                if order is None:
+                    order = self._sort(ts)
+                    self._put_cached_order((ts, None), order)
+            else:
+                order = range(self.row_count)
+            if value:
+                order = self._filter(order, value)
+            self._put_cached_order(key, order)
+        return order
+
+    def page(self, nr, sort=None, value=None):
+        columns = self.columns
+        tab = []
+        for i in self.get_order(sort, value)[nr * 256 : (nr + 1) * 256]:
+            tab.append([i] + [col[i] for col in columns])
         return tab
 
     def count(self, value=None):
-        return len(self.tab)
+        if value:
+            return len(self.get_order(None, value))
+        return self.row_count
+
+    def _get_column_for(self, col_id, value):
+        """Return column col_id, converted to list if value can't be stored in it"""
+        col = self.columns[col_id]
+        if not _fits_column(col, value):
+            col = self.columns[col_id] = list(col)
+        return col
+
+    def _set(self, col_id, i, value):
+        col = self._get_column_for(col_id, value)
+        try:
+            col[i] = value
+        except OverflowError:
+            col = self.columns[col_id] = list(col)
+            col[i] = value
 
     def insert_rec(self, rec):
-        self.tab.append(rec[1:])
+        for col_id, value in enumerate(rec[1:]):
+            col = self._get_column_for(col_id, value)
+            try:
+                col.append(value)
+            except OverflowError:
+                col = self.columns[col_id] = list(col)
+                col.append(value)
+        self.row_count += 1
+        self._orders = OrderedDict()
 
     def update_rec(self, rec):
-        self.tab[rec[0]] = rec[1:]
+        for col_id, value in enumerate(rec[1:]):
+            self._set(col_id, rec[0], value)
+        self._orders = OrderedDict()
 
     def delete_rec(self, nr):
-        self.tab.pop(nr)
+        for col in self.columns:
+            del col[nr]
+        self.row_count -= 1
+        self._orders = OrderedDict()
 
     def auto(self, col_name, col_names, rec):
         pass
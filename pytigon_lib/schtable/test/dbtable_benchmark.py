@@ -0,0 +1,156 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+# Pytigon - wxpython and django application framework
+
+# author: "Slawomir Cholaj (slawomir.cholaj@gmail.com)"
+# copyright: "Copyright (C) ????/2012 Slawomir Cholaj"
+# license: "LGPL 3.0"
+# version: "0.1a"
+
+"""Benchmark of DbTable.page.
+
+Creates sqlite database with table of rows (one foreign key, one field with choices),
+reads it page by page with the previous version of DbTable.page (copied below:
+OFFSET query, dict(field.choices) and query of related object for every row) and with
+current DbTable.page (keyset pagination, bulk fetch), and checks that both give the
+same rows.
+
+usage: python dbtable_benchmark.py [rows] [pages] [--reuse]
+    --reuse - use database created by previous run
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append("./../../..")
+
+import django
+from django.conf import settings
+
+DB_NAME = os.path.join(tempfile.gettempdir(), "dbtable_benchmark.sqlite3")
+
+settings.configure(
+    INSTALLED_APPS=["__main__"],
+    DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": DB_NAME}},
+    DEFAULT_AUTO_FIELD="django.db.models.AutoField",
+)
+django.setup()
+
+from django.db import connection, models
+
+from pytigon_lib.schtable.dbtable import DbTable, page_keys_cache
+
+
+class Group(models.Model):
+    name = models.CharField(max_length=32)
+
+    def __str__(self):
+        return self.name
+
+
+class Item(models.Model):
+    name = models.CharField(max_length=64, db_index=True)
+    group = models.ForeignKey(Group, on_delete=models.CASCADE)
+    status = models.CharField(
+        max_length=1, choices=(("N", "New"), ("A", "Accepted"), ("C", "Closed"))
+    )
+    active = models.BooleanField(default=True)
+
+
+def create_db(rows):
+    if os.path.exists(DB_NAME):
+        os.remove(DB_NAME)
+    with connection.schema_editor() as editor:
+        editor.create_model(Group)
+        editor.create_model(Item)
+    groups = Group.objects.bulk_create([Group(name="group %d" % i) for i in range(100)])
+    batch = []
+    for i in range(rows):
+        batch.append(
+            Item(
+                name="item %07d" % ((i * 7919) % rows),
+                group=groups[i % 100],
+                status="NAC"[i % 3],
+                active=i % 5 != 0,
+            )
+        )
+        if len(batch) >= 10000:
+            Item.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        Item.objects.bulk_create(batch)
+
+
+# previous version of DbTable.page
+
+
+def legacy_page(self, nr, sort=None, value=None):
+    data = self.model_class.objects.all()
+    if sort:
+        data = self._set_sort(data, sort)
+    else:
+        data = data.order_by("id")
+    tab = []
+    data = data[nr * 256 : (nr + 1) * 256]
+    for rec in data:
+        row = []
+        for field in self.model_class._meta.fields:
+            value = field.value_from_object(rec)
+            if field.choices:
+                if value in dict(field.choices):
+                    value = str(value) + ":" + dict(field.choices)[value]
+                else:
+                    value = ""
+            else:
+                if type(field).__name__ in ("ForeignKey", "HiddenForeignKey"):
+                    value2 = getattr(rec, field.name)
+                    if value2:
+                        value2 = str(value2.id) + ":" + str(value2)
+                    if value == None:
+                        value = "0"
+                    if value2 == None:
+                        value2 = ""
+                    value = str(value2)
+            row.append(value)
+        tab.append(row)
+    return tab
+
+
+def run(rows, pages):
+    if not os.path.exists(DB_NAME) or "--reuse" not in sys.argv:
+        create_db(rows)
+    tab = DbTable("__main__", "Item")
+    last_page = (rows - 1) // 256
+    page_list = list(range(pages)) + list(range(last_page - pages, last_page + 1))
+    results = []
+    for name, fun in (("legacy", legacy_page), ("current", DbTable.page)):
+        for sort in (None, "name"):
+            page_keys_cache.invalidate(("__main__", "Item"))
+            ret = []
+            start = time.perf_counter()
+            for nr in page_list:
+                ret.append(fun(tab, nr, sort))
+            print(
+                "%-8s sort=%-5s %d pages: %8.3fs"
+                % (name, sort, len(page_list), time.perf_counter() - start)
+            )
+            results.append(ret)
+    print("identical output:", results[0] == results[2] and results[1] == results[3])
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    pages = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    run(rows, pages)
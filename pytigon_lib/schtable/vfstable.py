@@ -24,11 +24,14 @@ import sys
 import gettext
 import uuid
 import functools
+import threading
+import time
+from collections import OrderedDict
 
 import fs.path
-from django.core.cache import cache
 from django.core.files.storage import default_storage
 from django.http import HttpResponse
+from django.utils.translation import gettext_noop
 
 # from fs.opener import fsopendir
 from fs.osfs import OSFS
@@ -38,7 +41,7 @@ from pytigon_lib.schtable.table import Table
 
 # from pytigon_lib.schtasks.task import get_process_manager
 from pytigon_lib.schtools import schjson
-from pytigon_lib.schtools.tools import bencode, bdecode, is_null
+from pytigon_lib.schtools.tools import bencode, bdecode
 
 from django_q.tasks import async_task, result
 
@@ -84,6 +87,94 @@ def str_cmp(x, y, ts):
         return 0
 
 
+# seconds, content of folder is read again after this time even if mtime of folder
+# has not changed (sizes and times of files)
+SNAPSHOT_TIMEOUT = 60
+SNAPSHOT_CACHE_SIZE = 32
+# number of (sort, filter value) pairs for which orders of rows are cached by snapshot
+ORDER_CACHE_SIZE = 32
+
+# folder -> FolderSnapshot, in LRU order. Snapshots are shared by requests in all
+# languages, so rows keep untranslated messages, they are translated in VfsTable.page
+_snapshots = OrderedDict()
+_snapshots_lock = threading.Lock()
+
+
+def _sort_group(value):
+    if value == ".." or (type(value) == tuple and value[0] == ".."):
+        return 0
+    if type(value) == tuple:
+        return 1
+    return 2
+
+
+class FolderSnapshot:
+    """Content of folder read once. Orders of rows for sort and filter values are
+    computed for the whole folder and cached.
+    """
+
+    def __init__(self, mtime, rows):
+        self.mtime = mtime
+        self.time = time.monotonic()
+        self.rows = rows
+        self.names = [row[1][0] if type(row[1]) == tuple else row[1] for row in rows]
+        self._sorted = {}
+        self._orders = OrderedDict()
+
+    def is_valid(self, mtime):
+        return (
+            mtime != None
+            and mtime == self.mtime
+            and time.monotonic() - self.time < SNAPSHOT_TIMEOUT
+        )
+
+    def _sort(self, ts):
+        """Return indexes of rows sorted by ts: ((column, 1 or -1), ...), in the same
+        order as sorting with str_cmp"""
+        rows = self.rows
+        order = list(range(len(rows)))
+        try:
+            for id, znak in reversed(ts):
+                # values of different groups (folders are tuples, files are str) are
+                # never compared, reverse changes only order of values inside groups
+                order.sort(
+                    key=lambda i: (_sort_group(rows[i][id]), rows[i][id]),
+                    reverse=znak < 0,
+                )
+                order.sort(key=lambda i: _sort_group(rows[i][id]))
+        except TypeError:
+
+            def _cmp(x, y):
+                return str_cmp(rows[x], rows[y], ts)
+
+            order = sorted(range(len(rows)), key=functools.cmp_to_key(_cmp))
+        return order
+
+    def get_order(self, ts, value=None):
+        """Return list of indexes of rows matching value, sorted by ts"""
+        key = (ts, value)
+        order = self._orders.get(key)
+        if order is not None:
+            self._orders.move_to_end(key)
+        else:
+            if ts:
+                order = self._sorted.get(ts)
+                if order is None:
+                    order = self._sorted[ts] = self._sort(ts)
+            else:
+                order = range(len(self.rows))
+            if value:
+                cmp = re.compile(value, re.IGNORECASE)
+                names = self.names
+                order = [i for i in order if cmp.match(names[i])]
+            elif not isinstance(order, list):
+                order = list(order)
+            self._orders[key] = order
+            while len(self._orders) > ORDER_CACHE_SIZE:
+                self._orders.popitem(last=False)
+        return order
+
+
 class VfsTable(Table):
     def __init__(self, folder):
         self.var_count = -1
@@ -167,7 +258,7 @@ class VfsTable(Table):
                                     "edit": (
                                         "tableurl",
                                         "../../%s/_/" % id,
-                                        _("Change folder"),
+                                        gettext_noop("Change folder"),
                                     )
                                 },
                             ]
@@ -194,7 +285,13 @@ class VfsTable(Table):
                             (size, ">," + self._size_to_color(size)),
                             (ctime, "," + self._time_to_color(ctime)),
                             info.raw,
-                            {"edit": ("command", "../../%s/_/" % id, _("Open file"))},
+                            {
+                                "edit": (
+                                    "command",
+                                    "../../%s/_/" % id,
+                                    gettext_noop("Open file"),
+                                )
+                            },
                         ]
                     )
                 except Exception as exception:
@@ -202,50 +299,60 @@ class VfsTable(Table):
 
         return elements
 
-    def page(self, nr, sort=None, value=None):
-        key = "FOLDER_" + bencode(self.folder) + "_TAB"
-        tabvalue = None
-        if tabvalue:
-            tab = tabvalue
-        else:
-            tab = self._get_table(value)[nr * 256 : (nr + 1) * 256]
-            cache.set(key + "::" + is_null(value, ""), tab, 300)
-
-        self.var_count = len(tab)
+    def _get_mtime(self):
+        try:
+            info = default_storage.fs.getinfo(
+                automount(self.folder), namespaces=["details"]
+            )
+            return info.modified
+        except:
+            return None
+
+    def _get_snapshot(self):
+        mtime = self._get_mtime()
+        with _snapshots_lock:
+            snapshot = _snapshots.get(self.folder)
+            if snapshot:
+                _snapshots.move_to_end(self.folder)
+        if snapshot and snapshot.is_valid(mtime):
+            return snapshot
+        rows = self._get_table()
+        snapshot = FolderSnapshot(mtime, rows)
+        with _snapshots_lock:
+            _snapshots[self.folder] = snapshot
+            _snapshots.move_to_end(self.folder)
+            while len(_snapshots) > SNAPSHOT_CACHE_SIZE:
+                _snapshots.popitem(last=False)
+        return snapshot
+
+    def _translate_row(self, row):
+        """Return copy of snapshot row with translated message of action"""
+        (action, href, title) = row[-1]["edit"]
+        return row[:-1] + [{"edit": (action, href, _(title))}]
+
+    def _get_sort(self, sort):
+        ts = []
         if sort != None:
-            s = sort.split(",")
-            ts = []
-            for pos in s:
+            for pos in sort.split(","):
                 if pos != "":
-                    id = 0
-                    znak = 0
                     if pos[0] == "-":
-                        id = self.col_names.index(pos[1:])
-                        znak = -1
+                        ts.append((self.col_names.index(pos[1:]), -1))
                     else:
-                        id = self.col_names.index(pos)
-                        znak = 1
-                    ts.append((id, znak))
+                        ts.append((self.col_names.index(pos), 1))
+        return tuple(ts)
 
-            def _cmp(x, y):
-                return str_cmp(x, y, ts)
-
-            tab.sort(key=functools.cmp_to_key(_cmp))
+    def page(self, nr, sort=None, value=None):
+        snapshot = self._get_snapshot()
+        order = snapshot.get_order(self._get_sort(sort), value)
+        tab = [
+            self._translate_row(snapshot.rows[i])
+            for i in order[nr * 256 : (nr + 1) * 256]
+        ]
+        self.var_count = len(tab)
         return tab
 
     def count(self, value):
-        key = "FOLDER_" + bencode(self.folder) + "_COUNT"
-        # countvalue = cache.get(key + '::' + is_null(value, ''))
-        countvalue = None
-
-        if countvalue:
-            return countvalue
-        else:
-            countvalue = len(self._get_table(value))
-            cache.set(key + "::" + is_null(value, ""), countvalue, 300)
-            return countvalue
-
-        return len(self._get_table(value))
+        return len(self._get_snapshot().get_order((), value))
 
     def insert_rec(self, rec):
         pass
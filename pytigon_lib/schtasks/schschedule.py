@@ -20,7 +20,13 @@
 # import pendulum
 import datetime
 import asyncio
+import collections
+import functools
+import heapq
+import inspect
+import time
 import types
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from asyncio.events import get_event_loop
 
@@ -37,6 +43,20 @@ LOGGER = logging.getLogger("pytigon_task")
 # INIT_TIME = pendulum.now()
 INIT_TIME = datetime.datetime.now()
 
+# seconds, max time of sleep of scheduler, protects against changes of system clock
+MAX_SLEEP = 60
+# seconds, when scheduler stops (all tasks removed) running tasks are awaited that long
+# before they are cancelled
+SHUTDOWN_GRACE_TIME = 30
+
+# execution modes of tasks
+MODE_INLINE = "inline"
+MODE_THREAD = "thread"
+MODE_PROCESS = "process"
+
+THREAD_WORKERS = 4
+PROCESS_WORKERS = 2
+
 
 def at_iterate(param):
     ret = []
@@ -242,13 +262,133 @@ def in_second_intervals(period=1, in_weekdays=None, in_hours=None):
     return _in_second_intervals
 
 
-def _key(elem):
-    return elem[4]
+def _call_task(fun, argi, argv):
+    """Call task in worker thread or process, coroutine functions are run in new event
+    loop"""
+    ret = fun(*argi, **argv)
+    if inspect.isawaitable(ret):
+        ret = asyncio.run(ret)
+    return ret
+
+
+class TaskInfo:
+    """Options and statistics of scheduled task"""
+
+    def __init__(
+        self,
+        max_instances=None,
+        misfire_grace_time=None,
+        coalesce=True,
+        mode=MODE_INLINE,
+    ):
+        """Constructor
+
+        Args:
+            max_instances - max number of running instances of task, if reached next
+            run is skipped. None - no limit.
+            misfire_grace_time - seconds, run which starts later is skipped. None - run
+            is never skipped.
+            coalesce - if True and many runs were missed (scheduler was blocked or
+            system clock changed) task is run once, if False every missed run is made
+            mode - MODE_INLINE: task is run in event loop of scheduler, MODE_THREAD: in
+            thread pool, MODE_PROCESS: in process pool - task function and its
+            arguments must be picklable. Use thread or process mode for blocking or
+            CPU-bound tasks, so they don't delay other tasks.
+        """
+        if mode not in (MODE_INLINE, MODE_THREAD, MODE_PROCESS):
+            raise ValueError("Unknown execution mode: %s" % mode)
+        self.mode = mode
+        self.max_instances = max_instances
+        self.misfire_grace_time = misfire_grace_time
+        self.coalesce = coalesce
+        self.seq = 0
+        self.removed = False
+        self.running = 0
+        self.runs = 0
+        self.errors = 0
+        self.skipped = 0
+        self.misfires = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        self.last_run_time = 0.0
+        self.max_run_time = 0.0
+        self.total_run_time = 0.0
+        self.last_result = ""
+        self.last_error = ""
+
+    def add_latency(self, latency):
+        self.last_latency = latency
+        self.total_latency += latency
+        if latency > self.max_latency:
+            self.max_latency = latency
+
+    def add_run_time(self, run_time, error=False):
+        self.runs += 1
+        if error:
+            self.errors += 1
+        self.last_run_time = run_time
+        self.total_run_time += run_time
+        if run_time > self.max_run_time:
+            self.max_run_time = run_time
+
+    def get_stats(self):
+        """Return dict with statistics, times are in seconds"""
+        return {
+            "mode": self.mode,
+            "last_result": self.last_result,
+            "last_error": self.last_error,
+            "running": self.running,
+            "runs": self.runs,
+            "errors": self.errors,
+            "skipped": self.skipped,
+            "misfires": self.misfires,
+            "last_latency": self.last_latency,
+            "max_latency": self.max_latency,
+            "avg_latency": self.total_latency / self.runs if self.runs else 0.0,
+            "last_run_time": self.last_run_time,
+            "max_run_time": self.max_run_time,
+            "avg_run_time": self.total_run_time / self.runs if self.runs else 0.0,
+        }
 
 
 class SChScheduler:
-    def __init__(self, mail_conf=None, rpc_port=None):
+    """Scheduler of tasks.
+
+    Task is a list: [task function, args, kwargs, time function, time of next run,
+    name, TaskInfo]. Times of next runs are kept in a heap, scheduler sleeps until the
+    first of them.
+    """
+
+    def __init__(
+        self,
+        mail_conf=None,
+        rpc_port=None,
+        max_running=None,
+        thread_workers=THREAD_WORKERS,
+        process_workers=PROCESS_WORKERS,
+    ):
+        """Constructor
+
+        Args:
+            mail_conf - configuration of imap client
+            rpc_port - port of XML-RPC server, None - server is not started
+            max_running - max number of tasks running at the same time, next tasks
+            wait for their end. None - no limit.
+            thread_workers - size of thread pool for tasks in MODE_THREAD
+            process_workers - size of process pool for tasks in MODE_PROCESS
+        """
         self.tasks = []
+        self.max_running = max_running
+        self.thread_workers = thread_workers
+        self.process_workers = process_workers
+        self._executors = {}
+        self._heap = []
+        self._seq = 0
+        self._running = set()
+        self._active = 0
+        self._queue = collections.deque()
+        self._wakeup = asyncio.Event()
         self.fmap = {
             "M": monthly,
             "d": daily,
@@ -273,6 +413,9 @@ class SChScheduler:
                 def xmlrpc_show_current_tasks(self):
                     return self.scheduler.show_current_tasks()
 
+                def xmlrpc_show_stats(self):
+                    return self.scheduler.show_stats()
+
             self.rpcserver = RpcServer(self)
 
             reactor.listenTCP(rpc_port, server.Site(self.rpcserver))
@@ -297,7 +440,17 @@ class SChScheduler:
     def __getattr__(self, item):
         return self.fmap[item]
 
-    def add_task(self, time_functions, task, *argi, **argv):
+    def add_task(self, time_functions, task, *argi, task_options=None, **argv):
+        """Add task
+
+        Args:
+            time_functions - function (previous time -> next time), list of them or
+            string, for example: "d(at='22:07');h(at=5)"
+            task - coroutine function
+            argi, argv - arguments of task
+            task_options - dict with arguments of TaskInfo: max_instances,
+            misfire_grace_time, coalesce, mode
+        """
         functions = []
         if type(time_functions) == str:
             x = time_functions.split(";")
@@ -324,7 +477,16 @@ class SChScheduler:
                 time_functions,
             ]
         for fun in functions:
-            self.tasks.append([task, argi, argv, fun, fun(), task.__name__])
+            t = [task, argi, argv, fun, fun(), task.__name__]
+            t.append(TaskInfo(**(task_options or {})))
+            self.tasks.append(t)
+            self._push(t)
+        self._wakeup.set()
+
+    def _push(self, task):
+        self._seq += 1
+        task[6].seq = self._seq
+        heapq.heappush(self._heap, (task[4], self._seq, task))
 
     def add_rpc_fun(self, name, fun):
         if self.rpcserver:
@@ -343,30 +505,135 @@ class SChScheduler:
     def remove_tasks(self, name):
         tasks = self.get_tasks(name)
         for task in tasks:
+            task[6].removed = True
             self.tasks.remove(task)
+        self._wakeup.set()
 
     def clear(self):
+        for task in self.tasks:
+            task[6].removed = True
         self.tasks.clear()
+        self._heap = []
+        self._wakeup.set()
+
+    def _start_due(self, now):
+        """Start tasks with time of next run <= now, return list of started asyncio tasks"""
+        started = []
+        while self._heap and self._heap[0][0] <= now:
+            dt, seq, task = heapq.heappop(self._heap)
+            info = task[6]
+            if info.removed or info.seq != seq:
+                continue
+            try:
+                next_time = task[3](dt)
+                if info.coalesce:
+                    while next_time <= now:
+                        next_time = task[3](next_time)
+                task[4] = next_time
+                self._push(task)
+            except:
+                LOGGER.exception("An error occurred in executing task")
+                continue
+            if (
+                info.misfire_grace_time is not None
+                and (now - dt).total_seconds() > info.misfire_grace_time
+            ):
+                info.misfires += 1
+                LOGGER.warning("Task misfired: " + task[5])
+                continue
+            if info.max_instances is not None and info.running >= info.max_instances:
+                info.skipped += 1
+                LOGGER.warning("Task skipped, previous run not finished: " + task[5])
+                continue
+            info.running += 1
+            t = self._start(task, dt)
+            if t:
+                started.append(t)
+        return started
+
+    def _start(self, task, scheduled):
+        """Start task or, if max_running tasks are running, add it to queue"""
+        if self.max_running and self._active >= self.max_running:
+            self._queue.append((task, scheduled))
+            return None
+        self._active += 1
+        t = asyncio.get_event_loop().create_task(self._run_task(task, scheduled))
+        self._running.add(t)
+        t.add_done_callback(self._running.discard)
+        return t
+
+    async def _run_task(self, task, scheduled):
+        info = task[6]
+        try:
+            info.add_latency((datetime.datetime.now() - scheduled).total_seconds())
+            LOGGER.info("Running task: " + task[5])
+            start = time.monotonic()
+            error = False
+            try:
+                if info.mode == MODE_INLINE:
+                    ret = task[0](*task[1], **task[2])
+                    if inspect.isawaitable(ret):
+                        ret = await ret
+                else:
+                    ret = await asyncio.get_event_loop().run_in_executor(
+                        self._get_executor(info.mode),
+                        functools.partial(_call_task, task[0], task[1], task[2]),
+                    )
+                if ret is not None:
+                    info.last_result = repr(ret)[:256]
+                    LOGGER.info("Task %s returned: %s" % (task[5], info.last_result))
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                error = True
+                info.last_error = repr(exc)[:256]
+                LOGGER.exception("An error occurred in task: " + task[5])
+            info.add_run_time(time.monotonic() - start, error)
+        finally:
+            info.running -= 1
+            self._active -= 1
+            while self._queue and (
+                not self.max_running or self._active < self.max_running
+            ):
+                task2, scheduled2 = self._queue.popleft()
+                if task2[6].removed:
+                    task2[6].running -= 1
+                else:
+                    self._start(task2, scheduled2)
+
+    def _get_executor(self, mode):
+        executor = self._executors.get(mode)
+        if executor is None:
+            if mode == MODE_THREAD:
+                executor = ThreadPoolExecutor(
+                    max_workers=self.thread_workers, thread_name_prefix="schschedule"
+                )
+            else:
+                executor = ProcessPoolExecutor(max_workers=self.process_workers)
+            self._executors[mode] = executor
+        return executor
+
+    def _shutdown_executors(self):
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._executors = {}
 
     async def process(self, dt):
-        if self.tasks:
-            processes = []
-            for task in self.tasks:
-                if task[4] <= dt:
-                    try:
-                        task[4] = task[3](task[4])
-                        processes.append(task[0](*task[1], **task[2]))
-                        LOGGER.info("Running task: " + task[5])
-                    except:
-                        LOGGER.exception("An error occurred in executing task")
-
-            if processes:
-                self.tasks.sort(key=_key)
-                try:
-                    done, pending = await asyncio.wait(processes)
-                    results = [future.result() for future in done]
-                except:
-                    LOGGER.exception("An error occurred in task")
+        """Run tasks with time of next run <= dt and wait for their end"""
+        started = self._start_due(dt)
+        if started:
+            await asyncio.wait(started)
+
+    def _get_delay(self):
+        """Return seconds to time of the first run"""
+        while self._heap:
+            dt, seq, task = self._heap[0]
+            if task[6].removed or task[6].seq != seq:
+                heapq.heappop(self._heap)
+                continue
+            delay = (dt - datetime.datetime.now()).total_seconds()
+            return min(max(delay, 0), MAX_SLEEP)
+        return MAX_SLEEP
 
     def show_tasks(self):
         ret = []
@@ -379,26 +646,64 @@ class SChScheduler:
         ret = []
         for task in asyncio.all_tasks():
             name = task._coro.__name__
-            if not name in ("_run", "process"):
+            if not name in ("_run", "process", "_run_task"):
                 ret.append(task._coro.__name__)
+        for task in self.tasks:
+            for i in range(task[6].running):
+                ret.append(task[5])
         return ret
 
+    def show_stats(self):
+        """Return statistics of scheduler and its tasks"""
+        tasks = []
+        for task in self.tasks:
+            stats = task[6].get_stats()
+            stats["name"] = str(task[5])
+            stats["next_run"] = str(task[4])
+            tasks.append(stats)
+        return {
+            "tasks": len(self.tasks),
+            "running": len(self._running),
+            "queued": len(self._queue),
+            "max_running": self.max_running or 0,
+            "task_stats": tasks,
+        }
+
     async def _run(self):
         if self.tasks or self.rpcserver_activated or self.imap4:
             while True:
                 try:
-                    loop = asyncio.get_event_loop()
-                    # loop.create_task(self.process(pendulum.now()))
-                    loop.create_task(self.process(datetime.datetime.now()))
+                    # self._start_due(pendulum.now())
+                    self._start_due(datetime.datetime.now())
                     if (
                         not self.tasks
                         and not self.rpcserver_activated
                         and not self.imap4
                     ):
-                        return
+                        break
                 except:
                     LOGGER.exception("Problem with scheduler")
-                await asyncio.sleep(1)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self._get_delay())
+                except asyncio.TimeoutError:
+                    pass
+            for task, scheduled in self._queue:
+                task[6].running -= 1
+            self._queue.clear()
+            if self._running:
+                done, pending = await asyncio.wait(
+                    list(self._running), timeout=SHUTDOWN_GRACE_TIME
+                )
+                if pending:
+                    LOGGER.warning(
+                        "Scheduler: %d tasks cancelled after %s seconds"
+                        % (len(pending), SHUTDOWN_GRACE_TIME)
+                    )
+                    for t in pending:
+                        t.cancel()
+                    await asyncio.wait(pending)
+            self._shutdown_executors()
 
     def run(self):
         loop = asyncio.get_event_loop()
@@ -229,13 +229,12 @@ class ExtTemplateResponse(LocalizationTemplateResponse):
         if self.context_data["view"].doc_type() in ("ods", "odt", "odp"):
             self["Content-Type"] = "application/vnd.oasis.opendocument.spreadsheet"
             file_out, file_in = render_odf(
-                self.template_name, Context(self.resolve_context(self.context_data))
+                self.template_name,
+                Context(self.resolve_context(self.context_data)),
+                stream=True,
             )
             if file_out:
-                f = open(file_out, "rb")
-                self.content = f.read()
-                f.close()
-                os.remove(file_out)
+                self.content = file_out.getvalue()
                 file_in_name = os.path.basename(file_in)
                 self["Content-Disposition"] = "attachment; filename=%s" % file_in_name
             return self
@@ -244,14 +243,12 @@ class ExtTemplateResponse(LocalizationTemplateResponse):
                 "Content-Type"
             ] = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
             context = self.resolve_context(self.context_data)
-            stream_out = render_ooxml(self.template_name, Context(context))
-            if type(stream_out) == tuple:
-                with open(stream_out[0], "rb") as f:
-                    self.content = f.read()
-                    file_in_name = os.path.basename(stream_out[1])
-            else:
-                self.content = stream_out.getvalue()
-                file_in_name = os.path.basename(self.template_name[0])
+            file_out, file_in = render_ooxml(
+                self.template_name, Context(context), stream=True
+            )
+            if file_out:
+                self.content = file_out.getvalue()
+            file_in_name = os.path.basename(file_in)
             self["Content-Disposition"] = "attachment; filename=%s" % file_in_name
             return self
         else: